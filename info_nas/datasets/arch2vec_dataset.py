@@ -9,6 +9,7 @@ import torch
 
 from info_nas.config import local_dataset_cfg
 from info_nas.datasets.io.create_dataset import load_io_dataset, dataset_from_pretrained
+from info_nas.datasets.io.sharded import is_sharded, get_sharded_hashes
 from arch2vec.extensions.get_nasbench101_model import get_nasbench_datasets
 from arch2vec.preprocessing.gen_json import gen_json_file
 from nasbench_pytorch.datasets.cifar10 import prepare_dataset
@@ -183,6 +184,14 @@ def split_off_valid(test_labeled, ratio=0.1):
     Returns: Dataset from the rest of the networks, splitted dataset.
 
     """
+    if is_sharded(test_labeled):
+        # split using the network filter, the shards are shared
+        unique_nets = np.unique(get_sharded_hashes(test_labeled))
+        chosen_hashes = unique_nets[:math.ceil(ratio * len(unique_nets))]
+        rest_hashes = unique_nets[math.ceil(ratio * len(unique_nets)):]
+
+        return {**test_labeled, 'net_filter': rest_hashes}, {**test_labeled, 'net_filter': chosen_hashes}
+
     unique_nets = np.unique(test_labeled['net_hashes'])
     chosen_hashes = unique_nets[:math.ceil(ratio * len(unique_nets))]
 
@@ -239,7 +248,8 @@ def _create_or_load_labeled(nasbench, dataset, pretrained_paths, labeled_path, u
 
     if os.path.exists(labeled_path):
         print(f'Loading labeled dataset from {labeled_path}.')
-        labeled = load_io_dataset(labeled_path)
+        # encoded data is decoded per item by the labeled datasets
+        labeled = load_io_dataset(labeled_path, decode=False)
     else:
         if isinstance(dataset, str):
             dataset = prepare_dataset(root=dataset, random_state=seed, no_valid_transform=False, **config['cifar-10'])
@@ -0,0 +1,242 @@
+import numpy as np
+import torch
+import torchvision
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.sampler import SubsetRandomSampler
+
+
+# normalization of the CIFAR-10 images (nasbench_pytorch.datasets.cifar10)
+CIFAR_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR_STD = (0.2023, 0.1994, 0.2010)
+
+
+def load_shared_cifar(root='./data/', download=True):
+    """
+    Decode the CIFAR-10 dataset once into uint8 tensors in shared memory. The tensors can be passed to worker
+    processes without copying (see `info_nas.datasets.networks.pretrained.pretrain_network_dataset_parallel`).
+
+    Args:
+        root: Directory path to download the CIFAR-10 dataset to.
+        download: Download the dataset if it does not exist.
+
+    Returns: A dict {'train': (images, labels), 'test': (images, labels)}, images have the shape (N, 3, 32, 32).
+
+    """
+    shared = {}
+
+    for split in ['train', 'test']:
+        cifar = torchvision.datasets.CIFAR10(root=root, train=(split == 'train'), download=download)
+
+        images = torch.from_numpy(cifar.data).permute(0, 3, 1, 2).contiguous()
+        labels = torch.tensor(cifar.targets, dtype=torch.long)
+
+        shared[split] = images.share_memory_(), labels.share_memory_()
+
+    return shared
+
+
+def get_cifar_transforms(train=True):
+    """
+    Get the CIFAR-10 transforms for uint8 image tensors, equivalent to the transforms of
+    `nasbench_pytorch.datasets.cifar10.prepare_dataset` (the random transforms draw the same random numbers).
+    """
+    train_transforms = [transforms.RandomCrop(32, padding=4), transforms.RandomHorizontalFlip()] if train else []
+
+    return transforms.Compose(train_transforms + [
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize(CIFAR_MEAN, CIFAR_STD)
+    ])
+
+
+class TensorCIFAR(Dataset):
+    """
+    CIFAR-10 dataset backed by uint8 image tensors (e.g. shared by multiple processes).
+    """
+    def __init__(self, images, labels, transform=None):
+        self.images = images
+        self.labels = labels
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        image = self.images[index]
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, self.labels[index]
+
+
+def prepare_shared_dataset(shared_cifar, batch_size, test_batch_size=256, validation_size=10000, split_from_end=True,
+                           random_state=None, no_valid_transform=True, num_workers=0, num_val_workers=0,
+                           num_test_workers=0):
+    """
+    Prepare the CIFAR-10 loaders from the shared tensors (see `load_shared_cifar`), with the same splits and
+    transforms as `nasbench_pytorch.datasets.cifar10.prepare_dataset`.
+
+    Args:
+        shared_cifar: The shared CIFAR-10 tensors.
+        batch_size: Batch size for the train (and validation) loader.
+        test_batch_size: Batch size for the test loader.
+        validation_size: Size of the validation dataset to split off the train set.
+        split_from_end: If True, split off `validation_size` images from the end, if False, choose images randomly.
+        random_state: Seed for the random validation split.
+        no_valid_transform: If True, don't use RandomCrop and RandomFlip for the validation set.
+        num_workers: Number of workers for the train loader.
+        num_val_workers: Number of workers for the validation loader.
+        num_test_workers: Number of workers for the test loader.
+
+    Returns: train loader, train size, validation loader, validation size, test loader, test size
+
+    """
+    train_images, train_labels = shared_cifar['train']
+    test_images, test_labels = shared_cifar['test']
+
+    train_set = TensorCIFAR(train_images, train_labels, transform=get_cifar_transforms(train=True))
+    valid_set = TensorCIFAR(train_images, train_labels, transform=get_cifar_transforms(train=not no_valid_transform))
+    train_size = len(train_set)
+
+    train_inds, valid_inds = _split_indices(train_size, validation_size, split_from_end, random_state)
+
+    if split_from_end:
+        train_set = torch.utils.data.Subset(train_set, train_inds)
+        valid_set = torch.utils.data.Subset(valid_set, valid_inds)
+        train_sampler, valid_sampler = None, None
+    else:
+        train_sampler, valid_sampler = SubsetRandomSampler(train_inds), SubsetRandomSampler(valid_inds)
+
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=split_from_end, sampler=train_sampler,
+                              num_workers=num_workers)
+    valid_loader = DataLoader(valid_set, batch_size=batch_size, shuffle=False, sampler=valid_sampler,
+                              num_workers=num_val_workers)
+
+    test_set = TensorCIFAR(test_images, test_labels, transform=get_cifar_transforms(train=False))
+    test_loader = DataLoader(test_set, batch_size=test_batch_size, shuffle=False, num_workers=num_test_workers)
+
+    return train_loader, train_size - validation_size, valid_loader, validation_size, test_loader, len(test_set)
+
+
+def prepare_batched_dataset(shared_cifar, batch_size, test_batch_size=256, validation_size=10000, split_from_end=True,
+                            random_state=None, no_valid_transform=True, device=None, **kwargs):
+    """
+    Prepare CIFAR-10 loaders that augment whole batches with tensor operations (see `BatchedCIFARLoader`) instead of
+    transforming images one by one in DataLoader workers. The splits are the same as in `prepare_shared_dataset`, the
+    loaders can be passed to `info_nas.datasets.networks.pretrained.pretrain_network_cifar` as they are.
+
+    Args:
+        shared_cifar: The CIFAR-10 tensors (see `load_shared_cifar`).
+        batch_size: Batch size for the train (and validation) loader.
+        test_batch_size: Batch size for the test loader.
+        validation_size: Size of the validation dataset to split off the train set.
+        split_from_end: If True, split off `validation_size` images from the end, if False, choose images randomly.
+        random_state: Seed for the random validation split.
+        no_valid_transform: If True, don't use RandomCrop and RandomFlip for the validation set.
+        device: Device where the batches are augmented (the uint8 batch is moved there first).
+        **kwargs: Ignored DataLoader options (e.g. num_workers from the dataset config).
+
+    Returns: train loader, train size, validation loader, validation size, test loader, test size
+
+    """
+    train_images, train_labels = shared_cifar['train']
+    test_images, test_labels = shared_cifar['test']
+
+    train_inds, valid_inds = _split_indices(len(train_images), validation_size, split_from_end, random_state)
+    train_inds, valid_inds = torch.as_tensor(train_inds), torch.as_tensor(valid_inds)
+
+    train_loader = BatchedCIFARLoader(train_images, train_labels, batch_size, indices=train_inds, shuffle=True,
+                                      augment=True, device=device)
+    valid_loader = BatchedCIFARLoader(train_images, train_labels, batch_size, indices=valid_inds, shuffle=False,
+                                      augment=not no_valid_transform, device=device)
+    test_loader = BatchedCIFARLoader(test_images, test_labels, test_batch_size, shuffle=False, augment=False,
+                                     device=device)
+
+    return train_loader, len(train_inds), valid_loader, len(valid_inds), test_loader, len(test_images)
+
+
+class BatchedCIFARLoader:
+    """
+    Iterates over batches of uint8 CIFAR-10 tensors, random crop with padding, horizontal flip and normalization
+    are applied to the whole batch at once (the same transforms as in `get_cifar_transforms`).
+    """
+    def __init__(self, images, labels, batch_size, indices=None, shuffle=True, augment=True, padding=4,
+                 device=None, generator=None):
+        """
+        Initializes the loader.
+
+        Args:
+            images: The images, uint8 tensor (N, 3, H, W).
+            labels: The labels.
+            batch_size: Batch size.
+            indices: Indices of the images to iterate over, by default all images.
+            shuffle: Shuffle the images every epoch.
+            augment: Apply random crop and horizontal flip.
+            padding: Padding of the random crop.
+            device: Device where the batches are augmented.
+            generator: Random generator for the shuffling and augmentation, by default the global torch generator.
+        """
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.indices = indices if indices is not None else torch.arange(len(images))
+        self.shuffle = shuffle
+        self.augment = augment
+        self.padding = padding
+        self.device = device
+        self.generator = generator
+
+        self.mean = torch.tensor(CIFAR_MEAN).view(1, -1, 1, 1)
+        self.std = torch.tensor(CIFAR_STD).view(1, -1, 1, 1)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator)]
+
+        for i in range(0, len(indices), self.batch_size):
+            batch_inds = indices[i:i + self.batch_size]
+
+            images = self.images[batch_inds].to(self.device)
+            labels = self.labels[batch_inds].to(self.device)
+
+            if self.augment:
+                images = self._augment(images)
+
+            yield self._normalize(images), labels
+
+    def _augment(self, images):
+        n, _, h, w = images.shape
+        device = images.device
+
+        # random crop - a random window of every padded image
+        padded = F.pad(images, [self.padding] * 4)
+        offsets = torch.randint(0, 2 * self.padding + 1, (2, n), generator=self.generator).to(device)
+        rows = (offsets[0, :, None] + torch.arange(h, device=device))[:, None, :, None]
+        cols = (offsets[1, :, None] + torch.arange(w, device=device))[:, None, None, :]
+        batch_ids = torch.arange(n, device=device)[:, None, None, None]
+        channel_ids = torch.arange(images.shape[1], device=device)[None, :, None, None]
+        images = padded[batch_ids, channel_ids, rows, cols]
+
+        # horizontal flip with probability 0.5
+        flip = (torch.rand(n, generator=self.generator) < 0.5).to(device)
+        return torch.where(flip[:, None, None, None], images.flip(3), images)
+
+    def _normalize(self, images):
+        images = images.float().div_(255)
+        return (images - self.mean.to(images.device)) / self.std.to(images.device)
+
+
+def _split_indices(train_size, validation_size, split_from_end, random_state):
+    if split_from_end:
+        indices = np.arange(train_size)
+        return indices[:-validation_size], indices[-validation_size:]
+
+    rng = np.random.RandomState(seed=random_state) if random_state is not None else np.random
+    valid_inds = rng.choice(train_size, size=validation_size, replace=False)
+    train_inds = np.delete(np.arange(train_size), valid_inds)
+    return train_inds, valid_inds
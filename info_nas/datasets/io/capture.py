@@ -0,0 +1,165 @@
+import torch
+from nasbench_pytorch.model import Network as NBNetwork
+
+from info_nas.datasets.io.output_layers import get_output_column
+
+
+def get_capture_points(net: NBNetwork):
+    """
+    List the points where the input and output data can be captured, in the same order as the lists returned by
+    `net.get_cell_outputs(inputs, return_inputs=True)`.
+
+    The inputs are the input image, the inputs of all cells and the pooled features (input of the classifier). The
+    outputs are the outputs of all cells, the pooled features and the logits (output of the classifier).
+
+    Args:
+        net: The network to capture the data from.
+
+    Returns: input points, output points - lists of tuples (module, is_input), the data is either the input or the
+        output of the module.
+
+    """
+    cells = [net.layers[i] for i in sorted(net.cell_indices)]
+
+    in_points = [(net.layers[0], True)] + [(c, True) for c in cells] + [(net.classifier, True)]
+    out_points = [(c, False) for c in cells] + [(net.classifier, True), (net.classifier, False)]
+
+    return in_points, out_points
+
+
+class IOCapture:
+    """
+    Records the input and output data of a network using forward hooks, so that the data is captured during the same
+    forward pass that returns the logits. Use it as a context manager, the hooks are removed on exit.
+
+    Example:
+        with IOCapture(net, nth_input=1, nth_output=-2) as capture:
+            logits = capture.forward(inputs)
+            in_data, out_data = capture.input, capture.output
+
+    With `capture.forward(inputs, truncate=True)`, the layers after the last captured point are skipped.
+
+    If `nth_output` is a list, the outputs of all listed layers are captured in the same pass (`capture.outputs`).
+
+    """
+    def __init__(self, net: NBNetwork, nth_input=None, nth_output=None):
+        """
+        Initializes the capture.
+
+        Args:
+            net: The network to capture the data from.
+            nth_input: The index of the captured input data (see `get_capture_points`), if None, no input is captured.
+            nth_output: The index of the captured output data, or a list of indices. If None, no output is captured.
+        """
+        self.net = net
+
+        in_points, out_points = get_capture_points(net)
+        self.points = {}
+
+        if nth_input is not None:
+            self.points['input'] = in_points[nth_input]
+
+        self.output_keys = []
+        if nth_output is not None:
+            nth_output = nth_output if isinstance(nth_output, list) else [nth_output]
+            self.output_keys = [get_output_column(i) for i in range(len(nth_output))]
+
+            for key, nth in zip(self.output_keys, nth_output):
+                self.points[key] = out_points[nth]
+
+        self.captured = {}
+        self._handles = []
+
+    @property
+    def input(self):
+        return self.captured.get('input')
+
+    @property
+    def output(self):
+        return self.captured.get(self.output_keys[0]) if len(self.output_keys) else None
+
+    @property
+    def outputs(self):
+        return [self.captured.get(key) for key in self.output_keys]
+
+    def forward(self, x, truncate=False):
+        """
+        Run the forward pass of the network and capture the data.
+
+        Args:
+            x: The network input.
+            truncate: If True, skip all layers after the last captured point. The classifier is skipped as well if
+                the logits are not captured.
+
+        Returns: The logits, or None if the classifier was skipped.
+
+        """
+        if not truncate:
+            return self.net(x)
+
+        n_layers, use_classifier = self._get_truncated_depth()
+        for i, layer in enumerate(self.net.layers):
+            if i == n_layers:
+                self._capture_skipped(layer, x)
+                return None
+
+            x = layer(x)
+
+        out = torch.mean(x, (2, 3))
+        if not use_classifier:
+            self._capture_skipped(self.net.classifier, out)
+            return None
+
+        return self.net.classifier(out)
+
+    def _capture_skipped(self, skipped_module, x):
+        # the pre-hooks of the first skipped module are not called, save its input directly
+        for key, (module, is_input) in self.points.items():
+            if module is skipped_module and is_input:
+                self.captured[key] = x
+
+    def _get_truncated_depth(self):
+        layers = list(self.net.layers)
+        n_layers, use_classifier = 0, False
+
+        for module, is_input in self.points.values():
+            if module is self.net.classifier:
+                # pooled features are computed from the last layer
+                n_layers = len(layers)
+                use_classifier = use_classifier or not is_input
+                continue
+
+            # the input of a layer is available before the layer is run
+            layer_idx = next(i for i, layer in enumerate(layers) if layer is module)
+            n_layers = max(n_layers, layer_idx if is_input else layer_idx + 1)
+
+        return n_layers, use_classifier
+
+    def _get_hook(self, key, is_input):
+        if is_input:
+            def hook(module, inputs):
+                self.captured[key] = inputs[0]
+        else:
+            def hook(module, inputs, outputs):
+                self.captured[key] = outputs
+
+        return hook
+
+    def __enter__(self):
+        for key, (module, is_input) in self.points.items():
+            hook = self._get_hook(key, is_input)
+            if is_input:
+                handle = module.register_forward_pre_hook(hook)
+            else:
+                handle = module.register_forward_hook(hook)
+
+            self._handles.append(handle)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for handle in self._handles:
+            handle.remove()
+
+        self._handles.clear()
+        self.captured.clear()
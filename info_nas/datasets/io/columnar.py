@@ -0,0 +1,211 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
+from collections.abc import MutableMapping
+
+import numpy as np
+import torch
+
+
+METADATA_NAME = 'columns.json'
+
+COMPRESSION = {'gzip': gzip.open, 'bz2': bz2.open, 'lzma': lzma.open}
+
+
+def is_columnar(dataset_dir: str):
+    """
+    Check if the directory contains a columnar IO dataset (see `save_columnar_io_dataset`).
+    """
+    return os.path.exists(os.path.join(dataset_dir, METADATA_NAME))
+
+
+def save_columnar_io_dataset(data, save_dir: str, compression=None):
+    """
+    Save the IO dataset in a columnar format - every array column is saved as a raw .npy array that can be
+    memory-mapped, other values are saved using torch.save. Column types and shapes are stored in a small metadata
+    file.
+
+    Args:
+        data: The IO dataset (see `info_nas.datasets.io.create_dataset.create_io_dataset` for the format).
+        save_dir: Directory to save the columns to.
+        compression: Compression of the array columns ('gzip', 'bz2' or 'lzma'), either one method for all columns,
+            or a dict {column name: method}. Compressed columns are not memory-mapped, they are decompressed on
+            load.
+
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    if not isinstance(compression, dict):
+        compression = {key: compression for key in data.keys()}
+
+    columns = {}
+    metadata = {'columns': columns}
+
+    for key, value in data.items():
+        if isinstance(value, (bool, int, float, str)) or value is None:
+            metadata[key] = value
+            continue
+
+        if isinstance(value, torch.Tensor):
+            col_type, array, dtype = 'torch', _tensor_to_numpy(value), str(value.dtype).replace('torch.', '')
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            col_type, array, dtype = 'numpy', value, str(value.dtype)
+        else:
+            # e.g. the net repo
+            file_name = f'{key}.pt'
+            torch.save(value, os.path.join(save_dir, file_name))
+            columns[key] = {'file': file_name, 'type': 'pickle'}
+            continue
+
+        method = compression.get(key)
+        file_name = f'{key}.npy' if method is None else f'{key}.npy.{method}'
+        _save_array(os.path.join(save_dir, file_name), np.ascontiguousarray(array), method)
+
+        columns[key] = {'file': file_name, 'type': col_type, 'dtype': dtype, 'shape': list(array.shape),
+                        'compression': method}
+
+    with open(os.path.join(save_dir, METADATA_NAME), 'w') as f:
+        json.dump(metadata, f, indent=4)
+
+
+def _tensor_to_numpy(tensor):
+    tensor = tensor.detach().cpu()
+
+    # numpy has no bfloat16, save the raw bits
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+
+    return tensor.numpy()
+
+
+def _save_array(path, array, compression=None):
+    if compression is None:
+        np.save(path, array)
+        return
+
+    if compression not in COMPRESSION:
+        raise ValueError(f"Invalid compression: {compression}, possible values are {list(COMPRESSION.keys())}.")
+
+    with COMPRESSION[compression](path, 'wb') as f:
+        np.save(f, array)
+
+
+def _load_array(path, compression=None):
+    if compression is None:
+        # copy-on-write mapping - the views are writable, but the changes are not saved to the file
+        return np.load(path, mmap_mode='c')
+
+    with COMPRESSION[compression](path, 'rb') as f:
+        return np.load(f)
+
+
+def load_columnar_io_dataset(dataset_dir: str, device=None):
+    """
+    Load the columnar IO dataset lazily - the columns are loaded on first access.
+
+    Args:
+        dataset_dir: Directory with the saved columns.
+        device: Device for the data, if None or cpu, the uncompressed array columns are zero-copy views of
+            memory-mapped files.
+
+    Returns: The loaded dataset (dict-like).
+
+    """
+    with open(os.path.join(dataset_dir, METADATA_NAME), 'r') as f:
+        metadata = json.load(f)
+
+    return LazyIODataset(dataset_dir, metadata, device=device)
+
+
+class LazyIODataset(MutableMapping):
+    """
+    A dict-like IO dataset, where the columns are memory-mapped (or loaded) on first access.
+    """
+    def __init__(self, dataset_dir, metadata, device=None):
+        self.dataset_dir = dataset_dir
+        self.columns = dict(metadata['columns'])
+        self.device = device
+
+        self._data = {k: v for k, v in metadata.items() if k != 'columns'}
+
+        # functions applied on the columns when they are loaded (see `map_column`)
+        self._column_fns = {}
+
+    def _load_column(self, key):
+        column = self.columns[key]
+        path = os.path.join(self.dataset_dir, column['file'])
+
+        if column['type'] == 'pickle':
+            return torch.load(path, map_location=self.device)
+
+        array = _load_array(path, column.get('compression'))
+        if column['type'] == 'numpy':
+            return array
+
+        tensor = torch.from_numpy(array)
+        if column['dtype'] == 'bfloat16':
+            tensor = tensor.view(torch.bfloat16)
+
+        if self.device is not None:
+            tensor = tensor.to(self.device)
+
+        return tensor
+
+    def map_column(self, key, fn):
+        """
+        Apply `fn` on the column. If the column was not loaded yet, it is applied when the column is accessed, so
+        that the dataset stays lazy (e.g. decoding, see `info_nas.datasets.io.encoding.decode_io_dataset`).
+        """
+        if key in self._data:
+            self._data[key] = fn(self._data[key])
+        elif key in self.columns:
+            self._column_fns[key] = self._column_fns.get(key, []) + [fn]
+        else:
+            raise KeyError(key)
+
+    def copy(self):
+        """
+        Shallow copy of the dataset - the loaded columns are shared, the other columns stay lazy.
+        """
+        data = LazyIODataset(self.dataset_dir, {'columns': self.columns}, device=self.device)
+        data._data = dict(self._data)
+        data._column_fns = dict(self._column_fns)
+        return data
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            if key not in self.columns:
+                raise KeyError(key)
+
+            value = self._load_column(key)
+            for fn in self._column_fns.pop(key, []):
+                value = fn(value)
+
+            self._data[key] = value
+
+        return self._data[key]
+
+    def __contains__(self, key):
+        # do not load the column
+        return key in self._data or key in self.columns
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._data and key not in self.columns:
+            raise KeyError(key)
+
+        self._data.pop(key, None)
+        self.columns.pop(key, None)
+        self._column_fns.pop(key, None)
+
+    def __iter__(self):
+        yield from self.columns
+        yield from (k for k in self._data if k not in self.columns)
+
+    def __len__(self):
+        return len(set(self.columns) | set(self._data))
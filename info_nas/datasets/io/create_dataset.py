@@ -1,26 +1,53 @@
 import numpy as np
 import os
+import shutil
+import time
 import torch
 from torch import nn
+from torch.utils.data import DataLoader, SequentialSampler, Subset
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain, islice
 from typing import List, Union
 from nasbench_pytorch.model import Network as NBNetwork
-from info_nas.datasets.networks.utils import load_trained_net
-
-
-def load_io_dataset(dataset_path: str, device=None):
+from info_nas.datasets.io.capture import IOCapture, get_capture_points
+from info_nas.datasets.io.columnar import is_columnar, load_columnar_io_dataset, save_columnar_io_dataset
+from info_nas.datasets.io.encoding import get_encoding, encode_io_dataset, decode_io_dataset, decode_images
+from info_nas.datasets.io.output_layers import get_output_column, get_output_columns, get_output_layers, \
+    normalize_output_layers
+from info_nas.datasets.io.reducers import get_layer_reducers
+from info_nas.datasets.io.sharded import ShardWriter, load_sharded_io_dataset, is_sharded, is_sharded_dir, \
+    merge_shards
+from info_nas.datasets.networks.utils import load_trained_nets
+
+
+def load_io_dataset(dataset_path: str, device=None, decode=True):
     """
     Load the saved dataset, map the data location to `device`.
 
     Args:
-        dataset_path: Path to the checkpoint (.pt format)
+        dataset_path: Path to the checkpoint (.pt format), or a directory with a columnar dataset (see
+            `info_nas.datasets.io.columnar.load_columnar_io_dataset`) or a sharded dataset (see
+            `info_nas.datasets.io.sharded.load_sharded_io_dataset`).
+
         device: Device for the data.
+        decode: If True, decode datasets saved with reduced precision (see `info_nas.datasets.io.encoding`) to the
+            float format. If False, the data stays encoded (and is decoded per item by the labeled datasets).
 
     Returns: The loaded IO dataset
 
     """
-    data = torch.load(dataset_path, map_location=device)
-    return data
+    if os.path.isdir(dataset_path):
+        if is_columnar(dataset_path):
+            data = load_columnar_io_dataset(dataset_path, device=device)
+        else:
+            data = load_sharded_io_dataset(dataset_path, device=device)
+    else:
+        data = torch.load(dataset_path, map_location=device)
+
+    return decode_io_dataset(data) if decode else data
 
 
 def _list_net_dir(net_dir: str):
@@ -28,11 +55,28 @@ def _list_net_dir(net_dir: str):
     return [os.path.join(net_dir, n) for n in net_paths]
 
 
+def _get_net_paths(net_dir: Union[str, List[str]]):
+    # pretrained networks in one folder
+    if isinstance(net_dir, str):
+        net_dir = [net_dir]
+
+    # join multiple folders
+    return [p for nd in net_dir for p in _list_net_dir(nd) if p.endswith('.tar')]
+
+
+def _get_path_hash(net_path: str):
+    # checkpoints are saved as {net_hash}.tar
+    return os.path.splitext(os.path.basename(net_path))[0]
+
+
 def dataset_from_pretrained(net_dir: Union[str, List[str]], nasbench, dataset, save_path: str, device=None,
-                            use_test_data=False, **kwargs):
+                            use_test_data=False, shard_size=None, columnar=False, n_load_workers=0, prefetch_depth=4,
+                            load_in_processes=False, resume=False, progress_every=50, output_dtype=None,
+                            image_dtype=None, compression=None, **kwargs):
     """
     Create the IO dataset using the checkpoints of trained networks and a dataset of inputs. Save it to a directory,
-    the output file format is .pt.
+    the output file format is .pt. If `shard_size` is set, the dataset is written in shards as the networks are
+    processed, and `save_path` is a directory.
 
     Args:
         net_dir: Either a list of directories, or one directory, where the .tar network checkpoints are loaded from.
@@ -43,31 +87,231 @@ def dataset_from_pretrained(net_dir: Union[str, List[str]], nasbench, dataset, s
         save_path: Path to save the checkpoint (the output should have the .pt format).
         device: The device for the neural networks (used during prediction).
         use_test_data: If True, use the test dataset, if False, use the validation set for IO dataset creation.
+        shard_size: If not None, write shards of `shard_size` networks to the `save_path` directory instead of
+            keeping the whole dataset in memory.
+
+        columnar: If True, save the dataset in the memory-mapped columnar format to the `save_path` directory (see
+            `info_nas.datasets.io.columnar.save_columnar_io_dataset`).
+
+        n_load_workers: If > 0, load the checkpoints in a pool of `n_load_workers` while the current network is
+            evaluated.
+
+        prefetch_depth: Maximum number of checkpoints loaded in advance.
+        load_in_processes: If True, use a process pool for loading instead of a thread pool.
+        resume: If True, the progress is saved to disk every `progress_every` networks (every shard if `shard_size`
+            is set). If a previous run was interrupted, the saved progress is loaded and only the remaining
+            networks are processed (using the same input images).
+
+        progress_every: Number of networks between progress saves (used if `resume` is True and `shard_size` is
+            None).
+
+        output_dtype: If not None, save the outputs in reduced precision ('float16' or 'bfloat16').
+        image_dtype: If 'uint8', save the reference images as pixel values (see
+            `info_nas.datasets.io.encoding.get_encoding`).
+
+        compression: Compression of the columns of the columnar format (see
+            `info_nas.datasets.io.columnar.save_columnar_io_dataset`).
+
         **kwargs: Additional kwargs for the `create_io_dataset` function.
 
     Returns: The generated IO dataset.
 
     """
 
-    # pretrained networks in one folder
-    if isinstance(net_dir, str):
-        net_dir = [net_dir]
+    if resume:
+        return _resumable_from_pretrained(net_dir, nasbench, dataset, save_path, device=device,
+                                          use_test_data=use_test_data, shard_size=shard_size, columnar=columnar,
+                                          n_load_workers=n_load_workers, prefetch_depth=prefetch_depth,
+                                          load_in_processes=load_in_processes, progress_every=progress_every,
+                                          output_dtype=output_dtype, image_dtype=image_dtype,
+                                          compression=compression, **kwargs)
 
-    # join multiple folders
-    net_paths = [p for nd in net_dir for p in _list_net_dir(nd) if p.endswith('.tar')]
+    net_paths = _get_net_paths(net_dir)
 
     print(f'Creating dataset from {len(net_paths)} pretrained networks.')
 
-    networks = (load_trained_net(net_path, nasbench, device=device) for net_path in net_paths)
+    networks = load_trained_nets(net_paths, nasbench, device=device, n_workers=n_load_workers,
+                                 prefetch_depth=prefetch_depth, use_processes=load_in_processes)
+
+    encoding = get_encoding(output_dtype=output_dtype, image_dtype=image_dtype)
+
+    if shard_size is not None:
+        writer = ShardWriter(save_path, shard_size=shard_size, encoding=encoding)
+        return create_io_dataset(networks, dataset, device=device, use_test_data=use_test_data, writer=writer,
+                                 **kwargs)
 
     data = create_io_dataset(networks, dataset, device=device, use_test_data=use_test_data, **kwargs)
-    torch.save(data, save_path)
+    data = encode_io_dataset(data, encoding)
+
+    if columnar:
+        save_columnar_io_dataset(data, save_path, compression=compression)
+    else:
+        torch.save(data, save_path)
 
     return data
 
 
+def _get_progress_dir(save_path: str):
+    return f"{save_path.rstrip(os.sep)}.progress"
+
+
+def _resumable_from_pretrained(net_dir, nasbench, dataset, save_path, device=None, use_test_data=False,
+                               shard_size=None, columnar=False, progress_every=50, output_dtype=None,
+                               image_dtype=None, compression=None, **kwargs):
+    # the progress is saved as a sharded dataset - either directly to `save_path`, or to a temporary directory
+    progress_dir = save_path if shard_size is not None else _get_progress_dir(save_path)
+    shard_size = shard_size if shard_size is not None else progress_every
+
+    if is_sharded_dir(progress_dir):
+        print(f'Resuming dataset creation from {progress_dir}.')
+        # evaluate the remaining networks on the saved images
+        data = append_to_io_dataset(progress_dir, net_dir, nasbench, device=device, shard_size=shard_size, **kwargs)
+    else:
+        data = dataset_from_pretrained(net_dir, nasbench, dataset, progress_dir, device=device,
+                                       use_test_data=use_test_data, shard_size=shard_size,
+                                       output_dtype=output_dtype, image_dtype=image_dtype, **kwargs)
+
+    if progress_dir == save_path:
+        return data
+
+    # all networks were processed, save the final dataset and remove the progress
+    data = merge_shards(data)
+    if columnar:
+        save_columnar_io_dataset(data, save_path, compression=compression)
+    else:
+        torch.save(data, save_path)
+
+    shutil.rmtree(progress_dir)
+    return data
+
+
+def append_to_io_dataset(dataset_path: str, net_dir: Union[str, List[str]], nasbench, save_path: str = None,
+                         device=None, batch_size=128, n_load_workers=0, prefetch_depth=4, load_in_processes=False,
+                         shard_size=100, **kwargs):
+    """
+    Add pretrained networks that are not yet in an existing IO dataset. Only the new networks are evaluated, the
+    inputs are the images stored in the dataset, so the reference indices stay valid. The network hashes are read
+    from the checkpoint names ({net_hash}.tar).
+
+    Args:
+        dataset_path: Path to the existing IO dataset (.pt, columnar or sharded directory).
+        net_dir: Either a list of directories, or one directory, where the .tar network checkpoints are loaded from.
+        nasbench: An instance of nasbench.api.NASBench(nb_path).
+        save_path: Path to save the merged dataset to, if None, `dataset_path` is overwritten. Sharded datasets are
+            always extended in place.
+
+        device: The device for the neural networks (used during prediction).
+        batch_size: Batch size for the prediction.
+        n_load_workers: If > 0, load the checkpoints in a pool of `n_load_workers` (see `dataset_from_pretrained`).
+        prefetch_depth: Maximum number of checkpoints loaded in advance.
+        load_in_processes: If True, use a process pool for loading instead of a thread pool.
+        shard_size: Number of networks per new shard (used only for sharded datasets).
+        **kwargs: Additional kwargs for the `create_io_dataset` function, `nth_input` and `nth_output` must be the
+            same as when the dataset was created.
+
+    Returns: The merged IO dataset (with the same storage encoding as the existing dataset).
+
+    """
+    data = load_io_dataset(dataset_path, decode=False)
+    encoding = data.get('encoding')
+    net_paths = _get_net_paths(net_dir)
+
+    new_paths = [p for p in net_paths if _get_path_hash(p) not in data['net_repo']]
+    print(f'Appending {len(new_paths)} new pretrained networks to the dataset '
+          f'({len(net_paths) - len(new_paths)} already processed).')
+
+    if not len(new_paths):
+        return data
+
+    # the new outputs are reduced by the saved (fitted) reducers
+    if data.get('output_reducers') is not None:
+        kwargs['output_reducer'] = data['output_reducers']
+
+    # batches of the reference images
+    images = decode_images(data['dataset'], encoding)
+    loaded_dataset = list(zip(torch.split(images, batch_size), torch.split(data['labels'], batch_size)))
+    networks = load_trained_nets(new_paths, nasbench, device=device, n_workers=n_load_workers,
+                                 prefetch_depth=prefetch_depth, use_processes=load_in_processes)
+
+    if is_sharded(data):
+        writer = ShardWriter(dataset_path, shard_size=shard_size, append=True)
+        return create_io_dataset(networks, None, device=device, loaded_dataset=loaded_dataset, writer=writer,
+                                 **kwargs)
+
+    new_data = create_io_dataset(networks, None, device=device, loaded_dataset=loaded_dataset, **kwargs)
+    data = merge_io_datasets(data, encode_io_dataset(new_data, encoding))
+
+    save_path = dataset_path if save_path is None else save_path
+    if os.path.isdir(dataset_path):
+        # keep the column compression
+        columns = load_columnar_io_dataset(dataset_path).columns
+        compression = {key: column.get('compression') for key, column in columns.items()}
+        _save_replace(data, save_path, columnar=True, compression=compression)
+    else:
+        _save_replace(data, save_path)
+
+    return data
+
+
+def merge_io_datasets(data, new_data):
+    """
+    Merge two IO datasets that were created using the same input images. The images and labels of `data` are used.
+    Both datasets must have the same storage encoding.
+
+    Args:
+        data: The first IO dataset.
+        new_data: The IO dataset to add.
+
+    Returns: The merged IO dataset.
+
+    """
+    assert data['use_reference'] == new_data['use_reference'], "Cannot merge datasets with different input types."
+    assert data.get('encoding') == new_data.get('encoding'), "Cannot merge datasets with different encodings."
+
+    output_columns = get_output_columns(data)
+    assert output_columns == get_output_columns(new_data), "The datasets have different output layers."
+    for col in output_columns:
+        assert data[col].shape[1:] == new_data[col].shape[1:], "The output shapes differ."
+
+    merged = {
+        'net_hashes': np.concatenate([data['net_hashes'], new_data['net_hashes']]),
+        'inputs': torch.cat([data['inputs'], new_data['inputs']]),
+        'dataset': data['dataset'],
+        'labels': data['labels'],
+        'use_reference': data['use_reference'],
+        'net_repo': {**data['net_repo'], **new_data['net_repo']},
+        'encoding': data.get('encoding'),
+        'output_layers': get_output_layers(new_data),
+        'n_output_points': new_data.get('n_output_points')
+    }
+
+    if data.get('output_reducers') is not None:
+        merged['output_reducers'] = data['output_reducers']
+
+    for col in output_columns:
+        merged[col] = torch.cat([data[col], new_data[col]])
+
+    return merged
+
+
+def _save_replace(data, save_path, columnar=False, compression=None):
+    # the old files may still be memory-mapped, write to a new path first
+    tmp_path = f"{save_path.rstrip(os.sep)}.tmp"
+
+    if columnar:
+        save_columnar_io_dataset(data, tmp_path, compression=compression)
+        if os.path.exists(save_path):
+            shutil.rmtree(save_path)
+    else:
+        torch.save(data, tmp_path)
+
+    os.replace(tmp_path, save_path)
+
+
 def create_io_dataset(networks, dataset, nth_input=0, nth_output=-2, loss=None, device=None, print_frequency=20,
-                      use_test_data=False, test_subset_size=20, seed=1):
+                      use_test_data=False, test_subset_size=20, seed=1, outputs_only=False, truncate=False,
+                      writer=None, loaded_dataset=None, group_size=1, n_threads=1, intra_op_threads=None,
+                      output_reducer=None, reducer_fit_networks=1):
     """
     Create the IO dataset with the following format (N is the size of the dataset, M is the number of trained
     networks, I is the number of images):
@@ -79,152 +323,399 @@ def create_io_dataset(networks, dataset, nth_input=0, nth_output=-2, loss=None,
         'labels': a vector of labels (length N),
         'use_reference': if True, the 'inputs' contain indices of images from 'dataset',
         'net_repo': a dict with net hash keys (M unique), where network specific data like weights or biases (of the
-            last dense layer) are stored
+            last dense layer) are stored,
+        'output_layers': list of the captured output layers (`nth_output`, negative indices are converted to
+            non-negative ones),
+        'n_output_points': number of the output capture points of the networks,
+        'output_reducers': parameters of the output reducers per layer (if `output_reducer` is not None)
     }
 
+    If `nth_output` is a list, the outputs of the other layers are saved in the columns 'outputs_1', 'outputs_2' etc.
+    (see `info_nas.datasets.io.output_layers.get_output_key`).
+
     Args:
-        networks: An iterable of trained networks for prediction. Must have the function
-            get_cell_outputs(inputs, return_inputs=True) that returns a list of inputs and corresponding outputs -
-            the inputs to a (hidden) layer of the network and corresponding outputs.
+        networks: An iterable of trained networks for prediction. The inputs and outputs of (hidden) layers are
+            captured during the forward pass, the indexing is the same as in
+            get_cell_outputs(inputs, return_inputs=True) (see `info_nas.datasets.io.capture.get_capture_points`).
 
         dataset: The dataset for creation of the IO data.
         nth_input: The index of the returned input data in the input list.
-        nth_output: The index of the returned output data in the input list.
+        nth_output: The index of the returned output data in the input list, or a list of indices - all layers are
+            captured in the same forward pass.
+
         loss: The loss to use for evaluation of predictions (default nn.CrossEntropyLoss)
         device: The device for prediction.
         print_frequency: Prints the number of processed networks every `print_frequency`.
         use_test_data: If True, use test data for prediction, if False, validation.
         test_subset_size: Use a random sample of the test set if it is too big (in batches)
+        seed: Seed for the test subset sampling.
+        outputs_only: If True, skip the loss and accuracy evaluation of the networks.
+        truncate: If True, skip the layers after `nth_input` and `nth_output` (and the classifier, if the logits are
+            not needed). Can be used only if `outputs_only` is True.
 
-    Returns: The created IO dataset.
+        writer: If not None, the data of every network is passed to the writer (e.g.
+            `info_nas.datasets.io.sharded.ShardWriter`) instead of being collected in memory.
+
+        loaded_dataset: Preloaded batches (inputs, targets) to use instead of `dataset`.
+        group_size: Number of networks that are evaluated together - every input batch is passed through all networks
+            of the group before moving to the next batch.
+
+        n_threads: Number of threads that evaluate the networks of a group concurrently.
+        intra_op_threads: Number of torch intra-op threads during the extraction. The setting is process-wide (see
+            `torch.set_num_threads`), so the intra-op pool is shared by all evaluation threads. If None, the current
+            setting is used.
+
+        output_reducer: If not None, the outputs are reduced on the device before they are saved - spatial pooling,
+            random projection or PCA (see `info_nas.datasets.io.reducers.get_reducer` for the parameters).
+
+        reducer_fit_networks: Number of networks used to fit the reducers that need fitting (PCA).
+
+    Returns: The created IO dataset (or the dataset returned by `writer.close`).
 
     """
 
-    _, _, valid_loader, validation_size, test_loader, test_size = dataset
-    # test dataset
-    if use_test_data:
+    if loaded_dataset is not None:
+        # preloaded data, count the number of images during the prediction
+        validation_size = None
+    elif use_test_data:
+        _, _, valid_loader, validation_size, test_loader, test_size = dataset
+        # test dataset
         validation_size = None
         rng = np.random.RandomState(seed) if seed is not None else np.random
         test_inds = rng.choice(np.arange(len(test_loader)), size=test_subset_size, replace=False)
 
-        loaded_dataset = [b for i, b in enumerate(test_loader) if i in test_inds]
+        loaded_dataset = [b for b in _get_batch_subset(test_loader, test_inds)]
     else:
+        _, _, valid_loader, validation_size, test_loader, test_size = dataset
         loaded_dataset = [b for b in valid_loader]
 
+    output_layers = nth_output if isinstance(nth_output, list) else [nth_output]
+
+    # save the layers as non-negative indices, the number of capture points is the same for all networks
+    networks, n_output_points = _get_n_output_points(networks)
+    if n_output_points is not None:
+        output_layers = normalize_output_layers(output_layers, n_output_points)
+
+    reducers = get_layer_reducers(output_reducer, len(output_layers))
+    if reducers is not None and any(r.needs_fit for r in reducers):
+        # fit on the first networks, they are evaluated again in the main loop
+        fit_networks = list(islice(networks, reducer_fit_networks))
+        networks = chain(fit_networks, networks)
+
+        print(f"Fitting the output reducers on {len(fit_networks)} networks.")
+        _fit_reducers(reducers, [network for _, network, _ in fit_networks], loaded_dataset, output_layers,
+                      device=device)
+
+    reducer_params = [r.get_params() for r in reducers] if reducers is not None else None
+
+    if writer is not None:
+        writer.open(*_concat_loaded_dataset(loaded_dataset), output_layers=output_layers,
+                    output_reducers=reducer_params, n_output_points=n_output_points)
+
     net_repo = {}
 
     net_hashes = []
     in_list = []
-    out_list = []
+    out_lists = [[] for _ in output_layers]
 
-    # get the io info per network
-    for i, (net_hash, network, _) in enumerate(networks):
-        if (i % print_frequency) == 0:
-            print(f"Processing network {i}: {net_hash}")
+    main_threads = torch.get_num_threads()
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
 
-        net_res = _get_net_outputs(network, loaded_dataset, nth_input, nth_output, loss=loss, num_data=validation_size,
-                                   device=device)
-        in_data, out_data = net_res["in_data"], net_res["out_data"]
-        assert in_data.shape[0] == out_data.shape[0]
+    pool = _get_inference_pool(n_threads)
+    start_time = time.time()
+    n_processed = 0
 
-        for _ in range(in_data.shape[0]):
-            net_hashes.append(net_hash)
+    # the thread count is global for the process, it is restored even if the evaluation fails
+    try:
+        # get the io info per network, evaluate `group_size` networks at once
+        for group in _iter_groups(networks, group_size):
+            group_res = _get_group_outputs([network for _, network, _ in group], loaded_dataset, nth_input,
+                                           nth_output, loss=loss, num_data=validation_size, device=device,
+                                           outputs_only=outputs_only, truncate=truncate, pool=pool, reducers=reducers)
 
-        in_list.append(in_data)
-        out_list.append(out_data)
+            for (net_hash, network, _), net_res in zip(group, group_res):
+                if (n_processed % print_frequency) == 0:
+                    print(f"Processing network {n_processed}: {net_hash}")
+                n_processed += 1
 
-        out_weight = network.classifier.weight
-        out_bias = network.classifier.bias
+                in_data, out_data = net_res["in_data"], net_res["out_data"]
+                out_data = out_data if isinstance(out_data, list) else [out_data]
+                assert all(in_data.shape[0] == out.shape[0] for out in out_data)
 
-        net_repo[net_hash] = {
-            'weights': out_weight.detach().cpu(),
-            'bias': out_bias.detach().cpu()
-        }
+                out_weight = network.classifier.weight
+                out_bias = network.classifier.bias
 
-    return _process_output_data(net_hashes, in_list, out_list, loaded_dataset, net_repo)
+                net_entry = {
+                    'weights': out_weight.detach().cpu(),
+                    'bias': out_bias.detach().cpu()
+                }
 
+                if writer is not None:
+                    writer.add(net_hash, in_data, out_data, net_entry)
+                    continue
 
-def _process_output_data(net_hashes, in_list, out_list, loaded_dataset, net_repo):
-    net_hashes = np.array(net_hashes)
-    in_list = torch.cat(in_list)
-    out_list = torch.cat(out_list)
+                for _ in range(in_data.shape[0]):
+                    net_hashes.append(net_hash)
+
+                in_list.append(in_data)
+                for out_list, out in zip(out_lists, out_data):
+                    out_list.append(out)
+
+                net_repo[net_hash] = net_entry
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+        torch.set_num_threads(main_threads)
+
+    elapsed = time.time() - start_time
+    if n_processed > 0 and elapsed > 0:
+        print(f"Processed {n_processed} networks ({n_processed / elapsed * 3600:.1f} networks per hour).")
+
+    if writer is not None:
+        return writer.close()
+
+    data = _process_output_data(net_hashes, in_list, out_lists, loaded_dataset, net_repo, output_layers)
+    data['n_output_points'] = n_output_points
+    if reducer_params is not None:
+        data['output_reducers'] = reducer_params
+
+    return data
+
+
+def _fit_reducers(reducers, networks, data_loader, output_layers, device=None):
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    for net in networks:
+        if not any(reducer.needs_fit for reducer in reducers):
+            break
+
+        net = net.to(device)
+        net.eval()
+
+        # only the outputs are needed, skip the rest of the network
+        with torch.no_grad(), IOCapture(net, nth_output=output_layers) as capture:
+            for inputs, _ in data_loader:
+                capture.forward(inputs.to(device), truncate=True)
+
+                for reducer, out in zip(reducers, capture.outputs):
+                    if reducer.needs_fit:
+                        reducer.partial_fit(out)
+
+                # e.g. random projections are fitted on the first batch
+                if not any(reducer.needs_fit for reducer in reducers):
+                    break
+
+    for reducer in reducers:
+        reducer.finish_fit()
+
+
+def _get_batch_subset(data_loader: DataLoader, batch_inds):
+    """
+    Get a loader that returns only the batches `batch_inds` of `data_loader` (in the original order). If the loader
+    is sequential, only the images of the selected batches are loaded.
 
+    Args:
+        data_loader: The original data loader.
+        batch_inds: Indices of the batches to keep.
+
+    Returns: An iterable of the selected batches.
+
+    """
+    batch_inds = sorted(batch_inds)
+
+    if not isinstance(data_loader.sampler, SequentialSampler) or data_loader.drop_last:
+        # the batch contents are known only after sampling
+        batch_inds = set(batch_inds)
+        return (b for i, b in enumerate(data_loader) if i in batch_inds)
+
+    # indices of the images in the selected batches
+    batch_size = data_loader.batch_size
+    n_data = len(data_loader.dataset)
+    image_inds = [j for i in batch_inds for j in range(i * batch_size, min((i + 1) * batch_size, n_data))]
+
+    # the selected batches are full except for the last batch of the dataset, which is also last in the subset
+    return DataLoader(Subset(data_loader.dataset, image_inds), batch_size=batch_size, shuffle=False,
+                      num_workers=data_loader.num_workers, collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory, worker_init_fn=data_loader.worker_init_fn)
+
+
+def _concat_loaded_dataset(loaded_dataset):
     # concat batched dataset
     loaded_inputs, loaded_targets = [], []
     for i, t in loaded_dataset:
         loaded_inputs.append(i)
         loaded_targets.append(t)
 
-    loaded_inputs = torch.cat(loaded_inputs)
-    loaded_targets = torch.cat(loaded_targets)
+    return torch.cat(loaded_inputs), torch.cat(loaded_targets)
 
-    assert len(net_hashes) == len(in_list) and len(net_hashes) == len(out_list)
+
+def _process_output_data(net_hashes, in_list, out_lists, loaded_dataset, net_repo, output_layers):
+    net_hashes = np.array(net_hashes)
+    in_list = torch.cat(in_list)
+    out_lists = [torch.cat(out_list) for out_list in out_lists]
+
+    loaded_inputs, loaded_targets = _concat_loaded_dataset(loaded_dataset)
+
+    assert len(net_hashes) == len(in_list) and all(len(net_hashes) == len(out_list) for out_list in out_lists)
 
     use_reference = len(in_list.shape) == 1
 
     # io dataset with hashes, original dataset and network info for reference
-    data = {'net_hashes': net_hashes, 'inputs': in_list, 'outputs': out_list, 'dataset': loaded_inputs,
-            'labels': loaded_targets, 'use_reference': use_reference, 'net_repo': net_repo}
+    data = {'net_hashes': net_hashes, 'inputs': in_list, 'dataset': loaded_inputs, 'labels': loaded_targets,
+            'use_reference': use_reference, 'net_repo': net_repo, 'output_layers': output_layers}
+
+    # one column per captured layer
+    for i, out_list in enumerate(out_lists):
+        data[get_output_column(i)] = out_list
 
     return data
 
 
-def _get_net_outputs(net: NBNetwork, data_loader, nth_input, nth_output, loss=None, num_data=None, device=None):
+def _get_n_output_points(networks):
+    # peek at the first network, the networks are returned unchanged
+    networks = iter(networks)
+    first = next(networks, None)
+    if first is None:
+        return networks, None
+
+    return chain([first], networks), len(get_capture_points(first[1])[1])
+
+
+def _iter_groups(networks, group_size):
+    group = []
+    for net_info in networks:
+        group.append(net_info)
+        if len(group) == group_size:
+            yield group
+            group = []
+
+    if len(group):
+        yield group
+
+
+def _get_inference_pool(n_threads):
+    if n_threads <= 1:
+        return None
+
+    # the threads share the intra-op thread pool of the process
+    return ThreadPoolExecutor(n_threads)
+
+
+def _get_net_outputs(net: NBNetwork, data_loader, nth_input, nth_output, loss=None, num_data=None, device=None,
+                     outputs_only=False, truncate=False):
+    return _get_group_outputs([net], data_loader, nth_input, nth_output, loss=loss, num_data=num_data,
+                              device=device, outputs_only=outputs_only, truncate=truncate)[0]
+
+
+def _get_group_outputs(nets: List[NBNetwork], data_loader, nth_input, nth_output, loss=None, num_data=None,
+                       device=None, outputs_only=False, truncate=False, pool=None, reducers=None):
+    if truncate and not outputs_only:
+        raise ValueError("Truncated forward pass does not compute the logits, set outputs_only=True.")
+
     if device is None:
         device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-        net = net.to(device)
-
-    net.eval()
+        nets = [net.to(device) for net in nets]
 
     if loss is None:
         loss = nn.CrossEntropyLoss()
 
-    test_loss = 0
-    correct = 0
+    evals = [_NetEvaluation(net, nth_input, nth_output, loss, outputs_only=outputs_only, truncate=truncate,
+                            reducers=reducers) for net in nets]
 
     n_tests = 0
+    batch_size = None
 
-    in_data = []
-    out_data = []
+    with ExitStack() as stack:
+        for e in evals:
+            stack.enter_context(e.capture)
 
-    batch_size = None
-    with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(data_loader):
             if batch_size is None:
                 batch_size = len(inputs)
 
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
+            # the batch is moved to the device once for all networks
+            inputs = inputs.to(device)
+            if not outputs_only:
+                targets = targets.to(device)
 
-            curr_loss = loss(outputs, targets)
-            test_loss += curr_loss.detach()
-            _, predict = torch.max(outputs.data, 1)
-            correct += predict.eq(targets.data).sum().detach()
+            ref_ids = torch.arange(len(inputs)) + batch_idx * batch_size
+            step = partial(_NetEvaluation.step, inputs=inputs, targets=targets, ref_ids=ref_ids)
 
-            in_list, out_list = net.get_cell_outputs(inputs, return_inputs=True)
-
-            # if first input (original image), save reference index instead
-            if nth_input != 0:
-                save_input = in_list[nth_input].to('cpu')
+            if pool is None:
+                for e in evals:
+                    step(e)
             else:
-                save_input = torch.arange(len(inputs)) + batch_idx * batch_size
-
-            in_data.append(save_input)
-            out_data.append(out_list[nth_output].to('cpu'))
+                list(pool.map(step, evals))
 
             if num_data is None:
                 n_tests += len(targets)
 
-        if num_data is None:
-            num_data = n_tests
+    if num_data is None:
+        num_data = n_tests
 
-    last_loss = test_loss / len(data_loader) if len(data_loader) > 0 else np.inf
-    acc = correct / num_data
+    return [e.result(len(data_loader), num_data) for e in evals]
 
-    return {
-        'in_data': torch.cat(in_data),
-        'out_data': torch.cat(out_data),
 
-        'loss': last_loss,
-        'accuracy': acc
-    }
+class _NetEvaluation:
+    """
+    Evaluation state of one network - captured data and prediction statistics.
+    """
+    def __init__(self, net: NBNetwork, nth_input, nth_output, loss, outputs_only=False, truncate=False,
+                 reducers=None):
+        net.eval()
+
+        self.nth_input = nth_input
+        self.loss = loss
+        self.outputs_only = outputs_only
+        self.truncate = truncate
+
+        # if first input (original image), save reference index instead
+        self.capture = IOCapture(net, nth_input=nth_input if nth_input != 0 else None, nth_output=nth_output)
+
+        self.test_loss = 0
+        self.correct = 0
+
+        self.in_data = []
+        self.out_data = [[] for _ in self.capture.output_keys]
+        self.reducers = reducers if reducers is not None else [None for _ in self.capture.output_keys]
+        self.multiple_outputs = isinstance(nth_output, list)
+
+    def step(self, inputs, targets, ref_ids):
+        # grad mode is thread-local
+        with torch.no_grad():
+            # the data is captured in the same pass that computes the logits
+            outputs = self.capture.forward(inputs, truncate=self.truncate)
+
+            if not self.outputs_only:
+                curr_loss = self.loss(outputs, targets)
+                self.test_loss += curr_loss.detach()
+                _, predict = torch.max(outputs.data, 1)
+                self.correct += predict.eq(targets.data).sum().detach()
+
+            save_input = self.capture.input.to('cpu') if self.nth_input != 0 else ref_ids
+
+            self.in_data.append(save_input)
+            for out_data, out, reducer in zip(self.out_data, self.capture.outputs, self.reducers):
+                # reduce on the device before the data is moved to cpu
+                out = reducer(out) if reducer is not None else out
+                out_data.append(out.to('cpu'))
+
+    def result(self, n_batches, num_data):
+        if self.outputs_only:
+            last_loss, acc = None, None
+        else:
+            last_loss = self.test_loss / n_batches if n_batches > 0 else np.inf
+            acc = self.correct / num_data
+
+        out_data = [torch.cat(out) for out in self.out_data]
+
+        return {
+            'in_data': torch.cat(self.in_data),
+            'out_data': out_data if self.multiple_outputs else out_data[0],
+
+            'loss': last_loss,
+            'accuracy': acc
+        }
@@ -0,0 +1,192 @@
+import torch
+
+from info_nas.datasets.io.columnar import LazyIODataset
+from info_nas.datasets.io.output_layers import get_output_columns
+
+
+# normalization of the CIFAR-10 images (nasbench_pytorch.datasets.cifar10)
+CIFAR_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR_STD = (0.2023, 0.1994, 0.2010)
+
+OUTPUT_DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16}
+IMAGE_DTYPES = ['uint8']
+
+
+def get_encoding(output_dtype=None, image_dtype=None, mean=CIFAR_MEAN, std=CIFAR_STD):
+    """
+    Create the storage encoding of an IO dataset.
+
+    Args:
+        output_dtype: If not None, the outputs are stored in reduced precision ('float16' or 'bfloat16').
+        image_dtype: If 'uint8', the reference images are stored as pixel values (0 - 255), the normalization is
+            applied on load.
+
+        mean: Channel means of the image normalization.
+        std: Channel standard deviations of the image normalization.
+
+    Returns: The encoding (dict), or None if no encoding is used.
+
+    """
+    if output_dtype is None and image_dtype is None:
+        return None
+
+    if output_dtype is not None and output_dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"Invalid output dtype: {output_dtype}, possible values are {list(OUTPUT_DTYPES.keys())}.")
+
+    if image_dtype is not None and image_dtype not in IMAGE_DTYPES:
+        raise ValueError(f"Invalid image dtype: {image_dtype}, possible values are {IMAGE_DTYPES}.")
+
+    encoding = {'outputs': output_dtype, 'dataset': None}
+    if image_dtype is not None:
+        encoding['dataset'] = {'dtype': image_dtype, 'mean': list(mean), 'std': list(std)}
+
+    return encoding
+
+
+def is_encoded(io_dataset):
+    """
+    Check if the IO dataset is stored in an encoded format (see `get_encoding`).
+    """
+    return io_dataset.get('encoding') is not None
+
+
+def _get_norm(images, encoding):
+    mean = torch.tensor(encoding['dataset']['mean'], device=images.device).view(-1, 1, 1)
+    std = torch.tensor(encoding['dataset']['std'], device=images.device).view(-1, 1, 1)
+    return mean, std
+
+
+def encode_outputs(outputs, encoding):
+    if encoding is None or encoding['outputs'] is None:
+        return outputs
+
+    return outputs.to(OUTPUT_DTYPES[encoding['outputs']])
+
+
+def decode_outputs(outputs, encoding):
+    if encoding is None or encoding['outputs'] is None:
+        return outputs
+
+    return outputs.float()
+
+
+def encode_images(images, encoding):
+    if encoding is None or encoding['dataset'] is None:
+        return images
+
+    # invert the normalization, the images were created from uint8 pixel values
+    mean, std = _get_norm(images, encoding)
+    pixels = (images * std + mean) * 255
+    return pixels.round().clamp(0, 255).to(torch.uint8)
+
+
+def decode_images(images, encoding):
+    if encoding is None or encoding['dataset'] is None:
+        return images
+
+    mean, std = _get_norm(images, encoding)
+    return (images.float() / 255 - mean) / std
+
+
+def encode_io_dataset(io_dataset, encoding):
+    """
+    Encode the outputs and the reference images of an IO dataset for storage.
+
+    Args:
+        io_dataset: The IO dataset (see `info_nas.datasets.io.create_dataset.create_io_dataset` for the format).
+        encoding: The encoding (see `get_encoding`).
+
+    Returns: The encoded dataset, the encoding is saved under the key 'encoding'.
+
+    """
+    assert not is_encoded(io_dataset), "The dataset is already encoded."
+
+    if encoding is None:
+        return io_dataset
+
+    column_fns = {col: lambda v: encode_outputs(v, encoding) for col in get_output_columns(io_dataset)}
+    column_fns['dataset'] = lambda v: encode_images(v, encoding)
+
+    data = _map_columns(io_dataset, column_fns)
+    data['encoding'] = encoding
+    return data
+
+
+def decode_io_dataset(io_dataset):
+    """
+    Decode an encoded IO dataset (see `encode_io_dataset`) to the original float format.
+
+    Args:
+        io_dataset: The encoded dataset.
+
+    Returns: The decoded dataset.
+
+    """
+    if not is_encoded(io_dataset):
+        return io_dataset
+
+    encoding = io_dataset['encoding']
+
+    column_fns = {'dataset': lambda v: decode_images(v, encoding)}
+
+    # sharded datasets have no output columns, the outputs are decoded when the shards are read
+    is_sharded = 'outputs' not in io_dataset
+    if not is_sharded:
+        column_fns.update({col: lambda v: decode_outputs(v, encoding) for col in get_output_columns(io_dataset)})
+
+    data = _map_columns(io_dataset, column_fns)
+    data['encoding'] = {**encoding, 'dataset': None} if is_sharded else None
+    return data
+
+
+def _map_columns(io_dataset, column_fns):
+    # lazily loaded columns are converted on access, so that they are not all loaded at once
+    if isinstance(io_dataset, LazyIODataset):
+        data = io_dataset.copy()
+        for col, fn in column_fns.items():
+            data.map_column(col, fn)
+
+        return data
+
+    data = dict(io_dataset)
+    for col, fn in column_fns.items():
+        data[col] = fn(data[col])
+
+    return data
+
+
+def _get_error_stats(orig, decoded):
+    orig, decoded = orig.float(), decoded.float()
+    abs_error = (orig - decoded).abs()
+
+    return {
+        'max_abs_error': abs_error.max().item(),
+        'mean_abs_error': abs_error.mean().item(),
+        'rel_error': (abs_error.norm() / orig.norm()).item() if orig.norm() > 0 else 0.0
+    }
+
+
+def get_encoding_error(io_dataset, encoded_dataset):
+    """
+    Compute the round-trip error of the encoding - compare the original data with the decoded data.
+
+    Args:
+        io_dataset: The original IO dataset.
+        encoded_dataset: The encoded dataset (see `encode_io_dataset`).
+
+    Returns: A dict {column: error statistics (max and mean absolute error, relative error in the Frobenius norm)}.
+
+    """
+    encoding = encoded_dataset['encoding']
+    report = {}
+
+    if encoding['outputs'] is not None:
+        for col in get_output_columns(io_dataset):
+            decoded = decode_outputs(encoded_dataset[col], encoding)
+            report[col] = _get_error_stats(io_dataset[col], decoded)
+
+    if encoding['dataset'] is not None:
+        decoded = decode_images(encoded_dataset['dataset'], encoding)
+        report['dataset'] = _get_error_stats(io_dataset['dataset'], decoded)
+
+    return report
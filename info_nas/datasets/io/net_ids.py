@@ -0,0 +1,173 @@
+import copy
+
+import numpy as np
+import torch
+
+
+NET_KEYS = ['adj', 'ops', 'weights', 'bias']
+
+
+def is_stacked_repo(net_repo):
+    """
+    Check if the network repository is stacked (see `stack_net_repo`).
+    """
+    return 'net_hashes' in net_repo and isinstance(net_repo['net_hashes'], np.ndarray)
+
+
+def stack_net_repo(net_repo, net_hashes=None):
+    """
+    Stack a network repository (a dict {net hash: {'adj': ..., 'ops': ..., 'weights': ..., 'bias': ...}}) to tensors
+    indexed by integer network ids. The network id is the position of the hash in the sorted hash table.
+
+    The stacked repository has the following format:
+    {
+        'net_hashes': sorted numpy array of the network hashes (the id -> hash table),
+        'adj', 'ops', 'weights', 'bias': tensors with the network data, the first dimension is the network id
+    }
+
+    Args:
+        net_repo: The network repository, returned as is if it is already stacked.
+        net_hashes: Hashes of networks to include, by default all networks of the repository.
+
+    Returns: The stacked repository.
+
+    """
+    if is_stacked_repo(net_repo):
+        return net_repo
+
+    net_hashes = np.unique(np.asarray(list(net_repo.keys()) if net_hashes is None else net_hashes, dtype=str))
+    entries = [net_repo[h] for h in net_hashes]
+
+    # adj and ops are added to the repository later (see `info_nas.datasets.arch2vec_dataset`)
+    stacked = {'net_hashes': net_hashes}
+    for key in NET_KEYS:
+        if len(entries) and key in entries[0]:
+            stacked[key] = torch.stack([torch.as_tensor(e[key]) for e in entries])
+
+    return stacked
+
+
+def merge_net_repos(*net_repos):
+    """
+    Merge network repositories to one stacked repository (see `stack_net_repo`). Datasets that share transforms with
+    per-network tables (e.g. `info_nas.datasets.io.transforms.Scaler`) must use the same network ids.
+
+    Args:
+        *net_repos: Network repositories (None is skipped).
+
+    Returns: The stacked repository with all networks.
+
+    """
+    merged = {}
+    for net_repo in net_repos:
+        if net_repo is None:
+            continue
+
+        if is_stacked_repo(net_repo):
+            net_repo = {h: {key: net_repo[key][i] for key in NET_KEYS if key in net_repo}
+                        for i, h in enumerate(net_repo['net_hashes'])}
+
+        merged.update(net_repo)
+
+    return stack_net_repo(merged)
+
+
+def encode_net_hashes(hashes, net_hashes):
+    """
+    Encode network hashes to int32 network ids.
+
+    Args:
+        hashes: Hashes to encode.
+        net_hashes: The hash table of a stacked repository (see `stack_net_repo`).
+
+    Returns: Numpy array of network ids.
+
+    """
+    hashes = np.asarray(hashes, dtype=str)
+    if not len(hashes):
+        return np.zeros(0, dtype=np.int32)
+
+    net_ids = np.searchsorted(net_hashes, hashes)
+    found = (net_ids < len(net_hashes)) & (net_hashes[np.minimum(net_ids, len(net_hashes) - 1)] == hashes)
+    if not np.all(found):
+        raise ValueError(f"Networks missing in the network repository: {np.unique(hashes[~found])[:10]}.")
+
+    return net_ids.astype(np.int32)
+
+
+def decode_net_ids(net_ids, net_hashes):
+    """
+    Get the hashes of network ids (e.g. for reporting).
+
+    Args:
+        net_ids: Network ids (tensor, array or int).
+        net_hashes: The hash table of a stacked repository (see `stack_net_repo`).
+
+    Returns: A list of hashes, or a single hash for a single id.
+
+    """
+    if torch.is_tensor(net_ids):
+        net_ids = net_ids.cpu().numpy()
+
+    hashes = net_hashes[net_ids]
+    return hashes.tolist() if isinstance(hashes, np.ndarray) else str(hashes)
+
+
+def bind_transforms(transform, net_repo):
+    """
+    Bind transforms that keep per-network tables (they have the method `bind_net_repo`) to the network ids of a
+    stacked repository. Composed transforms are bound recursively.
+
+    A transform that is already bound to different network ids (e.g. it is shared by datasets with different network
+    repositories) is copied and the copy is bound instead, so that the other datasets keep their tables.
+
+    Args:
+        transform: A transform or a composed transform (e.g. torchvision `Compose`).
+        net_repo: The stacked repository of the dataset.
+
+    Returns: The bound transform.
+
+    """
+    if transform is None:
+        return None
+
+    if hasattr(transform, 'transforms'):
+        bound = [bind_transforms(t, net_repo) for t in transform.transforms]
+        if all(b is t for b, t in zip(bound, transform.transforms)):
+            return transform
+
+        transform = copy.copy(transform)
+        transform.transforms = bound
+        return transform
+
+    if not hasattr(transform, 'bind_net_repo'):
+        return transform
+
+    bound_hashes = getattr(transform, '_net_hashes', None)
+    if bound_hashes is not None and not _is_same_table(bound_hashes, net_repo['net_hashes']):
+        transform = copy.copy(transform)
+        transform.unbind()
+
+    transform.bind_net_repo(net_repo)
+    return transform
+
+
+def _is_same_table(bound_hashes, net_hashes):
+    return bound_hashes is net_hashes or np.array_equal(bound_hashes, net_hashes)
+
+
+def is_bound_to(bound_hashes, net_hashes):
+    """
+    Check if a transform bound to the hash table `bound_hashes` can be (re)bound to `net_hashes`.
+
+    Returns: True if it is already bound to the same network ids, False if it is not bound yet.
+
+    """
+    if bound_hashes is None:
+        return False
+
+    if _is_same_table(bound_hashes, net_hashes):
+        return True
+
+    raise ValueError("The transform is already bound to different network ids, bind a copy of the transform (see "
+                     "`bind_transforms`) or use one network repository (see `merge_net_repos`).")
@@ -0,0 +1,93 @@
+def get_output_column(i):
+    """
+    Get the name of the column with the outputs of the i-th captured layer (the first layer is stored in 'outputs').
+    """
+    return 'outputs' if i == 0 else f'outputs_{i}'
+
+
+def normalize_output_layers(nth_output, n_points):
+    """
+    Convert negative output layer indices to non-negative ones, so that equivalent indices (e.g. -2 and
+    n_points - 2) refer to the same layer.
+
+    Args:
+        nth_output: Index of the captured layer, or a list of indices.
+        n_points: Number of the output capture points of the networks (see
+            `info_nas.datasets.io.capture.get_capture_points`).
+
+    Returns: The non-negative index, or a list of indices.
+
+    """
+    if isinstance(nth_output, list):
+        return [normalize_output_layers(nth, n_points) for nth in nth_output]
+
+    if not -n_points <= nth_output < n_points:
+        raise ValueError(f"Invalid output layer index: {nth_output}, the networks have {n_points} output points.")
+
+    return nth_output % n_points
+
+
+def get_output_layers(io_dataset):
+    """
+    Get the indices of the captured output layers (see `info_nas.datasets.io.capture.get_capture_points`), or None if
+    they were not saved with the dataset. The indices are non-negative if the dataset contains the number of capture
+    points ('n_output_points').
+    """
+    return io_dataset.get('output_layers')
+
+
+def get_output_columns(io_dataset):
+    """
+    Get the names of all output columns of the IO dataset.
+    """
+    layers = get_output_layers(io_dataset)
+    n_layers = len(layers) if layers is not None else 1
+
+    return [get_output_column(i) for i in range(n_layers)]
+
+
+def get_output_key(io_dataset, nth_output=None):
+    """
+    Get the name of the column with the outputs of the layer `nth_output`.
+
+    Args:
+        io_dataset: The IO dataset.
+        nth_output: Index of the captured layer (the same as in `create_io_dataset`), if None, the first captured
+            layer is used.
+
+    Returns: Name of the output column.
+
+    """
+    if nth_output is None:
+        return 'outputs'
+
+    layers = get_output_layers(io_dataset)
+
+    # datasets created before the number of capture points was saved are matched by the original indices
+    n_points = io_dataset.get('n_output_points')
+    if layers is not None and n_points is not None:
+        layers = normalize_output_layers(layers, n_points)
+        nth_output = normalize_output_layers(nth_output, n_points)
+
+    if layers is None or nth_output not in layers:
+        raise ValueError(f"The output layer {nth_output} was not captured, available layers: {layers}.")
+
+    return get_output_column(layers.index(nth_output))
+
+
+def select_output_layer(io_dataset, nth_output=None):
+    """
+    Get a view of the IO dataset where 'outputs' are the outputs of the layer `nth_output`.
+
+    Args:
+        io_dataset: The IO dataset.
+        nth_output: Index of the captured layer, if None, the dataset is returned unchanged.
+
+    Returns: The IO dataset with the selected outputs.
+
+    """
+    key = get_output_key(io_dataset, nth_output)
+    if key == 'outputs':
+        return io_dataset
+
+    return {**io_dataset, 'outputs': io_dataset[key]}
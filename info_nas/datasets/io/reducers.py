@@ -0,0 +1,318 @@
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+class OutputReducer:
+    """
+    Reduces the captured outputs of a network on the device, before they are moved to the cpu (see
+    `info_nas.datasets.io.create_dataset.create_io_dataset`). Reducers that need fitting are fitted on the outputs of
+    the first networks, the fitted parameters are saved with the dataset.
+    """
+    needs_fit = False
+    # the fit needs more than one batch (at most one such reducer per pipeline)
+    fits_incrementally = False
+
+    def __call__(self, x):
+        raise NotImplementedError()
+
+    def partial_fit(self, x):
+        pass
+
+    def finish_fit(self):
+        pass
+
+    def get_params(self):
+        raise NotImplementedError()
+
+
+class SpatialPooling(OutputReducer):
+    """
+    Pools feature maps to `output_size` x `output_size`, with output size 1, the output is a feature vector.
+    """
+    def __init__(self, output_size=1, mode='avg'):
+        if mode not in ['avg', 'max']:
+            raise ValueError(f"Invalid pooling mode: {mode}, possible values are ['avg', 'max'].")
+
+        self.output_size = output_size
+        self.mode = mode
+
+    def __call__(self, x):
+        if x.dim() != 4:
+            raise ValueError(f"Spatial pooling expects feature maps (B, C, H, W), got shape {tuple(x.shape)}.")
+
+        pool = F.adaptive_avg_pool2d if self.mode == 'avg' else F.adaptive_max_pool2d
+        x = pool(x, self.output_size)
+
+        return torch.flatten(x, 1) if self.output_size == 1 else x
+
+    def get_params(self):
+        return {'type': 'pool', 'output_size': self.output_size, 'mode': self.mode}
+
+
+class RandomProjection(OutputReducer):
+    """
+    Projects the flattened outputs to `out_dim` dimensions using a gaussian random matrix. The matrix is generated
+    from `seed`, so only the seed is saved. If `in_dim` is not known, it is fitted on the first batch.
+    """
+    def __init__(self, out_dim, seed=1, in_dim=None):
+        self.out_dim = out_dim
+        self.seed = seed
+        self.in_dim = in_dim
+
+        self._matrix = None
+        self._lock = threading.Lock()
+
+        self.needs_fit = in_dim is None
+
+    def _get_matrix(self, in_dim, device):
+        # the reducer can be shared between evaluation threads
+        with self._lock:
+            if self.in_dim is not None and self.in_dim != in_dim:
+                raise ValueError(f"The projection was created for {self.in_dim} input dimensions, got {in_dim}.")
+
+            if self._matrix is None:
+                gen = torch.Generator().manual_seed(self.seed)
+                self.in_dim = in_dim
+                self._matrix = torch.randn(in_dim, self.out_dim, generator=gen) / self.out_dim ** 0.5
+
+            if self._matrix.device != device:
+                self._matrix = self._matrix.to(device)
+
+            return self._matrix
+
+    def partial_fit(self, x):
+        self._get_matrix(torch.flatten(x, 1).shape[1], x.device)
+        self.needs_fit = False
+
+    def finish_fit(self):
+        if self.in_dim is None:
+            raise ValueError("The input dimension of the projection was not fitted, no outputs were passed to "
+                             "partial_fit.")
+
+        self.needs_fit = False
+
+    def __call__(self, x):
+        x = torch.flatten(x, 1)
+        return x @ self._get_matrix(x.shape[1], x.device)
+
+    def get_params(self):
+        return {'type': 'projection', 'out_dim': self.out_dim, 'seed': self.seed, 'in_dim': self.in_dim}
+
+
+class IncrementalPCA(OutputReducer):
+    """
+    Projects the flattened outputs on the first `n_components` principal components. The basis is fitted
+    incrementally batch by batch (the same algorithm as in sklearn.decomposition.IncrementalPCA), so only
+    `n_components` x D values are kept in memory. The first batches are buffered until there are at least
+    `n_components` rows.
+    """
+    fits_incrementally = True
+
+    def __init__(self, n_components, mean=None, components=None, singular_values=None, n_samples_seen=0):
+        self.n_components = n_components
+
+        self.mean = mean
+        self.components = components
+        self.singular_values = singular_values
+        self.n_samples_seen = n_samples_seen
+
+        self.needs_fit = components is None
+        self._buffer = []
+
+    def partial_fit(self, x):
+        x = torch.flatten(x, 1).double()
+
+        if self.components is None:
+            self._buffer.append(x)
+            if sum(b.shape[0] for b in self._buffer) < self.n_components:
+                return
+
+            x = torch.cat(self._buffer)
+            self._buffer = []
+
+        n_batch = x.shape[0]
+        batch_mean = x.mean(dim=0)
+
+        if self.components is None:
+            x_stack = x - batch_mean
+            new_mean = batch_mean
+        else:
+            n_total = self.n_samples_seen + n_batch
+            new_mean = (self.n_samples_seen * self.mean + n_batch * batch_mean) / n_total
+
+            # correction for the shift of the mean
+            mean_correction = ((self.n_samples_seen * n_batch / n_total) ** 0.5) * (self.mean - batch_mean)
+            x_stack = torch.cat([self.singular_values[:, None] * self.components, x - batch_mean,
+                                 mean_correction[None]])
+
+        _, s, v = torch.svd(x_stack)
+
+        self.mean = new_mean
+        self.components = v[:, :self.n_components].T
+        self.singular_values = s[:self.n_components]
+        self.n_samples_seen += n_batch
+
+    def finish_fit(self):
+        if self.components is None:
+            n_rows = sum(b.shape[0] for b in self._buffer)
+            raise ValueError(f"The PCA reducer needs at least {self.n_components} rows to be fitted, got {n_rows}.")
+
+        self.needs_fit = False
+
+    def __call__(self, x):
+        x = torch.flatten(x, 1)
+        mean, components = self.mean.to(x), self.components.to(x)
+
+        return (x - mean) @ components.T
+
+    def get_params(self):
+        # datasets created by older versions do not have the singular values
+        singular_values = self.singular_values.float().cpu() if self.singular_values is not None else None
+
+        return {'type': 'pca', 'n_components': self.n_components, 'mean': self.mean.float().cpu(),
+                'components': self.components.float().cpu(), 'singular_values': singular_values,
+                'n_samples_seen': self.n_samples_seen}
+
+
+reducer_dict = {
+    'pool': SpatialPooling,
+    'projection': RandomProjection,
+    'pca': IncrementalPCA
+}
+
+
+class ReducerPipeline(OutputReducer):
+    """
+    Applies reducers in sequence. At most one reducer of the pipeline can be fitted incrementally.
+    """
+    def __init__(self, reducers):
+        assert sum(r.needs_fit and r.fits_incrementally for r in reducers) <= 1, \
+            "Only one reducer of the pipeline can be fitted incrementally."
+        self.reducers = reducers
+
+        self._fit_row = None
+
+    @property
+    def needs_fit(self):
+        return any(r.needs_fit for r in self.reducers)
+
+    def __call__(self, x):
+        for r in self.reducers:
+            x = r(x)
+
+        return x
+
+    def partial_fit(self, x):
+        if self._fit_row is None:
+            self._fit_row = x[:1].clone()
+
+        for r in self.reducers:
+            if r.needs_fit:
+                r.partial_fit(x)
+
+                # the next reducers are fitted on the outputs of this one once it is fitted
+                if r.needs_fit:
+                    return
+
+            x = r(x)
+
+    def finish_fit(self):
+        # reducers after an incrementally fitted one are fitted once its fit is finished
+        x = self._fit_row
+        for r in self.reducers:
+            if r.needs_fit and not r.fits_incrementally and x is not None:
+                r.partial_fit(x)
+
+            r.finish_fit()
+            x = r(x) if x is not None else None
+
+        self._fit_row = None
+
+    def get_params(self):
+        return [r.get_params() for r in self.reducers]
+
+
+def get_reducer(params):
+    """
+    Create a reducer from its parameters (as in the config, or the fitted parameters saved in the dataset).
+
+    Args:
+        params: A dict {'type': reducer type, **reducer kwargs}, where the type is 'pool' (`SpatialPooling`),
+            'projection' (`RandomProjection`) or 'pca' (`IncrementalPCA`). A list of dicts creates a pipeline.
+
+    Returns: The reducer.
+
+    """
+    if not isinstance(params, list):
+        params = [params]
+
+    reducers = []
+    for p in params:
+        p = dict(p)
+        reducer_type = p.pop('type')
+        if reducer_type not in reducer_dict:
+            raise ValueError(f"Invalid reducer type: {reducer_type}, possible values are {list(reducer_dict.keys())}.")
+
+        reducers.append(reducer_dict[reducer_type](**p))
+
+    return ReducerPipeline(reducers)
+
+
+def get_layer_reducers(output_reducer, n_layers):
+    """
+    Create the reducers for all captured output layers.
+
+    Args:
+        output_reducer: Reducer parameters (see `get_reducer`) used for all layers, or a list of parameters per
+            layer (e.g. 'output_reducers' saved in a dataset).
+
+        n_layers: Number of the captured output layers.
+
+    Returns: A list of reducers (one per layer), or None if `output_reducer` is None.
+
+    """
+    if output_reducer is None:
+        return None
+
+    per_layer = isinstance(output_reducer, list) and len(output_reducer) and isinstance(output_reducer[0], list)
+    if per_layer:
+        assert len(output_reducer) == n_layers, "The number of reducers differs from the number of output layers."
+        return [get_reducer(params) for params in output_reducer]
+
+    # every layer has its own projection/basis
+    return [get_reducer(output_reducer) for _ in range(n_layers)]
+
+
+def get_reduced_size(io_dataset, nth_layer=0):
+    """
+    Get the size of the reduced output vectors of the IO dataset (the last dimension of the reducer), or None if the
+    outputs were not reduced to vectors.
+    """
+    output_reducers = io_dataset.get('output_reducers')
+    if output_reducers is None:
+        return None
+
+    last = output_reducers[nth_layer][-1]
+    if last['type'] == 'projection':
+        return last['out_dim']
+    if last['type'] == 'pca':
+        return last['components'].shape[0]
+
+    return None
+
+
+def get_transformed_size(io_dataset, top_k=None, nth_layer=0):
+    """
+    Get the number of output features the model is trained on - the reduced outputs with the bias included, sorted
+    and cut to the `top_k` features (see `scripts.utils.experiment_transforms`). Returns None if the outputs were not
+    reduced to vectors.
+    """
+    reduced_size = get_reduced_size(io_dataset, nth_layer=nth_layer)
+    if reduced_size is None:
+        return None
+
+    # the transforms always include the bias
+    n_features = reduced_size + 1
+    return min(top_k, n_features) if top_k is not None else n_features
@@ -1,13 +1,23 @@
 import math
+import random
 import warnings
 
+import numpy as np
 import torch
 import torch.utils.data
+from torch.utils.data._utils.collate import default_collate
+
+from info_nas.datasets.io.encoding import decode_images, decode_outputs
+from info_nas.datasets.io.net_ids import NET_KEYS, stack_net_repo, merge_net_repos, encode_net_hashes, \
+    decode_net_ids, bind_transforms
+from info_nas.datasets.io.output_layers import get_output_key
+from info_nas.datasets.io.sharded import is_sharded, get_sharded_hashes, get_sharded_len
 
 
 def get_train_valid_datasets(labeled, unlabeled, k=1, coef_k=1.0, repeat_unlabeled=1, batch_size=32, n_workers=0,
                              shuffle=True, val_batch_size=100, n_valid_workers=0, labeled_transforms=None,
-                             labeled_val_transforms=None, **kwargs):
+                             labeled_val_transforms=None, shuffle_buffer_size=10000, output_layer=None, net_repo=None,
+                             **kwargs):
     """
     Using the labeled and unlabeled dataset (loaded for example by the function
     `info_nas.datasets.arch2vec_dataset.get_labeled_unlabeled_datasets`), create the datasets:
@@ -31,25 +41,39 @@ def get_train_valid_datasets(labeled, unlabeled, k=1, coef_k=1.0, repeat_unlabel
         n_valid_workers: Data loader validation workers, half is used for labeled loader, half for unlabeled.
         labeled_transforms: The transforms to apply on the labeled train batches.
         labeled_val_transforms: The transforms to apply on the labeled validation batches.
+        shuffle_buffer_size: Size of the shuffle buffer for sharded labeled datasets.
+        output_layer: For datasets with multiple captured layers, the layer to use as the output (see
+            `info_nas.datasets.io.output_layers.get_output_key`). If None, the first captured layer is used.
+
+        net_repo: A stacked network repository shared by the labeled datasets, the batches contain ids of its
+            networks (see `info_nas.datasets.io.net_ids`). By default, it is created by `get_labeled_net_repo`.
+
         **kwargs: Additional DataLoader parameters (same for all datasets).
 
     Returns: train_dataset, valid_labeled_dataset, valid_labeled_unique, valid_unlabeled_dataset
 
     """
 
-    train_labeled = labeled_network_dataset(labeled['train'], transforms=labeled_transforms)
-    valid_labeled = labeled_network_dataset(labeled['valid'], transforms=labeled_val_transforms)
+    # one network table for all labeled datasets - the transforms are shared
+    if net_repo is None:
+        net_repo = get_labeled_net_repo(labeled)
+
+    train_labeled = labeled_network_dataset(labeled['train'], transforms=labeled_transforms, shuffle=shuffle,
+                                            shuffle_buffer_size=shuffle_buffer_size, output_layer=output_layer,
+                                            net_repo=net_repo)
+    valid_labeled = labeled_network_dataset(labeled['valid'], transforms=labeled_val_transforms,
+                                            output_layer=output_layer, net_repo=net_repo)
 
     train_unlabeled = unlabeled_network_dataset(unlabeled['train'])
     valid_unlabeled = unlabeled_network_dataset(unlabeled['val'])
 
-    n_labeled = len(labeled['train']['net_repo'])
+    n_labeled = _get_n_nets(labeled['train'])
     train_dataset = SemiSupervisedDataset(train_labeled, train_unlabeled, n_labeled, k=k, coef_k=coef_k,
                                           batch_size=batch_size, repeat_unlabeled=repeat_unlabeled, n_workers=n_workers,
                                           shuffle=shuffle, **kwargs)
 
-    valid_labeled_dataset = torch.utils.data.DataLoader(valid_labeled, batch_size=val_batch_size,
-                                                        num_workers=math.floor(n_valid_workers / 2), **kwargs)
+    valid_labeled_dataset = get_labeled_loader(valid_labeled, batch_size=val_batch_size,
+                                               num_workers=math.floor(n_valid_workers / 2), **kwargs)
     valid_unlabeled_dataset = torch.utils.data.DataLoader(valid_unlabeled, batch_size=val_batch_size,
                                                           num_workers=math.ceil(n_valid_workers / 2), **kwargs)
 
@@ -57,24 +81,111 @@ def get_train_valid_datasets(labeled, unlabeled, k=1, coef_k=1.0, repeat_unlabel
 
     # quick hack for two valid sets
     if labeled['valid_unseen_train'] is not None:
-        valid_unseen = labeled_network_dataset(labeled['valid_unseen_train'], transforms=labeled_transforms)
-        valid_unseen = torch.utils.data.DataLoader(valid_unseen, batch_size=val_batch_size,
-                                                   num_workers=0, **kwargs)
+        valid_unseen = labeled_network_dataset(labeled['valid_unseen_train'], transforms=labeled_transforms,
+                                               output_layer=output_layer, net_repo=net_repo)
+        valid_unseen = get_labeled_loader(valid_unseen, batch_size=val_batch_size, num_workers=0, **kwargs)
 
         valid_labeled_dataset = {'valid_unseen_networks': valid_labeled_dataset, 'valid_unseen_images': valid_unseen}
 
     return train_dataset, valid_labeled_dataset, valid_labeled_unique, valid_unlabeled_dataset
 
 
-def labeled_network_dataset(labeled, transforms=None, return_hash=True, return_ref_id=False):
-    net_repo = labeled['net_repo']
+def _get_n_nets(labeled):
+    if is_sharded(labeled):
+        # the net repo contains also the networks excluded by the 'net_filter'
+        return len(set(get_sharded_hashes(labeled)))
+
+    return len(labeled['net_repo'])
+
+
+def get_labeled_net_repo(labeled):
+    """
+    Merge the network repositories of the labeled datasets used in the training (see `get_train_valid_datasets`) to
+    one stacked repository.
+    """
+    return merge_net_repos(*[labeled[key]['net_repo'] for key in ['train', 'valid', 'valid_unseen_train']
+                             if labeled.get(key) is not None])
+
+
+def labeled_network_dataset(labeled, transforms=None, return_net_id=True, return_ref_id=False, shuffle=False,
+                            shuffle_buffer_size=10000, output_layer=None, net_repo=None, return_hash=False):
+    """
+    Create the labeled dataset from the loaded IO dataset.
+
+    Args:
+        labeled: The IO dataset.
+        transforms: Transforms of the items (or batched transforms, see `ReferenceNetworkDataset`).
+        return_net_id: Return the network ids (see `info_nas.datasets.io.net_ids`).
+        return_ref_id: Return the ids of the input images in the reference dataset.
+        shuffle: Shuffle sharded datasets.
+        shuffle_buffer_size: Size of the shuffle buffer for sharded datasets.
+        output_layer: The captured layer to serve as the output (see `ReferenceNetworkDataset`).
+        net_repo: Network repository of the network ids (must contain all networks of the dataset), by default
+            the repository of the dataset is used.
+
+        return_hash: Return also the network hashes (decoded from the network ids, e.g. for analyses).
+
+    Returns: The labeled dataset.
+
+    """
+    net_repo = labeled['net_repo'] if net_repo is None else net_repo
+
+    if is_sharded(labeled):
+        return ShardedNetworkDataset(labeled, transform=transforms, return_net_id=return_net_id,
+                                     return_ref_id=return_ref_id, shuffle=shuffle, buffer_size=shuffle_buffer_size,
+                                     output_layer=output_layer, net_repo=net_repo, return_hash=return_hash)
 
     # indexing in the original input (io dataset uses input id 0)
     ref_dataset = (labeled['dataset'], labeled['labels']) if labeled['use_reference'] else None
 
-    return ReferenceNetworkDataset(labeled['net_hashes'], labeled['inputs'], labeled['outputs'],
+    # the captured layer that is served as the output
+    outputs = labeled[get_output_key(labeled, output_layer)]
+
+    return ReferenceNetworkDataset(labeled['net_hashes'], labeled['inputs'], outputs,
                                    reference_dataset=ref_dataset, net_repo=net_repo,
-                                   transform=transforms, return_hash=return_hash, return_ref_id=return_ref_id)
+                                   transform=transforms, return_net_id=return_net_id, return_ref_id=return_ref_id,
+                                   encoding=labeled.get('encoding'), return_hash=return_hash)
+
+
+def get_labeled_loader(dataset, batch_size=32, shuffle=False, num_workers=0, drop_last=False, **kwargs):
+    """
+    Create a DataLoader for a labeled dataset. Batches of a `ReferenceNetworkDataset` are gathered at once (see
+    `ReferenceNetworkDataset.get_batch`) instead of collating single items, the batch order is the same.
+
+    Args:
+        dataset: The labeled dataset.
+        batch_size: Batch size.
+        shuffle: Whether to shuffle the dataset.
+        num_workers: Number of DataLoader workers.
+        drop_last: Drop the last incomplete batch.
+        **kwargs: Additional DataLoader parameters.
+
+    Returns: The DataLoader.
+
+    """
+    if isinstance(dataset, ShardedNetworkDataset):
+        return ShardedDataLoader(dataset, batch_size=batch_size, num_workers=num_workers, drop_last=drop_last,
+                                 **kwargs)
+
+    if not isinstance(dataset, ReferenceNetworkDataset):
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                                           drop_last=drop_last, **kwargs)
+
+    # the same sampling as in the DataLoader, but the dataset gets the whole list of batch indices
+    sampler = torch.utils.data.RandomSampler(dataset) if shuffle else torch.utils.data.SequentialSampler(dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=drop_last)
+
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler, num_workers=num_workers,
+                                       **kwargs)
+
+
+class ShardedDataLoader(torch.utils.data.DataLoader):
+    """
+    A DataLoader of a `ShardedNetworkDataset` that reports the number of batches with the shards split between the
+    workers (see `ShardedNetworkDataset.get_n_batches`).
+    """
+    def __len__(self):
+        return self.dataset.get_n_batches(self.batch_size, num_workers=self.num_workers, drop_last=self.drop_last)
 
 
 def unlabeled_network_dataset(dataset):
@@ -82,7 +193,6 @@ def unlabeled_network_dataset(dataset):
     return NetworkDataset(adj, ops)
 
 
-# TODO if larger dataset, load from file (IterableDataset - only for io, unlabeled are short enough)
 class NetworkDataset(torch.utils.data.Dataset):
     """
     A dataset with a variable batch length.
@@ -106,10 +216,27 @@ class NetworkDataset(torch.utils.data.Dataset):
 class ReferenceNetworkDataset(NetworkDataset):
     """
     A dataset that, that maps indices of images to the true data, and returns it as a batch. Optionally transforms
-    the data afterwards.
+    the data afterwards. Encoded outputs and images (see `info_nas.datasets.io.encoding`) are decoded per item.
+
+    The network hashes are encoded to int32 network ids of the stacked network repository (see
+    `info_nas.datasets.io.net_ids`), items contain the ids instead of the hashes (see `get_net_hashes`). If
+    `return_hash` is True, the decoded hashes are returned as well ('hash').
+
+    If indexed by a list of indices, the whole batch is gathered at once (see `get_batch`). Batched transforms (see
+    `info_nas.datasets.io.transforms.BatchCompose`) are applied on the whole batch.
     """
     def __init__(self, *args, reference_dataset=None, reference_id=1, net_repo=None, net_id=0,
-                 return_hash=True, return_ref_id=False, transform=None):
+                 return_net_id=True, return_ref_id=False, transform=None, encoding=None, output_id=2,
+                 return_hash=False):
+
+        if net_repo is not None:
+            net_repo = stack_net_repo(net_repo)
+
+            # hashes are stored as network ids
+            net_column = args[net_id]
+            if not np.issubdtype(np.asarray(net_column).dtype, np.integer):
+                args = list(args)
+                args[net_id] = encode_net_hashes(net_column, net_repo['net_hashes'])
 
         super().__init__(*args)
 
@@ -120,11 +247,17 @@ class ReferenceNetworkDataset(NetworkDataset):
         self.net_repo = net_repo
         self.net_id = net_id
 
+        self.return_net_id = return_net_id
         self.return_hash = return_hash
         self.return_ref_id = return_ref_id
 
         self._batch_names = self.get_batch_names()
-        self.transform = transform
+
+        # transforms shared with datasets of other network repositories are copied
+        self.transform = bind_transforms(transform, net_repo) if net_repo is not None else transform
+
+        self.encoding = encoding
+        self.output_id = output_id
 
     def get_batch_names(self):
         """
@@ -144,41 +277,51 @@ class ReferenceNetworkDataset(NetworkDataset):
             names.append('weights')
             names.append('bias')
 
-        if self.return_hash:
+        if self.net_repo is not None and self.return_net_id:
+            names.append('net_id')
+
+        if self.net_repo is not None and self.return_hash:
             names.append('hash')
 
-        if self.return_ref_id:
+        # without a reference dataset, the inputs are not indices
+        if self.reference_dataset is not None and self.return_ref_id:
             names.append('ref_id')
 
         return names
 
     def __getitem__(self, index, no_transform=False):
+        if isinstance(index, (list, np.ndarray)) or (torch.is_tensor(index) and index.dim() > 0):
+            return self.get_batch(index, no_transform=no_transform)
+
         item = super().__getitem__(index)
+        item[self.output_id] = decode_outputs(item[self.output_id], self.encoding)
 
         # get inputs from the reference dataset
         if self.reference_dataset is not None:
             ref_id = item[self.reference_id]
 
-            data = self.reference_dataset[ref_id]
+            data = decode_images(self.reference_dataset[ref_id], self.encoding)
             label = self.reference_labels[ref_id]
             item[self.reference_id] = data
             item.append(label)
 
         # get network metadata
         if self.net_repo is not None:
-            net_hash = item[self.net_id]
-            net_entry = self.net_repo[net_hash]
+            net_id = int(item[self.net_id])
 
-            # replace hash entry with adj, ops
-            item[self.net_id] = net_entry['adj']
-            item.insert(self.net_id + 1, net_entry['ops'])
+            # replace network id entry with adj, ops
+            item[self.net_id] = self.net_repo['adj'][net_id]
+            item.insert(self.net_id + 1, self.net_repo['ops'][net_id])
 
             # additional info goes to the end
-            item.append(net_entry['weights'])
-            item.append(net_entry['bias'])
+            item.append(self.net_repo['weights'][net_id])
+            item.append(self.net_repo['bias'][net_id])
+
+            if self.return_net_id:
+                item.append(net_id)
 
             if self.return_hash:
-                item.append(net_hash)
+                item.append(self.get_net_hashes(net_id))
 
         if self.return_ref_id and self.reference_dataset is not None:
             item.append(ref_id)
@@ -186,10 +329,203 @@ class ReferenceNetworkDataset(NetworkDataset):
         item = {name: v for name, v in zip(self._batch_names, item)}
 
         if self.transform is not None and not no_transform:
+            if getattr(self.transform, 'batched', False):
+                return _first_item(self.get_batch([index]))
+
             item = self.transform(item)
 
         return item
 
+    def get_net_hashes(self, net_ids):
+        """
+        Get the hashes of network ids returned by the dataset.
+        """
+        return decode_net_ids(net_ids, self.net_repo['net_hashes'])
+
+    def get_batch(self, indices, no_transform=False):
+        """
+        Gather a batch of items at once - every column is indexed once by the batch indices.
+
+        Args:
+            indices: Indices of the batch items.
+            no_transform: If True, do not apply the transform.
+
+        Returns: The batch, in the same format as the default collate of the items.
+
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+
+        if self.net_repo is None:
+            batch = default_collate([self.__getitem__(i, no_transform=True) for i in indices.tolist()])
+            return self._transform_batch(batch, len(indices), no_transform=no_transform)
+
+        net_ids = _gather(self.data[self.net_id], indices).long()
+
+        batch = {name: self.net_repo[name][net_ids] for name in NET_KEYS}
+        batch['output'] = decode_outputs(_gather(self.data[self.output_id], indices), self.encoding)
+
+        inputs = _gather(self.data[self.reference_id], indices)
+        if self.reference_dataset is not None:
+            batch['input'] = decode_images(_gather(self.reference_dataset, inputs), self.encoding)
+            batch['label'] = _gather(self.reference_labels, inputs)
+            batch['ref_id'] = inputs
+        else:
+            batch['input'] = inputs
+
+        batch['net_id'] = net_ids
+        if self.return_hash:
+            batch['hash'] = self.get_net_hashes(net_ids)
+
+        batch = {name: batch[name] for name in self._batch_names}
+
+        return self._transform_batch(batch, len(indices), no_transform=no_transform)
+
+    def _transform_batch(self, batch, batch_len, no_transform=False):
+        if self.transform is None or no_transform:
+            return batch
+
+        if getattr(self.transform, 'batched', False):
+            return self.transform(batch)
+
+        # per item transforms
+        items = [{name: v[i] for name, v in batch.items()} for i in range(batch_len)]
+        return default_collate([self.transform(item) for item in items])
+
+
+def _first_item(batch):
+    if isinstance(batch, dict):
+        # flags (e.g. 'include_bias') are shared by the whole batch
+        return {k: v[0] if torch.is_tensor(v) or isinstance(v, list) else v for k, v in batch.items()}
+
+    return type(batch)(v[0] for v in batch)
+
+
+def _gather(column, indices):
+    if torch.is_tensor(column):
+        return column[indices.to(column.device)]
+
+    return torch.as_tensor(np.asarray(column)[indices.numpy()])
+
+
+class ShardedNetworkDataset(torch.utils.data.IterableDataset):
+    """
+    A labeled dataset that reads the IO data from shards (see `info_nas.datasets.io.sharded`), so that only one
+    shard per worker is held in memory. Items are returned in the same format as in `ReferenceNetworkDataset`.
+
+    The shards are split between the DataLoader workers. If shuffle is True, the shard order is shuffled and the items
+    are drawn randomly from a shuffle buffer of size `buffer_size`.
+    """
+    def __init__(self, labeled, return_net_id=True, return_ref_id=False, transform=None, shuffle=False,
+                 buffer_size=10000, output_layer=None, net_repo=None, return_hash=False):
+        super().__init__()
+
+        self.output_key = get_output_key(labeled, output_layer)
+
+        self.shards = labeled['shards']
+        self.reference_dataset = (labeled['dataset'], labeled['labels']) if labeled['use_reference'] else None
+        # all shards share the network ids
+        self.net_repo = stack_net_repo(labeled['net_repo'] if net_repo is None else net_repo)
+        self.net_filter = labeled.get('net_filter')
+        self.encoding = labeled.get('encoding')
+
+        self.return_net_id = return_net_id
+        self.return_hash = return_hash
+        self.return_ref_id = return_ref_id
+        self.transform = bind_transforms(transform, self.net_repo)
+
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+
+        self.data_len = get_sharded_len(labeled)
+
+    def __len__(self):
+        return self.data_len
+
+    def get_n_batches(self, batch_size, num_workers=0, drop_last=False):
+        """
+        Get the number of batches returned by a DataLoader. The shards are split between the workers and every worker
+        collates its own batches, so each of them can end with an incomplete batch.
+
+        Args:
+            batch_size: Batch size.
+            num_workers: Number of DataLoader workers.
+            drop_last: Drop the last incomplete batch of every worker.
+
+        Returns: The number of batches.
+
+        """
+        n_rows = [self._get_shard_len(s) for s in self._get_shards()]
+        worker_rows = [sum(n_rows[w::num_workers]) for w in range(num_workers)] if num_workers > 0 else [sum(n_rows)]
+
+        if drop_last:
+            return sum(n // batch_size for n in worker_rows)
+
+        return sum(math.ceil(n / batch_size) for n in worker_rows)
+
+    def _get_shards(self):
+        if self.net_filter is None:
+            return self.shards
+
+        return [s for s in self.shards if np.any(np.isin(list(s['nets'].keys()), self.net_filter))]
+
+    def _get_shard_len(self, shard):
+        if self.net_filter is None:
+            return sum(shard['nets'].values())
+
+        return sum(n for h, n in shard['nets'].items() if np.isin(h, self.net_filter))
+
+    def _load_shard(self, shard):
+        data = torch.load(shard['path'])
+        args = data['net_hashes'], data['inputs'], data[self.output_key]
+
+        if self.net_filter is not None:
+            net_map = np.isin(args[0], self.net_filter)
+            args = [a[net_map] for a in args]
+
+        return ReferenceNetworkDataset(*args, reference_dataset=self.reference_dataset, net_repo=self.net_repo,
+                                       return_net_id=self.return_net_id, return_ref_id=self.return_ref_id,
+                                       transform=self.transform, encoding=self.encoding, return_hash=self.return_hash)
+
+    def __iter__(self):
+        # seed from the torch generator - differs every epoch and in every worker
+        rng = random.Random(torch.empty((), dtype=torch.int64).random_().item())
+
+        shards = self._get_shards()
+
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        if self.shuffle:
+            shards = rng.sample(shards, len(shards))
+
+        buffer = []
+        for shard in shards:
+            shard_dataset = self._load_shard(shard)
+
+            indices = list(range(len(shard_dataset)))
+            if self.shuffle:
+                rng.shuffle(indices)
+
+            for i in indices:
+                item = shard_dataset[i]
+                if not self.shuffle:
+                    yield item
+                    continue
+
+                # return a random item from a full buffer
+                if len(buffer) < self.buffer_size:
+                    buffer.append(item)
+                    continue
+
+                j = rng.randrange(len(buffer))
+                yield buffer[j]
+                buffer[j] = item
+
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield item
+
 
 class UniqueValidationNets:
     """
@@ -208,22 +544,29 @@ class UniqueValidationNets:
         return n_batches + (1 if batch_diff > 0 else 0)
 
     def _init_unique_nets(self):
-        used_hashes = set()
-        dataset_len = len(self.net_dataset)
-
-        for i in range(dataset_len):
-            item = self.net_dataset.__getitem__(index=i, no_transform=True)
-
-            if item['hash'] not in used_hashes:
-                used_hashes.add(item['hash'])
-                self.unique_ids.append(i)
+        if isinstance(self.net_dataset, ShardedNetworkDataset):
+            # networks are stored in the manifest, the shards do not have to be loaded
+            net_hashes = get_sharded_hashes({'shards': self.net_dataset.shards,
+                                             'net_filter': self.net_dataset.net_filter})
+            self.unique_ids = encode_net_hashes(net_hashes, self.net_dataset.net_repo['net_hashes']).tolist()
+            return
+
+        # the first row of every network, in the dataset order
+        net_ids = np.asarray(self.net_dataset.data[self.net_dataset.net_id])
+        _, first_rows = np.unique(net_ids, return_index=True)
+        self.unique_ids = np.sort(first_rows).tolist()
 
     def __iter__(self):
         batch_adj = []
         batch_ops = []
 
         for i in self.unique_ids:
-            item = self.net_dataset.__getitem__(index=i, no_transform=True)
+            if isinstance(self.net_dataset, ShardedNetworkDataset):
+                net_repo = self.net_dataset.net_repo
+                item = {'adj': net_repo['adj'][i], 'ops': net_repo['ops'][i]}
+            else:
+                item = self.net_dataset.__getitem__(index=i, no_transform=True)
+
             batch_adj.append(item['adj'])
             batch_ops.append(item['ops'])
 
@@ -241,9 +584,10 @@ class SemiSupervisedDataset:
                  repeat_unlabeled=1, **kwargs):
         self.n, self.n_labeled, self.n_unlabeled = 0, 0, 0
 
-        # datasets and their iterators
-        self.labeled = torch.utils.data.DataLoader(labeled, batch_size=batch_size, shuffle=shuffle,
-                                                   num_workers=math.floor(n_workers / 2), **kwargs)
+        # datasets and their iterators (iterable datasets shuffle on their own)
+        labeled_shuffle = shuffle and not isinstance(labeled, torch.utils.data.IterableDataset)
+        self.labeled = get_labeled_loader(labeled, batch_size=batch_size, shuffle=labeled_shuffle,
+                                          num_workers=math.floor(n_workers / 2), **kwargs)
         self.unlabeled = torch.utils.data.DataLoader(unlabeled, batch_size=batch_size, shuffle=shuffle,
                                                      num_workers=math.ceil(n_workers / 2), **kwargs)
         self.labeled_iter = None
@@ -0,0 +1,324 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from info_nas.datasets.io.encoding import encode_images, encode_outputs
+from info_nas.datasets.io.output_layers import get_output_column, get_output_columns, normalize_output_layers
+
+
+MANIFEST_NAME = 'manifest.json'
+REFERENCE_NAME = 'reference.pt'
+
+
+def is_sharded(io_dataset):
+    """
+    Check if the loaded IO dataset is stored in shards (see `load_sharded_io_dataset`).
+    """
+    return 'shards' in io_dataset
+
+
+def is_sharded_dir(dataset_dir: str):
+    """
+    Check if the directory contains a sharded IO dataset (possibly a partially written one).
+    """
+    return os.path.exists(os.path.join(dataset_dir, MANIFEST_NAME))
+
+
+def load_sharded_io_dataset(dataset_dir: str, device=None):
+    """
+    Load the manifest and the shared data of a sharded IO dataset. The shards themselves are loaded lazily by the
+    dataset readers (e.g. `info_nas.datasets.io.semi_dataset.ShardedNetworkDataset`).
+
+    The loaded dataset has the following format:
+    {
+        'shards': a list of dicts {'path': path to the shard, 'nets': dict {net hash: number of rows in the shard}},
+        'dataset': the dataset that was used to create the IO data,
+        'labels': a vector of labels,
+        'use_reference': if True, the shard 'inputs' contain indices of images from 'dataset',
+        'input_shape': shape of one input row,
+        'output_shape': shape of one output row,
+        'output_layers': list of the captured output layers (shards contain one output column per layer),
+        'n_output_points': number of the output capture points of the networks,
+        'output_reducers': parameters of the output reducers (see `info_nas.datasets.io.reducers`),
+        'net_repo': a dict with net hash keys, where network specific data like weights or biases are stored,
+        'net_filter': if not None, use only networks with these hashes,
+        'encoding': the storage encoding of the outputs and images (see `info_nas.datasets.io.encoding.get_encoding`)
+    }
+
+    Every shard is a dict with the keys 'net_hashes', 'inputs' and 'outputs' (and 'outputs_1' etc. for multiple output
+    layers, same format as in `info_nas.datasets.io.create_dataset.create_io_dataset`), the net repo entries of the
+    shard networks are saved in a separate file.
+
+    Args:
+        dataset_dir: Directory with the shards and the manifest.
+        device: Device for the shared data.
+
+    Returns: The loaded sharded IO dataset.
+
+    """
+    with open(os.path.join(dataset_dir, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+
+    reference = torch.load(os.path.join(dataset_dir, REFERENCE_NAME), map_location=device)
+
+    shards = [{'path': os.path.join(dataset_dir, s['path']), 'nets': s['nets']} for s in manifest['shards']]
+    net_repo = _load_net_repo(dataset_dir, manifest['shards'], device=device)
+
+    return {
+        'shards': shards,
+        'dataset': reference['dataset'],
+        'labels': reference['labels'],
+        'use_reference': manifest['use_reference'],
+        'input_shape': manifest['input_shape'],
+        'output_shape': manifest['output_shape'],
+        'output_layers': manifest.get('output_layers'),
+        'n_output_points': manifest.get('n_output_points'),
+        'output_reducers': reference.get('output_reducers'),
+        'net_repo': net_repo,
+        'net_filter': None,
+        'encoding': manifest.get('encoding')
+    }
+
+
+def _load_net_repo(dataset_dir, shards, device=None):
+    net_repo = {}
+    for shard in shards:
+        net_repo.update(torch.load(os.path.join(dataset_dir, shard['net_repo']), map_location=device))
+
+    return net_repo
+
+
+def merge_shards(io_dataset):
+    """
+    Load all shards of a sharded IO dataset to memory and merge them to a single IO dataset (see
+    `info_nas.datasets.io.create_dataset.create_io_dataset` for the format).
+
+    Args:
+        io_dataset: The loaded sharded dataset.
+
+    Returns: The merged dataset.
+
+    """
+    shards = [torch.load(s['path']) for s in io_dataset['shards']]
+
+    data = {
+        'net_hashes': np.concatenate([s['net_hashes'] for s in shards]),
+        'inputs': torch.cat([s['inputs'] for s in shards]),
+        'dataset': io_dataset['dataset'],
+        'labels': io_dataset['labels'],
+        'use_reference': io_dataset['use_reference'],
+        'net_repo': io_dataset['net_repo'],
+        'encoding': io_dataset['encoding'],
+        'output_layers': io_dataset['output_layers'],
+        'n_output_points': io_dataset.get('n_output_points'),
+        'output_reducers': io_dataset['output_reducers']
+    }
+
+    for col in get_output_columns(io_dataset):
+        data[col] = torch.cat([s[col] for s in shards])
+
+    return data
+
+
+def _save_replace(obj, path):
+    _write_replace(path, lambda f: torch.save(obj, f), mode='wb')
+
+
+def _write_replace(path, write_fn, mode='w'):
+    # write to a temporary file first and sync it to disk, so that the file is never partially written (the manifest
+    # must not reference shards that are lost in a crash)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode) as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def get_sharded_hashes(io_dataset):
+    """
+    Get the hashes of all networks in a sharded dataset in the order of writing (optionally filtered by the
+    'net_filter').
+    """
+    net_filter = io_dataset.get('net_filter')
+    net_filter = set(net_filter) if net_filter is not None else None
+
+    return [h for s in io_dataset['shards'] for h in s['nets'] if net_filter is None or h in net_filter]
+
+
+def get_sharded_len(io_dataset):
+    """
+    Get the number of rows of a sharded dataset (optionally filtered by the 'net_filter').
+    """
+    net_filter = io_dataset.get('net_filter')
+    net_filter = set(net_filter) if net_filter is not None else None
+
+    return sum(n for s in io_dataset['shards'] for h, n in s['nets'].items() if net_filter is None or h in net_filter)
+
+
+class ShardWriter:
+    """
+    Writes the IO dataset to a directory in shards of `shard_size` networks, as they are produced. The manifest is
+    rewritten after every shard, so that it always describes the complete shards on disk - if the creation is
+    interrupted, the written shards can be loaded or extended (`append=True`).
+
+    Usage: writer.open(dataset, labels), writer.add(...) for every network, writer.close()
+    """
+    def __init__(self, save_dir: str, shard_size=100, append=False, encoding=None):
+        """
+        Initializes the writer.
+
+        Args:
+            save_dir: Directory to save the shards to.
+            shard_size: Number of networks per shard.
+            append: If True and a sharded dataset exists in `save_dir`, add new shards to it.
+            encoding: Storage encoding of the outputs and images (see `info_nas.datasets.io.encoding.get_encoding`).
+                When appending, the encoding of the existing dataset is used.
+        """
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        self.save_dir = save_dir
+        self.shard_size = shard_size
+
+        self.shards = []
+        self.processed_hashes = set()
+
+        self.use_reference = None
+        self.input_shape = None
+        self.output_shape = None
+        self.output_layers = None
+        self.n_output_points = None
+        self.encoding = encoding
+
+        if append and is_sharded_dir(save_dir):
+            self._load_existing()
+
+        self._hashes, self._n_rows, self._inputs, self._outputs, self._net_repo = [], [], [], [], {}
+
+    def _load_existing(self):
+        with open(os.path.join(self.save_dir, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+
+        self.shards = manifest['shards']
+        self.use_reference = manifest['use_reference']
+        self.input_shape = manifest['input_shape']
+        self.output_shape = manifest['output_shape']
+        self.output_layers = manifest.get('output_layers')
+        self.n_output_points = manifest.get('n_output_points')
+        self.encoding = manifest.get('encoding')
+
+        self.processed_hashes = {h for s in self.shards for h in s['nets']}
+
+    def open(self, dataset, labels, output_layers=None, output_reducers=None, n_output_points=None):
+        """
+        Write the shared data.
+
+        Args:
+            dataset: The dataset that is used to create the IO data.
+            labels: The labels of the dataset.
+            output_layers: List of the captured output layers.
+            output_reducers: Parameters of the output reducers.
+            n_output_points: Number of the output capture points of the networks.
+        """
+        if self.output_layers is not None and output_layers is not None:
+            existing = self.output_layers
+            if n_output_points is not None:
+                existing = normalize_output_layers(existing, n_output_points)
+                output_layers = normalize_output_layers(output_layers, n_output_points)
+
+            assert existing == output_layers, "The output layers differ from the existing shards."
+
+        self.output_layers = output_layers if output_layers is not None else self.output_layers
+        self.n_output_points = n_output_points if n_output_points is not None else self.n_output_points
+        dataset = encode_images(dataset, self.encoding)
+        _save_replace({'dataset': dataset, 'labels': labels, 'output_reducers': output_reducers},
+                      os.path.join(self.save_dir, REFERENCE_NAME))
+
+    def add(self, net_hash, in_data, out_data, net_entry):
+        """
+        Add the IO data of one network, flush the shard to disk if it is full.
+
+        Args:
+            net_hash: Hash of the network.
+            in_data: Inputs of the network (or reference ids).
+            out_data: Corresponding outputs, or a list of outputs of all captured layers.
+            net_entry: Network specific data for the net repo (e.g. weights and biases).
+        """
+        out_data = out_data if isinstance(out_data, list) else [out_data]
+        assert all(in_data.shape[0] == out.shape[0] for out in out_data)
+
+        if self.use_reference is None:
+            self.use_reference = len(in_data.shape) == 1
+            self.input_shape = list(in_data.shape[1:])
+            self.output_shape = list(out_data[0].shape[1:])
+
+        assert list(out_data[0].shape[1:]) == self.output_shape, "The output shape differs from the other shards."
+
+        self._net_repo[net_hash] = net_entry
+
+        self._hashes.append(net_hash)
+        self._n_rows.append(in_data.shape[0])
+        self._inputs.append(in_data)
+        self._outputs.append([encode_outputs(out, self.encoding) for out in out_data])
+
+        if len(self._hashes) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered networks to a new shard and update the manifest.
+        """
+        if not len(self._hashes):
+            return
+
+        shard_name = f"shard_{len(self.shards)}"
+        shard = {
+            'net_hashes': np.repeat(np.array(self._hashes), self._n_rows),
+            'inputs': torch.cat(self._inputs)
+        }
+
+        # one column per output layer
+        for i, outputs in enumerate(zip(*self._outputs)):
+            shard[get_output_column(i)] = torch.cat(outputs)
+
+        _save_replace(shard, os.path.join(self.save_dir, f"{shard_name}.pt"))
+        _save_replace(self._net_repo, os.path.join(self.save_dir, f"{shard_name}_net_repo.pt"))
+
+        self.shards.append({'path': f"{shard_name}.pt", 'net_repo': f"{shard_name}_net_repo.pt",
+                            'nets': dict(zip(self._hashes, self._n_rows))})
+        self.processed_hashes.update(self._hashes)
+        self._write_manifest()
+
+        self._hashes, self._n_rows, self._inputs, self._outputs, self._net_repo = [], [], [], [], {}
+
+    def _write_manifest(self):
+        manifest = {
+            'use_reference': self.use_reference,
+            'input_shape': self.input_shape,
+            'output_shape': self.output_shape,
+            'output_layers': self.output_layers,
+            'n_output_points': self.n_output_points,
+            'encoding': self.encoding,
+            'shards': self.shards
+        }
+
+        _write_replace(os.path.join(self.save_dir, MANIFEST_NAME), lambda f: json.dump(manifest, f, indent=4))
+
+    def close(self):
+        """
+        Flush the last shard.
+
+        Returns: The written dataset (loaded by `load_sharded_io_dataset`).
+
+        """
+        self.flush()
+
+        if not is_sharded_dir(self.save_dir):
+            # no networks were added
+            self._write_manifest()
+
+        return load_sharded_io_dataset(self.save_dir)
@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+
+
+class RunningStats:
+    """
+    Streaming mean, std, min and max of data rows, optionally grouped (e.g. by network or by label and network).
+
+    Every batch is reduced over the sorted groups and merged into the running statistics with the parallel variance
+    update (Chan et al.), so the data can be fed in batches or shards and statistics fitted in separate processes can
+    be merged (see `merge`). Sums are accumulated in float64, the results have the dtype of the data.
+    """
+    def __init__(self, axis=None):
+        """
+        Initializes the statistics.
+
+        Args:
+            axis: If None, compute the statistics over all elements of a group, if 0, compute them per column.
+        """
+        if axis is not None and axis != 0:
+            raise ValueError(f"Unsupported axis for running statistics: {axis}, use None or 0.")
+
+        self.axis = axis
+        self.dtype = None
+
+        # group key -> [count, mean, m2, min, max]
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def update(self, values, group_ids=None, group_keys=None):
+        """
+        Update the statistics with a batch of rows.
+
+        Args:
+            values: Batch of data rows (numpy array or tensor).
+            group_ids: Integer group ids of the rows, all rows belong to one group if None.
+            group_keys: Keys of the groups, `group_keys[i]` is the key of rows with id i. If None, the group ids are
+                used as the keys (and None is the key if `group_ids` is None).
+
+        """
+        if torch.is_tensor(values):
+            values = values.detach().cpu().numpy()
+
+        if not len(values):
+            return
+
+        if self.dtype is None:
+            self.dtype = values.dtype
+
+        if group_ids is None:
+            group_ids = np.zeros(len(values), dtype=np.int64)
+            group_keys = [None]
+
+        group_ids = np.asarray(group_ids)
+        n_groups = len(group_keys) if group_keys is not None else group_ids.max() + 1
+
+        present, counts, means, m2s, mins, maxs = _segment_moments(values, group_ids, n_groups, self.axis)
+
+        for i, g in enumerate(present):
+            key = group_keys[g] if group_keys is not None else g
+            self._merge_group(key, [counts[i], means[i], m2s[i], mins[i], maxs[i]])
+
+    def merge(self, other):
+        """
+        Merge statistics computed on other data (e.g. in another process).
+        """
+        if other.axis != self.axis:
+            raise ValueError(f"Cannot merge statistics over different axes ({self.axis}, {other.axis}).")
+
+        if self.dtype is None:
+            self.dtype = other.dtype
+
+        for key, group in other.groups.items():
+            self._merge_group(key, group)
+
+        return self
+
+    def _merge_group(self, key, group):
+        if key not in self.groups:
+            self.groups[key] = group
+            return
+
+        n_a, mean_a, m2_a, min_a, max_a = self.groups[key]
+        n_b, mean_b, m2_b, min_b, max_b = group
+
+        n = n_a + n_b
+        delta = mean_b - mean_a
+
+        mean = mean_a + delta * n_b / n
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+        self.groups[key] = [n, mean, m2, np.minimum(min_a, min_b), np.maximum(max_a, max_b)]
+
+    def get_stats(self):
+        """
+        Get the statistics of all groups.
+
+        Returns: A dict {group key: {'mean': mean, 'std': std, 'min': min, 'max': max, 'count': number of values}}.
+
+        """
+        return {key: self._get_group_stats(*group) for key, group in self.groups.items()}
+
+    def _get_group_stats(self, n, mean, m2, gmin, gmax):
+        std = np.sqrt(m2 / n)
+
+        if self.axis is None:
+            cast = self.dtype.type
+        else:
+            def cast(a):
+                return a.astype(self.dtype)
+
+        return {'mean': cast(mean), 'std': cast(std), 'min': gmin, 'max': gmax, 'count': n}
+
+
+def _segment_moments(values, group_ids, n_groups, axis):
+    counts = np.bincount(group_ids, minlength=n_groups)
+    present = np.flatnonzero(counts)
+    counts = counts[present]
+
+    # rows of one group are contiguous after a stable sort
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    seg_ids = np.repeat(np.arange(len(counts)), counts)
+    values = values[np.argsort(group_ids, kind='stable')]
+
+    if axis is None:
+        values = values.reshape(len(values), -1)
+        n = counts * values.shape[1]
+
+        mean = np.add.reduceat(values.sum(axis=1, dtype=np.float64), starts) / n
+        sq_dev = ((values - mean[seg_ids, np.newaxis]) ** 2).sum(axis=1)
+        m2 = np.add.reduceat(sq_dev, starts)
+
+        vmin = np.minimum.reduceat(values.min(axis=1), starts)
+        vmax = np.maximum.reduceat(values.max(axis=1), starts)
+        return present, n, mean, m2, vmin, vmax
+
+    mean = np.add.reduceat(values, starts, axis=0, dtype=np.float64) / counts[:, np.newaxis]
+    m2 = np.add.reduceat((values - mean[seg_ids]) ** 2, starts, axis=0)
+
+    vmin = np.minimum.reduceat(values, starts, axis=0)
+    vmax = np.maximum.reduceat(values, starts, axis=0)
+    return present, counts, mean, m2, vmin, vmax
@@ -5,8 +5,12 @@ import pickle
 import torch
 import torchvision
 
+from info_nas.datasets.io.net_ids import stack_net_repo, is_bound_to
+from info_nas.datasets.io.stats import RunningStats
 
-def get_transforms(scale_path, include_bias, normalize, multiply_by_weights, scale_whole_path=False):
+
+def get_transforms(scale_path, include_bias, normalize, multiply_by_weights, scale_whole_path=False, batched=False,
+                   device=None, net_repo=None):
     """
     Gets all transforms for the training, loads saved fit data for scalers.
 
@@ -16,34 +20,42 @@ def get_transforms(scale_path, include_bias, normalize, multiply_by_weights, sca
         normalize: If True, normalize the network data, if false, min max scale.
         multiply_by_weights: If True, multiply the outputs by the weights of the network (according to the label).
         scale_whole_path: Path to a scale for the whole dataset.
+        batched: If True, return the batched variant of the transforms (see `BatchCompose`).
+        device: Device for the batched transforms, by default the batch stays on its device.
+        net_repo: Network repository to precompute the sort permutations from (see `SortByWeights`).
 
     Returns: Transforms for the dataset.
 
     """
     transforms = []
 
+    if batched and device is not None:
+        transforms.append(BatchToDevice(device))
+
     if include_bias:
         assert 'include_bias' in scale_path
-        transforms.append(IncludeBias())
+        transforms.append(BatchIncludeBias() if batched else IncludeBias())
 
     if multiply_by_weights:
-        transforms.append(MultByWeights(include_bias=include_bias))
+        mult = BatchMultByWeights if batched else MultByWeights
+        transforms.append(mult(include_bias=include_bias))
 
-    scaler = load_scaler(scale_path, normalize, include_bias)
+    scaler = load_scaler(scale_path, normalize, include_bias, batched=batched)
     transforms.append(scaler)
 
-    transforms.append(SortByWeights(after_sort_scale=scale_whole_path))
-    transforms.append(ToTuple())
-    transforms = torchvision.transforms.Compose(transforms)
+    sort = BatchSortByWeights if batched else SortByWeights
+    transforms.append(sort(after_sort_scale=scale_whole_path, net_repo=net_repo, include_bias=include_bias))
+    transforms.append(BatchToTuple() if batched else ToTuple())
 
-    return transforms
+    return BatchCompose(transforms) if batched else torchvision.transforms.Compose(transforms)
 
 
-def load_scaler(scale_path, normalize, include_bias):
+def load_scaler(scale_path, normalize, include_bias, batched=False):
     per_label = 'per_label' in scale_path
     weighted = 'weighted' in scale_path
 
-    scaler = Scaler(normalize=normalize, per_label=per_label, weighted=weighted, include_bias=include_bias)
+    scaler_cls = BatchScaler if batched else Scaler
+    scaler = scaler_cls(normalize=normalize, per_label=per_label, weighted=weighted, include_bias=include_bias)
     scaler.load_fit(scale_path)
     return scaler
 
@@ -85,8 +97,12 @@ class IncludeBias:
 class SortByWeights:
     """
     Sorts the outputs by weights corresponding to the inputs label.
+
+    The sort permutations depend only on the network and the label, so they are computed once per network (on first
+    use after the transform is bound to the network ids, see `bind_net_repo`) and the transform is a single gather.
     """
-    def __init__(self, fixed_label=None, return_top_n=None, use_all_labels=False, after_sort_scale=None):
+    def __init__(self, fixed_label=None, return_top_n=None, use_all_labels=False, after_sort_scale=None,
+                 net_repo=None, include_bias=True):
         """
         Initializes the sort transform.
 
@@ -94,6 +110,10 @@ class SortByWeights:
             fixed_label: Sorts using a fixed label instead.
             return_top_n: Return only top n features.
             after_sort_scale: Scale the data after sorting.
+            net_repo: Network repository to bind the transform to (see `bind_net_repo`), the labeled datasets bind
+                their transforms on their own.
+
+            include_bias: Whether the precomputed permutations include bias (see `IncludeBias`).
         """
         self.fixed_label = fixed_label
         self.return_top_n = return_top_n
@@ -105,6 +125,82 @@ class SortByWeights:
 
         self.after_sort_scale = after_sort_scale
 
+        self.include_bias = include_bias
+
+        self._net_hashes = None
+        self._net_weights = None
+        self._net_bias = None
+        self._perm_table = None
+        self._permutations = {}
+
+        if net_repo is not None:
+            self.bind_net_repo(net_repo)
+
+    def bind_net_repo(self, net_repo):
+        """
+        Bind the transform to the network ids of a stacked network repository (see
+        `info_nas.datasets.io.net_ids.stack_net_repo`), the sort permutations of all networks are precomputed.
+        """
+        net_repo = stack_net_repo(net_repo)
+        if is_bound_to(self._net_hashes, net_repo['net_hashes']):
+            return
+
+        self._net_hashes = net_repo['net_hashes']
+        self._net_weights, self._net_bias = net_repo['weights'], net_repo['bias']
+        self._perm_table = None
+
+    def unbind(self):
+        """
+        Remove the binding to the network ids (and the precomputed permutations).
+        """
+        self._net_hashes = None
+        self._net_weights = None
+        self._net_bias = None
+        self._perm_table = None
+        self._permutations = {}
+
+    def __getstate__(self):
+        # DataLoader workers build their own table instead of receiving a copy
+        state = self.__dict__.copy()
+        state['_perm_table'] = None
+        return state
+
+    def _get_perm_table(self):
+        """
+        Precompute the permutations of all bound networks (cut to the top n features), the indices are stored as int16
+        to keep the table small.
+        """
+        if self._perm_table is None and self._net_hashes is not None:
+            self._perm_table = torch.stack([self._compute_permutation(weights, bias, self.include_bias).to(torch.int16)
+                                            for weights, bias in zip(self._net_weights, self._net_bias)])
+
+        return self._perm_table
+
+    def _compute_permutation(self, weights, bias, include_bias):
+        if include_bias:
+            sort_key = torch.cat([weights, bias.unsqueeze(-1)], dim=1)
+        else:
+            sort_key = weights
+
+        if self.use_all_labels:
+            _, indices = torch.sort(sort_key, descending=True)
+        else:
+            # the same sort call as for a single label
+            indices = torch.stack([torch.sort(row, descending=True)[1] for row in sort_key])
+
+        return indices if self.return_top_n is None else indices[:, :self.return_top_n]
+
+    def _get_permutation(self, net_id, weights, bias, include_bias):
+        if self._net_hashes is not None and include_bias == self.include_bias:
+            return self._get_perm_table()[net_id].long()
+
+        # items that differ from the precomputed variant
+        key = (int(net_id), include_bias)
+        if key not in self._permutations:
+            self._permutations[key] = self._compute_permutation(weights, bias, include_bias)
+
+        return self._permutations[key]
+
     def __call__(self, item):
         output = item['output']
         label = item['label']
@@ -112,26 +208,18 @@ class SortByWeights:
 
         include_bias = item['include_bias'] if 'include_bias' in item else False
 
-        if include_bias:
-            sort_key = torch.cat([weights, bias.unsqueeze(-1)], dim=1)
+        if 'net_id' in item:
+            indices = self._get_permutation(item['net_id'], weights, bias, include_bias)
         else:
-            sort_key = weights
+            indices = self._compute_permutation(weights, bias, include_bias)
 
         if not self.use_all_labels:
             # sort by target label or one chosen
-            sort_key = sort_key[label] if self.fixed_label is None else sort_key[self.fixed_label]
-
-            sort_key, indices = torch.sort(sort_key, descending=True)
+            indices = indices[label] if self.fixed_label is None else indices[self.fixed_label]
             output = output[indices].detach()
-
-            output = output if self.return_top_n is None else output[:self.return_top_n]
         else:
             # features sorted by each label
-            sort_key, indices = torch.sort(sort_key, descending=True)
-            outputs_all = output[indices].detach()
-
-            outputs_all = outputs_all if self.return_top_n is None else outputs_all[:, :self.return_top_n]
-            output = outputs_all.flatten()
+            output = output[indices].detach().flatten()
 
         if self.after_sort_scale is not None:
             mu, std = self.after_sort_scale['mean'], self.after_sort_scale['std']
@@ -158,7 +246,8 @@ class MultByWeights:
 
     def __call__(self, item):
         label, output = item['label'], item['output']
-        output *= get_weights(item, label, include_bias=self.include_bias)
+        # not in-place - without IncludeBias, the output is a view of the dataset
+        output = output * get_weights(item, label, include_bias=self.include_bias)
         if self.normalize_row:
             output = (output - torch.mean(output)) / torch.std(output)
 
@@ -191,10 +280,96 @@ class Scaler:
 
         self.weighted = weighted
 
+        self._net_hashes = None
         self.net_scales = net_scales
+        self._running = None
+
+    @property
+    def net_scales(self):
+        return self._net_scales
+
+    @net_scales.setter
+    def net_scales(self, net_scales):
+        self._net_scales = net_scales
+        # dense tables are built from the fitted scales on first use
+        self._tables = None
+
+    def bind_net_repo(self, net_repo):
+        """
+        Bind the scaler to the network ids of a stacked network repository (see
+        `info_nas.datasets.io.net_ids.stack_net_repo`), the scale tables are indexed by these ids.
+        """
+        net_repo = stack_net_repo(net_repo)
+        if is_bound_to(self._net_hashes, net_repo['net_hashes']):
+            return
+
+        self._net_hashes = net_repo['net_hashes']
+        self._tables = None
+
+    def unbind(self):
+        """
+        Remove the binding to the network ids (and the scale tables).
+        """
+        self._net_hashes = None
+        self._tables = None
 
     def fit(self, outputs, hashes, labels=None, net_repo=None, save_path=None):
-        scales = self._fit_scales(outputs, hashes, labels=labels, net_repo=net_repo)
+        self.partial_fit(outputs, hashes, labels=labels, net_repo=net_repo,
+                         all_labels=np.unique(labels) if labels is not None else None)
+        self.finish_fit(save_path=save_path)
+
+    def partial_fit(self, outputs, hashes, labels=None, net_repo=None, all_labels=None):
+        """
+        Update the fit with a part of the data (e.g. a shard or a batch of rows), the scales are computed in
+        `finish_fit`. Parts fitted in other processes can be merged using `merge_fit`.
+
+        Args:
+            outputs: Output rows.
+            hashes: Network hashes of the rows.
+            labels: Labels of the rows, must be provided if per_label=True or weighted=True.
+            net_repo: Network repository with the weights, must be provided if weighted=True.
+            all_labels: If weighted=True and per_label=False, all outputs of a network are scaled by the weights of
+                every label in `all_labels`. By default all labels of the network classifier.
+
+        """
+        if self._running is None:
+            self._running = RunningStats(axis=self.axis)
+
+        for values, group_ids, group_keys in self._get_groups(outputs, hashes, labels, net_repo, all_labels):
+            self._running.update(values, group_ids, group_keys)
+
+    def merge_fit(self, other):
+        """
+        Merge the partial fit of another scaler (see `partial_fit`).
+        """
+        if other._running is None:
+            return
+
+        if self._running is None:
+            self._running = RunningStats(axis=self.axis)
+
+        self._running.merge(other._running)
+
+    def finish_fit(self, save_path=None):
+        """
+        Compute the scales from the partial fits, optionally save them to `save_path`.
+        """
+        if self._running is None:
+            raise ValueError("The Scaler is not partially fitted, call partial_fit first.")
+
+        stats = self._running.get_stats()
+        self._running = None
+
+        scales = {}
+        for label, net_hash in sorted(stats.keys()):
+            net_stats = stats[(label, net_hash)]
+            net_scales = {'mean': net_stats['mean'], 'std': net_stats['std'], 'max': net_stats['max']}
+
+            if self.per_label or self.weighted:
+                scales.setdefault(label, {})[net_hash] = net_scales
+            else:
+                scales[net_hash] = net_scales
+
         self.net_scales = scales
 
         if save_path is not None:
@@ -205,69 +380,269 @@ class Scaler:
         with open(load_path, 'rb') as f:
             self.net_scales = pickle.load(f)
 
-    def _fit_scales(self, outputs, hashes, labels=None, net_repo=None):
+    def _get_groups(self, outputs, hashes, labels=None, net_repo=None, all_labels=None):
+        # hashes and labels are encoded to integer group ids, the group keys are (label, hash) - or (None, hash) if
+        # the scales are not per label
+        net_hashes, hash_ids = np.unique(hashes, return_inverse=True)
 
-        if self.per_label or self.weighted:
-            assert labels is not None, "Must provide labels if per_label=True or weighted=True."
+        if not (self.per_label or self.weighted):
+            yield outputs, hash_ids, [(None, net_hash) for net_hash in net_hashes]
+            return
+
+        assert labels is not None, "Must provide labels if per_label=True or weighted=True."
+        label_values, label_ids = np.unique(labels, return_inverse=True)
+
+        if self.per_label:
+            values = outputs
             if self.weighted:
                 assert net_repo is not None, "Must provide weights in net repo if weighted=True."
+                # every row is multiplied by the weights of its label
+                values = outputs * self._get_weight_table(net_repo, net_hashes, label_values)[hash_ids, label_ids]
+
+            group_ids = label_ids * len(net_hashes) + hash_ids
+            yield values, group_ids, [(label, net_hash) for label in label_values for net_hash in net_hashes]
+            return
+
+        # all outputs of a network are multiplied by the weights of every label
+        assert net_repo is not None, "Must provide weights in net repo if weighted=True."
+        if all_labels is None:
+            all_labels = np.arange(len(net_repo[net_hashes[0]]['weights']))
+
+        weight_table = self._get_weight_table(net_repo, net_hashes, all_labels)
+        for i, label in enumerate(all_labels):
+            yield outputs * weight_table[hash_ids, i], hash_ids, [(label, net_hash) for net_hash in net_hashes]
+
+    def _get_weight_table(self, net_repo, net_hashes, label_values):
+        return np.stack([
+            np.stack([get_weights(net_repo[net_hash], label, include_bias=self.include_bias).numpy()
+                      for label in label_values])
+            for net_hash in net_hashes
+        ])
+
+    def _get_tables(self, device):
+        """
+        Pack the fitted scales to dense tensors indexed by (network id, label), the network ids are given by the bound
+        network repository (see `bind_net_repo`). Scales that are not per label have a single label slot, the table
+        'known' marks the fitted entries.
+        """
+        if self._net_hashes is None:
+            raise ValueError("The Scaler is not bound to network ids, call bind_net_repo first.")
 
-            fit_dict = {}
+        if self._tables is None:
+            label_scales = self.net_scales if self.per_label or self.weighted else {0: self.net_scales}
+            n_labels = max(label_scales.keys()) + 1
+            example = next(iter(next(iter(label_scales.values())).values()))
 
-            for label in np.unique(labels):
-                labelmap = labels == label
+            # scales of networks that are not in the repository are skipped
+            net_index = {net_hash: i for i, net_hash in enumerate(self._net_hashes)}
 
-                label_hashes = hashes[labelmap] if self.per_label else hashes
-                label_vals = outputs[labelmap] if self.per_label else outputs
+            # the same arithmetic as in the original per item scaling, done once per entry
+            eps = np.finfo(np.float32).eps
 
-                fit_dict[label] = self._get_scales_per_hash(label_vals, label_hashes, net_repo=net_repo,
-                                                            weight_label=label)
+            def get_entry(scales, name):
+                return np.asarray(scales[name] if name == 'mean' else scales[name] + eps)
 
-            return fit_dict
+            tables = {'known': torch.zeros((len(self._net_hashes), n_labels), dtype=torch.bool)}
+            for label, label_entries in label_scales.items():
+                rows = [net_index[net_hash] for net_hash in label_entries if net_hash in net_index]
+                tables['known'][rows, label] = True
 
-        return self._get_scales_per_hash(outputs, hashes, net_repo=net_repo)
+            for name in ['mean', 'std', 'max']:
+                first = get_entry(example, name)
+                table = np.full((len(self._net_hashes), n_labels, *first.shape), np.nan, dtype=first.dtype)
 
-    def _get_scales_per_hash(self, values, hashes, net_repo=None, weight_label=None):
-        scales = {}
+                for label, label_entries in label_scales.items():
+                    for net_hash, scales in label_entries.items():
+                        if net_hash in net_index:
+                            table[net_index[net_hash], label] = get_entry(scales, name)
 
-        for net_hash in np.unique(hashes):
-            filtered = values[hashes == net_hash]
+                tables[name] = torch.as_tensor(table)
 
-            # multiply by label weights
-            if self.weighted:
-                weights = get_weights(net_repo[net_hash], weight_label, include_bias=self.include_bias).numpy()
-                filtered *= weights
+            # scalar scales (axis=None) are python-like scalars in the arithmetic
+            self._scalar = tables['mean'].dim() == 2
+            self._tables = tables
 
-            mean, std = np.mean(filtered, axis=self.axis), np.std(filtered, axis=self.axis)
-            hmax = np.max(filtered, axis=self.axis)
+        tables = self._tables
+        if tables['mean'].device != torch.device(device):
+            tables.update({name: tables[name].to(device) for name in ['known', 'mean', 'std', 'max']})
 
-            scales[net_hash] = {'mean': mean, 'std': std, 'max': hmax}
+        return tables
 
-        return scales
+    def _get_scale(self, tables, name, rows, labels, output):
+        scale = tables[name][rows, labels]
+        return scale.to(output.dtype) if self._scalar else scale
 
-    def __call__(self, item):
-        if self.net_scales is None:
-            raise ValueError("The Scaler is not fitted with scale values.")
+    def _scale(self, output, tables, rows, labels):
+        if not torch.all(tables['known'][rows, labels]):
+            raise ValueError("The Scaler is not fitted for some of the networks (or labels).")
 
-        net_hash = item['hash']
-        output = item['output']
-        label = item['label'].item()
+        if self.normalize:
+            mean, std = self._get_scale(tables, 'mean', rows, labels, output), \
+                self._get_scale(tables, 'std', rows, labels, output)
+            return (output - mean) / std
 
+        return output / self._get_scale(tables, 'max', rows, labels, output)
+
+    def _scale_by_hash(self, output, net_hash, label):
+        # items without network ids (e.g. a standalone Scaler) are scaled by the hash
+        label = int(label)
         scales = self.net_scales[label][net_hash] if self.per_label or self.weighted else self.net_scales[net_hash]
 
         if self.normalize:
             mu, std = scales['mean'], scales['std']
-            item['output'] = (output - mu) / (std + np.finfo(np.float32).eps)
-        else:
-            omax = scales['max']
-            item['output'] = output / (omax + np.finfo(np.float32).eps)
+            return (output - mu) / (std + np.finfo(np.float32).eps)
+
+        return output / (scales['max'] + np.finfo(np.float32).eps)
+
+    def __call__(self, item):
+        if self.net_scales is None:
+            raise ValueError("The Scaler is not fitted with scale values.")
+
+        output = item['output']
+        if 'net_id' not in item:
+            item['output'] = self._scale_by_hash(output, _get_hash(item), item['label'])
+            return item
 
+        tables = self._get_tables(output.device)
+
+        label = item['label'] if self.per_label or self.weighted else 0
+        item['output'] = self._scale(output, tables, item['net_id'], label)
         return item
 
 
+def _get_hash(item):
+    if 'hash' not in item:
+        raise ValueError("The Scaler needs either network ids ('net_id') or hashes ('hash') of the items.")
+
+    return item['hash']
+
+
 class ToTuple:
     """
     Convert to tuple batch instead of a dict batch.
     """
     def __call__(self, item):
         return item['adj'], item['ops'], item['input'], item['output']
+
+
+class BatchCompose(torchvision.transforms.Compose):
+    """
+    Composes batched transforms. The transforms take a whole batch dict (as returned by
+    `info_nas.datasets.io.semi_dataset.ReferenceNetworkDataset.get_batch`), and produce the same results as the per
+    item transforms applied on every item of the batch.
+    """
+    batched = True
+
+
+class BatchToDevice:
+    """
+    Moves the batch tensors to a device, the following transforms run on the device. With a cuda device, the
+    DataLoader should not use worker processes.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def __call__(self, batch):
+        return {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in batch.items()}
+
+
+class BatchIncludeBias:
+    def __call__(self, batch):
+        output = batch['output']
+        batch['output'] = torch.cat([output, torch.ones(len(output), 1, dtype=output.dtype, device=output.device)],
+                                    dim=1)
+        batch['include_bias'] = True
+        return batch
+
+
+def get_batch_weights(batch, labels, include_bias=True):
+    rows = torch.arange(len(labels), device=labels.device)
+    weights = batch['weights'][rows, labels]
+
+    if include_bias:
+        bias = batch['bias'][rows, labels]
+        weights = torch.cat([weights, bias.unsqueeze(-1)], dim=1)
+
+    return weights
+
+
+class BatchMultByWeights(MultByWeights):
+    def __call__(self, batch):
+        output = batch['output'] * get_batch_weights(batch, batch['label'], include_bias=self.include_bias)
+        if self.normalize_row:
+            output = (output - torch.mean(output, dim=1, keepdim=True)) / torch.std(output, dim=1, keepdim=True)
+
+        batch['output'] = output
+        return batch
+
+
+class BatchSortByWeights(SortByWeights):
+    def __call__(self, batch):
+        output = batch['output']
+        weights, bias = batch['weights'], batch['bias']
+
+        include_bias = batch.get('include_bias', False)
+
+        if 'net_id' not in batch:
+            indices = torch.stack([self._compute_permutation(w, b, include_bias) for w, b in zip(weights, bias)])
+        elif self._net_hashes is not None and include_bias == self.include_bias:
+            perm_table = self._get_perm_table()
+            indices = perm_table[batch['net_id'].to(perm_table.device)].long()
+        else:
+            indices = torch.stack([self._get_permutation(i, w, b, include_bias) for i, w, b in
+                                   zip(batch['net_id'].tolist(), weights, bias)])
+
+        indices = indices.to(output.device)
+
+        if not self.use_all_labels:
+            # sort by target label or one chosen
+            labels = batch['label'] if self.fixed_label is None else torch.full_like(batch['label'], self.fixed_label)
+            indices = indices[torch.arange(len(labels), device=labels.device), labels.to(output.device)]
+            output = torch.gather(output, 1, indices).detach()
+        else:
+            # features sorted by each label
+            expanded = output.unsqueeze(1).expand(-1, indices.shape[1], -1)
+            output = torch.gather(expanded, 2, indices).detach().flatten(start_dim=1)
+
+        if self.after_sort_scale is not None:
+            mu, std = self.after_sort_scale['mean'], self.after_sort_scale['std']
+            output = (output - mu) / std
+
+        batch['output'] = output
+        return batch
+
+
+class BatchScaler(Scaler):
+    """
+    Scales the outputs of every network in a batch, the scales of the whole batch are gathered from the dense tables
+    at once.
+    """
+    def _get_scale(self, tables, name, rows, labels, output):
+        scale = super()._get_scale(tables, name, rows, labels, output)
+        return scale.unsqueeze(-1) if self._scalar else scale
+
+    def __call__(self, batch):
+        if self.net_scales is None:
+            raise ValueError("The Scaler is not fitted with scale values.")
+
+        output = batch['output']
+        if 'net_id' not in batch:
+            batch['output'] = torch.stack([self._scale_by_hash(o, h, label) for o, h, label in
+                                           zip(output, _get_hash(batch), batch['label'])])
+            return batch
+
+        tables = self._get_tables(output.device)
+
+        rows = batch['net_id'].to(output.device)
+        if self.per_label or self.weighted:
+            labels = batch['label'].to(output.device)
+        else:
+            labels = torch.zeros_like(rows)
+
+        batch['output'] = self._scale(output, tables, rows, labels)
+        return batch
+
+
+class BatchToTuple:
+    def __call__(self, batch):
+        return batch['adj'], batch['ops'], batch['input'], batch['output']
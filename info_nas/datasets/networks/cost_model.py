@@ -0,0 +1,219 @@
+import json
+import resource
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from nasbench_pytorch.model import Network as NBNetwork
+from nasbench_pytorch.model.model import compute_vertex_channels
+from nasbench_pytorch.model.model_spec import ModelSpec
+
+
+COST_FEATURES = ['macs', 'params', 'n_convs', 'n_pools']
+
+
+def get_architecture_cost(ops, adjacency, num_labels=10, input_size=32, in_channels=3, stem_out_channels=128,
+                          num_stacks=3, num_modules_per_stack=3):
+    """
+    Compute the cost of a network analytically from its cell (`module_operations` and `module_adjacency`, see
+    `info_nas.datasets.networks.utils.get_net_from_hash`), for the same network as `NBNetwork` builds.
+
+    Args:
+        ops: Operations of the cell vertices.
+        adjacency: Adjacency matrix of the cell.
+        num_labels: Number of labels for the classification.
+        input_size: Height and width of the input images.
+        in_channels: Number of input image channels.
+        stem_out_channels: Number of output stem channels.
+        num_stacks: Number of stacks.
+        num_modules_per_stack: Number of cells per stack.
+
+    Returns: A dict with the number of multiply-accumulate operations per image ('macs'), the number of weights of
+        the convolutions, batch norms and the classifier ('params'), and the number of convolutions ('n_convs') and max pools ('n_pools') in the network.
+
+    """
+    spec = ModelSpec(adjacency, ops)
+    matrix, ops = spec.matrix, spec.ops
+    n_vertices = len(matrix)
+
+    cost = {'macs': 0, 'params': 0, 'n_convs': 0, 'n_pools': 0}
+
+    def add_conv(c_in, c_out, kernel_size, size):
+        # ConvBnRelu - convolution without bias, batch norm with weight and bias
+        cost['macs'] += size * size * c_in * c_out * kernel_size * kernel_size
+        cost['params'] += c_in * c_out * kernel_size * kernel_size + 2 * c_out
+        cost['n_convs'] += 1
+
+    size = input_size
+    add_conv(in_channels, stem_out_channels, 3, size)
+
+    c_in = c_out = stem_out_channels
+    for stack_num in range(num_stacks):
+        if stack_num > 0:
+            size //= 2
+            c_out *= 2
+
+        for _ in range(num_modules_per_stack):
+            channels = compute_vertex_channels(c_in, c_out, matrix)
+
+            for t in range(1, n_vertices):
+                # projection of the cell input
+                if matrix[0, t]:
+                    add_conv(c_in, channels[t], 1, size)
+
+                if t == n_vertices - 1:
+                    continue
+
+                if ops[t] == 'conv3x3-bn-relu':
+                    add_conv(channels[t], channels[t], 3, size)
+                elif ops[t] == 'conv1x1-bn-relu':
+                    add_conv(channels[t], channels[t], 1, size)
+                elif ops[t] == 'maxpool3x3':
+                    cost['n_pools'] += 1
+                else:
+                    raise ValueError(f"Invalid operation: {ops[t]}.")
+
+            c_in = c_out
+
+    # global average pooling and classifier
+    cost['macs'] += c_out * num_labels
+    cost['params'] += c_out * num_labels + num_labels
+
+    return cost
+
+
+def measure_throughput(ops, adjacency, batch_size=128, n_batches=10, n_warmup=2, num_labels=10, input_size=32,
+                       device=None, **net_kwargs):
+    """
+    Measure the training throughput of a network (forward pass, backward pass and an optimizer step on random data)
+    and the peak memory.
+
+    On cpu, the peak memory is the increase of the maximum resident set size of the process - to get the value for
+    a single network, call the function in a fresh process (see `scripts/benchmark_pretraining_cost.py`).
+
+    Args:
+        ops: Operations of the cell vertices.
+        adjacency: Adjacency matrix of the cell.
+        batch_size: Batch size.
+        n_batches: Number of measured batches.
+        n_warmup: Number of batches before the measurement.
+        num_labels: Number of labels for the classification.
+        input_size: Height and width of the input images.
+        device: Device to measure on.
+        **net_kwargs: Additional kwargs for `NBNetwork`.
+
+    Returns: A dict with the training throughput ('images_per_sec') and the peak memory in MB ('peak_memory_mb').
+
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    net = NBNetwork((adjacency, ops), num_labels, **net_kwargs).to(device)
+    net.train()
+
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.025, momentum=0.9, weight_decay=1e-4)
+    loss = nn.CrossEntropyLoss()
+
+    inputs = torch.randn(batch_size, 3, input_size, input_size, device=device)
+    targets = torch.randint(0, num_labels, (batch_size,), device=device)
+
+    def train_step():
+        optimizer.zero_grad()
+        curr_loss = loss(net(inputs), targets)
+        curr_loss.backward()
+        optimizer.step()
+
+    for _ in range(n_warmup):
+        train_step()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+
+    for _ in range(n_batches):
+        train_step()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        peak_memory = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        # ru_maxrss is in kilobytes on linux
+        peak_memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_memory) / 2 ** 10
+
+    return {'images_per_sec': batch_size * n_batches / (time.time() - start), 'peak_memory_mb': peak_memory}
+
+
+class PretrainCostModel:
+    """
+    A linear model of the training time per image, fitted on measured throughputs (see `measure_throughput`) with
+    the analytic costs as features (see `get_architecture_cost`). Predicts the pretraining time of any network.
+    """
+    def __init__(self, coefficients=None, intercept=0.0, features=None):
+        self.coefficients = coefficients
+        self.intercept = intercept
+        self.features = features if features is not None else COST_FEATURES
+
+    def _get_features(self, costs):
+        return np.array([[c[f] for f in self.features] for c in costs], dtype=np.float64)
+
+    def fit(self, costs, images_per_sec):
+        """
+        Fit the model.
+
+        Args:
+            costs: A list of analytic costs of the measured networks.
+            images_per_sec: Measured training throughputs of the networks.
+
+        Returns: The fitted model.
+
+        """
+        x = self._get_features(costs)
+        y = 1.0 / np.asarray(images_per_sec, dtype=np.float64)
+
+        x = np.concatenate([x, np.ones((len(x), 1))], axis=1)
+        solution, _, _, _ = np.linalg.lstsq(x, y, rcond=None)
+
+        self.coefficients = solution[:-1].tolist()
+        self.intercept = float(solution[-1])
+        return self
+
+    def predict_time_per_image(self, costs):
+        """
+        Predict the training time per image (seconds) for a list of analytic costs.
+        """
+        if self.coefficients is None:
+            raise ValueError("The cost model is not fitted.")
+
+        # the linear model can extrapolate to negative times
+        return np.maximum(self._get_features(costs) @ np.array(self.coefficients) + self.intercept, 0.0)
+
+    def predict_pretrain_time(self, costs, n_train, num_epochs, n_eval=0):
+        """
+        Predict the pretraining time (seconds).
+
+        Args:
+            costs: A list of analytic costs of the networks.
+            n_train: Number of training images.
+            num_epochs: Number of training epochs.
+            n_eval: Number of validation images evaluated every epoch (and test images evaluated at the end),
+                evaluation is approximated as a third of a training step.
+
+        Returns: Predicted pretraining times.
+
+        """
+        time_per_image = self.predict_time_per_image(costs)
+        return time_per_image * num_epochs * (n_train + n_eval / 3)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'coefficients': self.coefficients, 'intercept': self.intercept, 'features': self.features},
+                      f, indent='    ')
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as f:
+            return PretrainCostModel(**json.load(f))
@@ -1,13 +1,24 @@
+import os
+import random
+import traceback
 from datetime import datetime
 from typing import List
 
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+
 from nasbench_pytorch.model import Network as NBNetwork
 from nasbench_pytorch.trainer import train, test
-from info_nas.datasets.networks.utils import get_net_from_hash, save_trained_net, is_net_pretrained
+from info_nas.datasets.networks.utils import get_net_from_hash, save_trained_net, is_net_pretrained, \
+    save_training_state, load_training_state, remove_training_state, set_rng_state
+from info_nas.datasets.networks.work_queue import PretrainQueue, get_worker_id
+from info_nas.datasets.cifar import prepare_shared_dataset, prepare_batched_dataset
 
 
 def pretrain_network_dataset(net_hashes: List[str], nasbench, dataset, device=None, num_epochs=10, num_labels=10,
-                             dir_path='./checkpoints/', skip_existing=True, **kwargs):
+                             dir_path='./checkpoints/', skip_existing=True, group_size=1, **kwargs):
     """
     Pretrain networks from the NAS-Bench-101 dataset according to a list of their hashes. Store their checkpoints.
 
@@ -22,34 +33,377 @@ def pretrain_network_dataset(net_hashes: List[str], nasbench, dataset, device=No
         num_labels: Number of labels for the classification.
         dir_path: Path where the checkpoints will be saved to.
         skip_existing: Skip networks that exists in the directory.
+        group_size: Number of networks that are trained together on the same batches (see
+            `pretrain_networks_shared_batches`), the data is loaded and augmented once per group.
+
         **kwargs: Additional kwargs for the training.
 
     """
 
-    train_set, n_train, val_set, n_val, test_set, n_test = dataset
-
     net_hashes = [n for n in net_hashes if not (skip_existing and is_net_pretrained(n, dir_path=dir_path))]
     print(f"Pretraining {len(net_hashes)} network{'s' if len(net_hashes) > 1 else ''}.\n----------------------------\n")
 
+    if group_size > 1:
+        for i in range(0, len(net_hashes), group_size):
+            group = net_hashes[i:i + group_size]
+
+            print('--------------------')
+            print(f"Pretraining networks {i + 1}-{i + len(group)}/{len(net_hashes)}: {group}.")
+            print(datetime.now().strftime("%d/%m/%Y %H:%M:%S\n--------------------"))
+
+            _pretrain_group(group, nasbench, dataset, device=device, num_epochs=num_epochs, num_labels=num_labels,
+                            dir_path=dir_path, **kwargs)
+        return
+
     for i, net_hash in enumerate(net_hashes):
         print('--------------------')
         print(f"Pretraining network {i + 1}/{len(net_hashes)}: {net_hash}.")
         now = datetime.now()
         print(now.strftime("%d/%m/%Y %H:%M:%S\n--------------------"))
 
-        # function for periodic checkpointing
-        def periodic_checkpoint(network, metric_dict):
-            save_trained_net(net_hash, network, info=metric_dict, net_args=[num_labels], dir_path=dir_path)
+        _pretrain_hash(net_hash, nasbench, dataset, device=device, num_epochs=num_epochs, num_labels=num_labels,
+                       dir_path=dir_path, **kwargs)
+
+
+def pretrain_from_queue(queue: PretrainQueue, nasbench, dataset, device=None, num_epochs=10, num_labels=10,
+                        dir_path='./checkpoints/', skip_existing=True, worker_id=None, **kwargs):
+    """
+    Pretrain networks pulled from a work queue until the queue is empty. Many workers can share the same queue and
+    checkpoint directory.
+
+    Args:
+        queue: The work queue with network hashes (see `info_nas.datasets.networks.work_queue.PretrainQueue`).
+        nasbench: An instance of nasbench.api.NASBench(nb_path).
+        dataset: Dataset to use for the training (see `pretrain_network_dataset`).
+        device: Device to use for the training.
+        num_epochs: Number of training epochs.
+        num_labels: Number of labels for the classification.
+        dir_path: Path where the checkpoints will be saved to.
+        skip_existing: Mark networks that exist in the directory as done without training.
+        worker_id: Id of the worker, by default host name and process id.
+        **kwargs: Additional kwargs for the training.
+
+    Returns: Number of networks trained by this worker.
+
+    """
+    worker_id = worker_id if worker_id is not None else get_worker_id()
+    n_trained = 0
+
+    while True:
+        net_hash = queue.acquire(worker_id)
+        if net_hash is None:
+            break
+
+        if skip_existing and is_net_pretrained(net_hash, dir_path=dir_path):
+            queue.complete(net_hash, worker_id)
+            continue
+
+        print('--------------------')
+        print(f"Worker {worker_id} pretraining network {net_hash}.")
+        print(datetime.now().strftime("%d/%m/%Y %H:%M:%S\n--------------------"))
+
+        try:
+            with queue.heartbeat(net_hash, worker_id):
+                _pretrain_hash(net_hash, nasbench, dataset, device=device, num_epochs=num_epochs,
+                               num_labels=num_labels, dir_path=dir_path, **kwargs)
+        except Exception:
+            # the network is retried later (possibly by another worker)
+            traceback.print_exc()
+            queue.fail(net_hash, worker_id, error=traceback.format_exc())
+            continue
+
+        queue.complete(net_hash, worker_id)
+        n_trained += 1
+
+        progress = queue.progress()
+        print(f"Queue progress: {progress['done']}/{sum(progress.values())} done, {progress['running']} running, "
+              f"{progress['failed']} failed.")
+
+    return n_trained
+
+
+def pretrain_network_dataset_parallel(net_hashes: List[str], nasbench, shared_cifar, n_workers=2,
+                                      cores_per_worker=None, dataset_kwargs=None, batched_augment=False, seed=1,
+                                      device=None, num_epochs=10, num_labels=10, dir_path='./checkpoints/',
+                                      skip_existing=True, group_size=1, **kwargs):
+    """
+    Pretrain networks in `n_workers` processes at once. Every worker is pinned to a disjoint set of cpu cores and
+    uses one torch thread per core. The workers share one decoded copy of CIFAR-10 (see
+    `info_nas.datasets.cifar.load_shared_cifar`), the checkpoints are the same as in `pretrain_network_dataset`.
+
+    Args:
+        net_hashes: A list of net hashes that should be trained.
+        nasbench: An instance of nasbench.api.NASBench(nb_path).
+        shared_cifar: The shared CIFAR-10 tensors.
+        n_workers: Number of worker processes.
+        cores_per_worker: Number of cores per worker, by default the available cores are divided evenly.
+        dataset_kwargs: Kwargs for `info_nas.datasets.cifar.prepare_shared_dataset` (e.g. batch_size).
+        batched_augment: If True, augment whole batches with tensor operations (see
+            `info_nas.datasets.cifar.prepare_batched_dataset`).
+
+        seed: The random seed, set before the training of every network (the results do not depend on the worker).
+        device: Device to use for the training.
+        num_epochs: Number of training epochs.
+        num_labels: Number of labels for the classification.
+        dir_path: Path where the checkpoints will be saved to.
+        skip_existing: Skip networks that exists in the directory.
+        group_size: Number of networks that are trained together on the same batches in one worker (see
+            `pretrain_networks_shared_batches`).
+
+        **kwargs: Additional kwargs for the training.
+
+    """
+    net_hashes = [n for n in net_hashes if not (skip_existing and is_net_pretrained(n, dir_path=dir_path))]
+    print(f"Pretraining {len(net_hashes)} network{'s' if len(net_hashes) > 1 else ''} "
+          f"in {n_workers} processes.\n----------------------------\n")
+
+    # nasbench is not passed to the workers, one task is a group of networks
+    archs = [get_net_from_hash(net_hash, nasbench) for net_hash in net_hashes]
+    tasks = [(net_hashes[i:i + group_size], archs[i:i + group_size]) for i in range(0, len(net_hashes), group_size)]
+    core_sets = _get_core_sets(n_workers, cores_per_worker=cores_per_worker)
+
+    ctx = mp.get_context('spawn')
+    task_queue = ctx.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(n_workers):
+        task_queue.put(None)
+
+    train_kwargs = dict(device=device, num_epochs=num_epochs, num_labels=num_labels, dir_path=dir_path, **kwargs)
+    dataset_kwargs = dataset_kwargs if dataset_kwargs is not None else {}
+
+    workers = [ctx.Process(target=_pretrain_worker, args=(i, cores, task_queue, shared_cifar, dataset_kwargs,
+                                                          batched_augment, seed, train_kwargs))
+               for i, cores in enumerate(core_sets)]
+
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    failed = [i for i, w in enumerate(workers) if w.exitcode != 0]
+    if len(failed):
+        raise RuntimeError(f"Pretraining workers {failed} failed.")
+
+
+def _get_core_sets(n_workers, cores_per_worker=None):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+    cores_per_worker = cores_per_worker if cores_per_worker is not None else len(cores) // n_workers
+    if cores_per_worker < 1 or cores_per_worker * n_workers > len(cores):
+        raise ValueError(f"Cannot assign {cores_per_worker} cores to each of {n_workers} workers, "
+                         f"{len(cores)} cores are available.")
+
+    return [cores[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(n_workers)]
+
+
+def _pretrain_worker(worker_id, cores, task_queue, shared_cifar, dataset_kwargs, batched_augment, seed, train_kwargs):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    _set_seed(seed)
+    if batched_augment:
+        dataset = prepare_batched_dataset(shared_cifar, random_state=seed, device=train_kwargs['device'],
+                                          **dataset_kwargs)
+    else:
+        dataset = prepare_shared_dataset(shared_cifar, random_state=seed, **dataset_kwargs)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        net_hashes, archs = task
+
+        print('--------------------')
+        print(f"Worker {worker_id} (cores {cores}) pretraining network{'s' if len(net_hashes) > 1 else ''} "
+              f"{', '.join(net_hashes)}.")
+        print(datetime.now().strftime("%d/%m/%Y %H:%M:%S\n--------------------"))
+
+        _set_seed(seed)
+        _pretrain_archs(net_hashes, archs, dataset, **train_kwargs)
+
+
+def _set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _pretrain_hash(net_hash, nasbench, dataset, **kwargs):
+    ops, adjacency = get_net_from_hash(net_hash, nasbench)
+    _pretrain_net(net_hash, ops, adjacency, dataset, **kwargs)
+
+
+def _pretrain_net(net_hash, ops, adjacency, dataset, **kwargs):
+    _pretrain_archs([net_hash], [(ops, adjacency)], dataset, **kwargs)
+
+
+def _pretrain_group(net_hashes, nasbench, dataset, **kwargs):
+    archs = [get_net_from_hash(net_hash, nasbench) for net_hash in net_hashes]
+    _pretrain_archs(net_hashes, archs, dataset, **kwargs)
+
+
+def _pretrain_archs(net_hashes, archs, dataset, device=None, num_epochs=10, num_labels=10, dir_path='./checkpoints/',
+                    save_every_k=None, **kwargs):
+    # single networks are trained as a group of one, so that checkpointing does not change the training
+    train_set, n_train, val_set, n_val, test_set, n_test = dataset
+
+    nets = [NBNetwork((adjacency, ops), num_labels).to(device) for ops, adjacency in archs]
+
+    start_states = None
+    if save_every_k is not None:
+        # save the training state every k epochs, resume from the last saved state
+        start_states = [load_training_state(net_hash, dir_path=dir_path, device=device) for net_hash in net_hashes]
+        for net_hash, state in zip(net_hashes, start_states):
+            if state is not None:
+                print(f"Resuming the training of {net_hash} from epoch {state['epoch']}.")
+
+    nets, metrics = pretrain_networks_shared_batches(nets, train_set, val_set, test_set, num_tests=n_test,
+                                                     num_epochs=num_epochs, device=device, save_every_k=save_every_k,
+                                                     checkpoint_func=_get_state_checkpoint(net_hashes, dir_path),
+                                                     start_states=start_states, **kwargs)
+
+    for net_hash, net, net_metrics in zip(net_hashes, nets, metrics):
+        save_trained_net(net_hash, net, info=net_metrics, net_args=[num_labels], dir_path=dir_path)
+        remove_training_state(net_hash, dir_path=dir_path)
+
+
+def _get_state_checkpoint(net_hashes, dir_path):
+    def save_state(i, net, optimizer, scheduler, epoch, metrics):
+        save_training_state(net_hashes[i], net, optimizer, scheduler, epoch, info=metrics, dir_path=dir_path)
+
+    return save_state
+
+
+def pretrain_networks_shared_batches(nets, train_loader, valid_loader, test_loader, num_tests=None, num_epochs=108,
+                                     device=None, print_frequency=50, loss=None, optimizer=None, grad_clip=5,
+                                     save_every_k=None, checkpoint_func=None, start_states=None):
+    """
+    Train a group of networks on the same batches - every network takes an optimizer step on each augmented batch,
+    so the data is loaded and augmented only once for the whole group. The networks have separate optimizers,
+    schedulers and metrics, the metrics have the same format as in `pretrain_network_cifar` (per-epoch train and
+    validation metrics, final test metrics).
+
+    Args:
+        nets: The networks to train.
+        train_loader: Train data loader.
+        valid_loader: Validation data loader.
+        test_loader: Test data loader.
+        num_tests: Number of test examples.
+        num_epochs: Number of training epochs.
+        device: Device to use for the training.
+        print_frequency: How often to print the batch metrics.
+        loss: Loss, default is CrossEntropyLoss.
+        optimizer: Optimizer name, 'sgd', 'rmsprop' (default) or 'adam'.
+        grad_clip: Gradient clipping parameter.
+        save_every_k: Call `checkpoint_func` every k epochs.
+        checkpoint_func: Function that saves the training state, signature:
+            func(net index, net, optimizer, scheduler, number of finished epochs, metric dict).
+
+        start_states: A list of saved training states to resume from (one per network, None for networks trained
+            from scratch), see `info_nas.datasets.networks.utils.save_training_state`. The random generators are
+            restored from the state of the first resumed epoch, so that the batches are the same as in an
+            uninterrupted run.
+
+    Returns: The trained networks and a list of metric dicts (one per network).
+
+    """
+    loss = loss if loss is not None else nn.CrossEntropyLoss()
+
+    optimizers = [_get_optimizer(net, optimizer) for net in nets]
+    schedulers = [torch.optim.lr_scheduler.CosineAnnealingLR(opt, num_epochs) for opt in optimizers]
+
+    n_batches = len(train_loader)
+    metrics = [{'train_loss': [], 'train_accuracy': [], 'val_loss': [], 'val_accuracy': []} for _ in nets]
+    start_epochs = [0 for _ in nets]
+
+    start_states = start_states if start_states is not None else [None for _ in nets]
+    for i, state in enumerate(start_states):
+        if state is None:
+            continue
+
+        nets[i].load_state_dict(state['model_state_dict'])
+        optimizers[i].load_state_dict(state['optimizer_state_dict'])
+        schedulers[i].load_state_dict(state['scheduler_state_dict'])
+        start_epochs[i] = state['epoch']
+        metrics[i] = state['info']
+
+    # continue with the same random generator state as the uninterrupted training
+    resume_states = [state for state in start_states if state is not None and state['epoch'] == min(start_epochs)]
+    if len(resume_states):
+        set_rng_state(resume_states[0]['rng_state'])
+
+    for epoch in range(min(start_epochs), num_epochs):
+        # networks resumed from a later epoch wait for the others
+        active = [i for i in range(len(nets)) if start_epochs[i] <= epoch]
+
+        for i in active:
+            nets[i].train()
+
+        train_loss = torch.zeros(len(nets))
+        correct = torch.zeros(len(nets), dtype=torch.long)
+        total = 0
+
+        batch_idx = 0
+        for batch_idx, (inputs, targets) in enumerate(train_loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            total += targets.size(0)
+
+            for i in active:
+                net, opt = nets[i], optimizers[i]
+                outputs = net(inputs)
+
+                opt.zero_grad()
+                curr_loss = loss(outputs, targets)
+                curr_loss.backward()
+                if grad_clip is not None:
+                    nn.utils.clip_grad_norm_(net.parameters(), grad_clip)
+                opt.step()
+
+                train_loss[i] += curr_loss.detach().cpu()
+                correct[i] += outputs.detach().argmax(dim=1).eq(targets).sum().cpu()
+
+            if (batch_idx % print_frequency) == 0:
+                print(f'Epoch={epoch}/{num_epochs} Batch={batch_idx + 1}/{n_batches} | '
+                      f'Loss={(train_loss[active] / (batch_idx + 1)).tolist()}, '
+                      f'Acc={(correct[active] / total).tolist()}')
+
+        for i in active:
+            metrics[i]['train_loss'].append((train_loss[i] / (batch_idx + 1)).item())
+            metrics[i]['train_accuracy'].append((correct[i] / total).item())
+
+            if valid_loader is not None:
+                val_loss, val_acc = test(nets[i], valid_loader)
+                metrics[i]['val_loss'].append(val_loss)
+                metrics[i]['val_accuracy'].append(val_acc)
+
+            schedulers[i].step()
+
+        print('--------------------')
+
+        finished = epoch + 1
+        if save_every_k is not None and finished % save_every_k == 0 and finished < num_epochs:
+            for i in active:
+                checkpoint_func(i, nets[i], optimizers[i], schedulers[i], finished, metrics[i])
+
+    for i, net in enumerate(nets):
+        metrics[i]['test_loss'], metrics[i]['test_accuracy'] = test(net, test_loader, num_tests=num_tests)
+
+    return nets, metrics
 
-        ops, adjacency = get_net_from_hash(net_hash, nasbench)
-        net = NBNetwork((adjacency, ops), num_labels)
 
-        # train net and save it
-        net = net.to(device)
-        net, metrics = pretrain_network_cifar(net, train_set, val_set, test_set, n_labels=num_labels,
-                                              num_tests=n_test, num_epochs=num_epochs, device=device, **kwargs)
+def _get_optimizer(net, optimizer):
+    # the same defaults as in nasbench_pytorch.trainer.train
+    if optimizer is None or optimizer.lower() == 'rmsprop':
+        return torch.optim.RMSprop(net.parameters(), lr=0.2, momentum=0.9, weight_decay=1e-4, eps=1.0)
+    if optimizer.lower() == 'sgd':
+        return torch.optim.SGD(net.parameters(), lr=0.025, momentum=0.9, weight_decay=1e-4)
+    if optimizer.lower() == 'adam':
+        return torch.optim.Adam(net.parameters())
 
-        periodic_checkpoint(net, metrics)
+    raise ValueError(f"Invalid optimizer: {optimizer}, possible values are ['sgd', 'rmsprop', 'adam'].")
 
 
 def pretrain_network_cifar(net, train_loader, valid_loader, test_loader, num_tests=None, num_epochs=108, device=None,
@@ -1,4 +1,10 @@
+import itertools
 import os
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
 import torch
 from nasbench import api
 from nasbench_pytorch.model import Network as NBNetwork
@@ -43,8 +49,8 @@ def is_net_pretrained(net_hash, dir_path='./checkpoints/'):
 
 
 def save_trained_net(net_hash, net, dir_path='./checkpoints/', info=None, net_args=None, net_kwargs=None):
-    if not os.path.exists(dir_path):
-        os.mkdir(dir_path)
+    # the directory can be shared by multiple workers
+    os.makedirs(dir_path, exist_ok=True)
 
     checkpoint_dict = {
         'hash': net_hash,
@@ -54,7 +60,85 @@ def save_trained_net(net_hash, net, dir_path='./checkpoints/', info=None, net_ar
         'info': info
     }
 
-    torch.save(checkpoint_dict, os.path.join(dir_path, f'{net_hash}.tar'))
+    _save_replace(checkpoint_dict, os.path.join(dir_path, f'{net_hash}.tar'))
+
+
+def _save_replace(obj, save_path):
+    # write to a temporary file first, so that an interrupted save does not leave a partial checkpoint
+    tmp_path = f'{save_path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, save_path)
+
+
+def get_training_state_path(net_hash, dir_path='./checkpoints/'):
+    """
+    Get the path of the mid-training checkpoint of a network (it is not listed as a trained network, see
+    `is_net_pretrained`).
+    """
+    return os.path.join(dir_path, f'{net_hash}.partial.pt')
+
+
+def save_training_state(net_hash, net, optimizer, scheduler, epoch, info=None, dir_path='./checkpoints/'):
+    """
+    Save a mid-training checkpoint, so that the training can be resumed after a crash.
+
+    Args:
+        net_hash: Hash of the network.
+        net: The network.
+        optimizer: The optimizer of the network.
+        scheduler: The learning rate scheduler.
+        epoch: Number of finished epochs.
+        info: Metrics of the finished epochs.
+        dir_path: Checkpoint directory.
+
+    """
+    os.makedirs(dir_path, exist_ok=True)
+
+    state = {
+        'hash': net_hash,
+        'epoch': epoch,
+        'model_state_dict': net.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'info': info,
+        'rng_state': {
+            'torch': torch.get_rng_state(),
+            'numpy': np.random.get_state(),
+            'random': random.getstate()
+        }
+    }
+
+    _save_replace(state, get_training_state_path(net_hash, dir_path=dir_path))
+
+
+def load_training_state(net_hash, dir_path='./checkpoints/', device=None):
+    """
+    Load the mid-training checkpoint of a network.
+
+    Returns: The saved state (see `save_training_state`), or None if there is no checkpoint.
+
+    """
+    state_path = get_training_state_path(net_hash, dir_path=dir_path)
+    if not os.path.exists(state_path):
+        return None
+
+    return torch.load(state_path, map_location=device)
+
+
+def set_rng_state(rng_state):
+    """
+    Restore the random generators from a mid-training checkpoint (the data order continues as if the training was
+    not interrupted).
+    """
+    torch.set_rng_state(rng_state['torch'])
+    np.random.set_state(rng_state['numpy'])
+    random.setstate(rng_state['random'])
+
+
+def remove_training_state(net_hash, dir_path='./checkpoints/'):
+    state_path = get_training_state_path(net_hash, dir_path=dir_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
 
 
 def load_trained_net(net_path, nasbench, device=None):
@@ -73,3 +157,68 @@ def load_trained_net(net_path, nasbench, device=None):
     net = net.to(device)
 
     return checkpoint['hash'], net, checkpoint['info']
+
+
+_worker_nasbench = None
+
+
+def _init_load_worker(nasbench):
+    global _worker_nasbench
+    _worker_nasbench = nasbench
+
+
+def _load_in_worker(net_path):
+    return load_trained_net(net_path, _worker_nasbench, device=torch.device('cpu'))
+
+
+def load_trained_nets(net_paths, nasbench, device=None, n_workers=0, prefetch_depth=4, use_processes=False):
+    """
+    Load trained networks one by one (in the order of `net_paths`). If `n_workers` > 0, the next `prefetch_depth`
+    checkpoints are loaded in a thread (or process) pool while the current network is being used.
+
+    Args:
+        net_paths: Paths to the network checkpoints.
+        nasbench: An instance of nasbench.api.NASBench(nb_path).
+        device: Device for the loaded networks.
+        n_workers: Number of loading workers, if 0, the networks are loaded in the current thread.
+        prefetch_depth: Maximum number of checkpoints that are loaded in advance.
+        use_processes: If True, use a process pool instead of a thread pool (nasbench must be picklable). The
+            networks are loaded to cpu in the workers and moved to `device` afterwards.
+
+    Returns: A generator of loaded networks in the same format as `load_trained_net`.
+
+    """
+    if n_workers == 0:
+        for net_path in net_paths:
+            yield load_trained_net(net_path, nasbench, device=device)
+
+        return
+
+    assert prefetch_depth > 0, "Prefetch depth must be positive."
+
+    if use_processes:
+        executor = ProcessPoolExecutor(n_workers, initializer=_init_load_worker, initargs=(nasbench,))
+        load_func = _load_in_worker
+    else:
+        executor = ThreadPoolExecutor(n_workers)
+
+        def load_func(net_path):
+            return load_trained_net(net_path, nasbench, device=device)
+
+    net_paths = iter(net_paths)
+
+    with executor:
+        futures = deque(executor.submit(load_func, p) for p in itertools.islice(net_paths, prefetch_depth))
+
+        while len(futures):
+            net_hash, net, info = futures.popleft().result()
+
+            # keep the queue full
+            next_path = next(net_paths, None)
+            if next_path is not None:
+                futures.append(executor.submit(load_func, next_path))
+
+            if use_processes:
+                net = net.to(device)
+
+            yield net_hash, net, info
@@ -0,0 +1,220 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_worker_id():
+    """
+    Get a unique id of the current worker process (host name and process id).
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class PretrainQueue:
+    """
+    A work queue of network hashes for pretraining, stored in a SQLite database. Many worker processes (possibly on
+    several nodes sharing the database file) pull hashes from the queue, so that slow architectures do not block
+    the other workers.
+
+    A pulled hash is leased to the worker for `lease_timeout` seconds (the lease is renewed while the network is
+    trained, see `heartbeat`). If the worker crashes, the lease expires and the hash is returned to the other workers.
+    Failed networks (and networks with an expired lease) are retried until they fail `max_attempts` times.
+
+    Note that SQLite locking may be unreliable on some network file systems (e.g. older NFS).
+    """
+    def __init__(self, db_path: str, lease_timeout=600, max_attempts=3, timeout=60):
+        """
+        Initializes the queue, creates the database if it does not exist.
+
+        Args:
+            db_path: Path to the SQLite database.
+            lease_timeout: Number of seconds after which an unrenewed lease expires.
+            max_attempts: Maximum number of training attempts per network.
+            timeout: Number of seconds to wait for a database lock.
+        """
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    net_hash TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    updated REAL
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        # a new connection per operation - the queue can be used from multiple threads and processes
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def add(self, net_hashes: List[str]):
+        """
+        Add hashes to the queue, hashes that are already in the queue are skipped.
+
+        Args:
+            net_hashes: The hashes to add.
+
+        Returns: Number of added hashes.
+
+        """
+        now = time.time()
+        with self._connect() as conn:
+            n_before = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.executemany("INSERT OR IGNORE INTO tasks (net_hash, status, updated) VALUES (?, ?, ?)",
+                             [(h, PENDING, now) for h in net_hashes])
+            n_after = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+        return n_after - n_before
+
+    def acquire(self, worker_id: str):
+        """
+        Lease the next pending hash (or a hash with an expired lease) to the worker.
+
+        Args:
+            worker_id: Id of the worker (see `get_worker_id`).
+
+        Returns: The leased hash, or None if there is no hash available.
+
+        """
+        now = time.time()
+        with self._connect() as conn:
+            self._fail_expired(conn, now)
+
+            row = conn.execute("""
+                SELECT net_hash FROM tasks
+                WHERE attempts < ? AND (status = ? OR (status = ? AND lease_expires < ?))
+                ORDER BY attempts, rowid LIMIT 1
+            """, (self.max_attempts, PENDING, RUNNING, now)).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute("""
+                UPDATE tasks SET status = ?, attempts = attempts + 1, worker = ?, lease_expires = ?, updated = ?
+                WHERE net_hash = ?
+            """, (RUNNING, worker_id, now + self.lease_timeout, now, row[0]))
+
+        return row[0]
+
+    def _fail_expired(self, conn, now):
+        # the worker was lost during the last attempt (e.g. killed), the hash would stay running forever
+        conn.execute("""
+            UPDATE tasks SET status = ?, lease_expires = NULL, error = ?, updated = ?
+            WHERE status = ? AND lease_expires < ? AND attempts >= ?
+        """, (FAILED, "The lease expired during the last attempt.", now, RUNNING, now, self.max_attempts))
+
+    def renew(self, net_hash: str, worker_id: str):
+        """
+        Renew the lease of a hash.
+
+        Returns: False if the lease was lost (e.g. it expired and was taken by another worker).
+
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute("""
+                UPDATE tasks SET lease_expires = ?, updated = ? WHERE net_hash = ? AND worker = ? AND status = ?
+            """, (now + self.lease_timeout, now, net_hash, worker_id, RUNNING))
+
+        return cursor.rowcount > 0
+
+    def complete(self, net_hash: str, worker_id: str = None):
+        """
+        Mark the hash as done.
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE tasks SET status = ?, worker = ?, lease_expires = NULL, updated = ? WHERE net_hash = ?",
+                         (DONE, worker_id, time.time(), net_hash))
+
+    def fail(self, net_hash: str, worker_id: str, error: str = None):
+        """
+        Release a hash after a failed attempt. It is retried later, or marked as failed after `max_attempts`.
+        """
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, lease_expires = NULL, error = ?,
+                    updated = ?
+                WHERE net_hash = ? AND worker = ?
+            """, (self.max_attempts, PENDING, FAILED, error, time.time(), net_hash, worker_id))
+
+    def progress(self):
+        """
+        Get the number of hashes per status.
+
+        Returns: A dict {status: count} (status is 'pending', 'running', 'done' or 'failed').
+
+        """
+        with self._connect() as conn:
+            self._fail_expired(conn, time.time())
+            rows = conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+
+        counts = {status: 0 for status in [PENDING, RUNNING, DONE, FAILED]}
+        counts.update(dict(rows))
+        return counts
+
+    def get_failed(self):
+        """
+        Get the failed hashes and the last error.
+
+        Returns: A list of tuples (net_hash, error).
+
+        """
+        with self._connect() as conn:
+            self._fail_expired(conn, time.time())
+            return conn.execute("SELECT net_hash, error FROM tasks WHERE status = ?", (FAILED,)).fetchall()
+
+    @contextmanager
+    def heartbeat(self, net_hash: str, worker_id: str, interval=None):
+        """
+        Renew the lease of a hash periodically in a background thread (while the network is trained).
+
+        Args:
+            net_hash: The leased hash.
+            worker_id: Id of the worker.
+            interval: Number of seconds between renewals, by default a third of the lease timeout.
+        """
+        interval = interval if interval is not None else self.lease_timeout / 3
+        stop = threading.Event()
+
+        def renew_lease():
+            while not stop.wait(interval):
+                if not self.renew(net_hash, worker_id):
+                    print(f"Lost the lease of {net_hash}.")
+                    return
+
+        thread = threading.Thread(target=renew_lease, daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
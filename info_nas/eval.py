@@ -33,7 +33,7 @@ def eval_vae_validation(mod, valid_set, res_dict, device, config, verbose=2):
 
 
 def eval_labeled_validation(model, validation, device, config, model_config, loss_labeled, return_all_metrics=False,
-                            nasbench=None):
+                            nasbench=None, net_hashes=None):
     if isinstance(validation, dict):
         if return_all_metrics:
             raise ValueError("Can return only summary metrics for multiple validation sets.")
@@ -43,7 +43,7 @@ def eval_labeled_validation(model, validation, device, config, model_config, los
 
         for val_name, val_set in validation.items():
             metrics = _eval_labeled_validation(model, val_set, device, config, model_config, loss_labeled,
-                                               nasbench=nasbench)
+                                               nasbench=nasbench, net_hashes=net_hashes)
             metrics = {f"{val_name}-{k}": v for k, v in metrics.items()}
             res_dict.update(metrics)
 
@@ -51,11 +51,12 @@ def eval_labeled_validation(model, validation, device, config, model_config, los
     else:
         # there is only one validation set
         return _eval_labeled_validation(model, validation, device, config, model_config, loss_labeled,
-                                        return_all_metrics=return_all_metrics, nasbench=nasbench)
+                                        return_all_metrics=return_all_metrics, nasbench=nasbench,
+                                        net_hashes=net_hashes)
 
 
 def _eval_labeled_validation(model, validation, device, config, model_config, loss_labeled, return_all_metrics=False,
-                             nasbench=None):
+                             nasbench=None, net_hashes=None):
     loss_m = {"val_loss": []}
     metrics = {k: [] for k in metrics_dict.keys()}
     metrics = {**loss_m, **metrics}
@@ -68,7 +69,7 @@ def _eval_labeled_validation(model, validation, device, config, model_config, lo
             adj, ops = adj.to(device), ops.to(device)
             model_out = model(ops, adj)
 
-            outputs = get_hash_accuracy(batch['hash'], nasbench, model_config, device=device)
+            outputs = get_hash_accuracy(batch['net_id'], nasbench, model_config, device=device, net_hashes=net_hashes)
         else:
             adj, ops, inputs, outputs = batch[:4]
             adj, ops = adj.to(device), ops.to(device)
@@ -98,7 +99,7 @@ def _eval_labeled_validation(model, validation, device, config, model_config, lo
 
 def eval_epoch(model, model_labeled, model_reference, metrics_res_dict, Z, losses_total, losses_epoch, epoch, device,
                nasbench, valid_unlabeled, valid_labeled, valid_labeled_orig, config, model_config, loss_labeled,
-               verbose=2):
+               verbose=2, net_hashes=None):
     model.eval()
     model_labeled.eval()
     if model_reference is not None:
@@ -136,7 +137,7 @@ def eval_epoch(model, model_labeled, model_reference, metrics_res_dict, Z, losse
         # labeled only eval
         if m_name == 'labeled':
             val_metrics = eval_labeled_validation(m, valid_labeled, device, config, model_config, loss_labeled,
-                                                  nasbench=nasbench)
+                                                  nasbench=nasbench, net_hashes=net_hashes)
             for val_m_name, val_m_loss in val_metrics.items():
                 _metrics_list(metrics_res_dict[m_name], val_m_name).append(val_m_loss)
                 if verbose > 1:
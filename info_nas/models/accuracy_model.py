@@ -7,7 +7,7 @@ from arch2vec.models.model import VAEReconstructed_Loss
 from arch2vec.extensions.get_nasbench101_model import get_arch2vec_model
 from arch2vec.utils import preprocessing, save_checkpoint_vae
 
-from info_nas.datasets.io.semi_dataset import get_train_valid_datasets
+from info_nas.datasets.io.semi_dataset import get_train_valid_datasets, get_labeled_net_repo
 from info_nas.eval import init_stats_dict, mean_losses, checkpoint_metrics_losses, eval_epoch
 from info_nas.models.layers import LatentNodesFlatten, get_dense_list
 from info_nas.models.utils import get_optimizer, save_extended_vae, get_hash_accuracy
@@ -71,10 +71,11 @@ def train_as_infonas(labeled, unlabeled, nasbench, checkpoint_dir, transforms=No
 
         config, model_config = _init_config_and_seeds(model_config, seed, torch_deterministic, cudnn_deterministic)
 
-        # init dataset
+        # init dataset - batches contain network ids of the shared repository
+        net_repo = get_labeled_net_repo(labeled)
         train_dataset, valid_labeled, valid_labeled_orig, valid_unlabeled = get_train_valid_datasets(
             labeled, unlabeled, batch_size=batch_size, labeled_transforms=transforms, val_batch_size=batch_size,
-            labeled_val_transforms=valid_transforms, **model_config['dataset_config']
+            labeled_val_transforms=valid_transforms, net_repo=net_repo, **model_config['dataset_config']
         )
         dataset_len = len(train_dataset)
         # precompute validation len
@@ -109,9 +110,10 @@ def train_as_infonas(labeled, unlabeled, nasbench, checkpoint_dir, transforms=No
 
             for i, batch in enumerate(train_dataset):
                 if isinstance(batch, dict):
-                    net_hash = batch['hash']
+                    net_ids = batch['net_id']
                     batch = batch['adj'], batch['ops']
-                    batch_acc = get_hash_accuracy(net_hash, nasbench, model_config, device=device)
+                    batch_acc = get_hash_accuracy(net_ids, nasbench, model_config, device=device,
+                                                  net_hashes=net_repo['net_hashes'])
 
                     _train_on_batch(model_labeled, batch, optimizer_labeled, device, config, Z['labeled'],
                                     loss_func_vae, loss_func_labeled, loss_lists_epoch['labeled'],
@@ -134,7 +136,7 @@ def train_as_infonas(labeled, unlabeled, nasbench, checkpoint_dir, transforms=No
             # epoch stats
             eval_epoch(model, model_labeled, None, metrics_total, Z, loss_lists_total, loss_lists_epoch, epoch,
                        device, nasbench, valid_unlabeled, valid_labeled, valid_labeled_orig, config, model_config,
-                       loss_func_labeled, verbose=verbose)
+                       loss_func_labeled, verbose=verbose, net_hashes=net_repo['net_hashes'])
 
             metrics_total['running_time'].append(time.process_time() - start_time)
 
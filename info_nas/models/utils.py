@@ -4,6 +4,7 @@ import numpy as np
 import torch
 from torch import optim
 
+from info_nas.datasets.io.net_ids import decode_net_ids
 from info_nas.models.io_model import model_dict
 
 
@@ -66,7 +67,11 @@ def get_optimizer(model, name='adam', **kwargs):
     return optimizer(model.parameters(), **kwargs)
 
 
-def get_hash_accuracy(hash, nasbench, config, device=None):
+def get_hash_accuracy(hash, nasbench, config, device=None, net_hashes=None):
+    if net_hashes is not None:
+        # network ids of a stacked network repository (see info_nas.datasets.io.net_ids)
+        hash = decode_net_ids(hash, net_hashes)
+
     metrics = [nasbench.get_metrics_from_hash(h)[1] for h in hash]
     config = config['hash_accuracy']
     epoch, time, what = config['epoch'], config['time'], config['what']
@@ -18,6 +18,8 @@ from arch2vec.utils import preprocessing, save_checkpoint_vae
 from arch2vec.models.configs import configs
 
 from info_nas.datasets.io.semi_dataset import get_train_valid_datasets
+from info_nas.datasets.io.reducers import get_reduced_size, get_transformed_size
+from info_nas.datasets.io.sharded import is_sharded
 from info_nas.models.io_model import model_dict
 from info_nas.config import local_model_cfg, load_json_cfg
 from info_nas.models.losses import losses_dict
@@ -74,10 +76,15 @@ def train(labeled, unlabeled, nasbench, checkpoint_dir, transforms=None, valid_t
 
     # init models
     if not labeled['train']['use_reference']:
-        in_channels = labeled['train']['inputs'].shape[1]
+        if is_sharded(labeled['train']):
+            in_channels = labeled['train']['input_shape'][0]
+        else:
+            in_channels = labeled['train']['inputs'].shape[1]
     else:
         in_channels = labeled['train']['dataset'].shape[1]
 
+    _check_out_channels(labeled['train'], model_config)
+
     # init models
     model, optimizer = get_arch2vec_model(device=device)
     model_labeled, optimizer_labeled = _initialize_labeled_model(model, in_channels, device=device,
@@ -176,6 +183,19 @@ def _save_arch2vec_model(model, optimizer, checkpoint_dir, model_type, epoch):
     save_checkpoint_vae(model, optimizer, epoch, None, None, None, None, None, f_path=orig_path)
 
 
+def _check_out_channels(labeled, model_config):
+    # the outputs were reduced during the dataset creation
+    top_k = model_config.get('scale', {}).get('top_k')
+    out_channels = get_transformed_size(labeled, top_k=top_k)
+    if out_channels is None:
+        return
+
+    if model_config['out_channels'] != out_channels:
+        raise ValueError(f"The outputs of the dataset were reduced to {get_reduced_size(labeled)} features (with the "
+                         f"bias and top_k={top_k}), out_channels should be {out_channels} "
+                         f"(is {model_config['out_channels']}).")
+
+
 def _initialize_labeled_model(model, in_channels, model_config=None, device=None):
     model_class = model_dict[model_config['model_class']]
 
@@ -58,7 +58,7 @@ def get_labeled_data(data_pt, nasbench, nb_dataset, input_dataset, top_k=None, k
     data, _ = prepare_labeled_dataset(data_pt, nasbench, device=torch.device('cpu'), key=key,
                                       nb_dataset=nb_dataset, dataset=input_dataset, remove_labeled=False)
 
-    labeled = labeled_network_dataset(data, transforms=transforms, return_ref_id=True)
+    labeled = labeled_network_dataset(data, transforms=transforms, return_ref_id=True, return_hash=True)
     return torch.utils.data.DataLoader(labeled, batch_size=32, shuffle=False, num_workers=4)
 
 
@@ -0,0 +1,60 @@
+import time
+
+import click
+import torch
+
+from info_nas.config import local_dataset_cfg, load_json_cfg
+from info_nas.datasets.cifar import load_shared_cifar, prepare_batched_dataset
+from nasbench_pytorch.datasets.cifar10 import prepare_dataset
+
+
+def measure_images_per_sec(loader, n_batches, device=None):
+    n_images = 0
+    start = time.time()
+
+    for i, (inputs, targets) in enumerate(loader):
+        # include the transfer to the training device
+        inputs, targets = inputs.to(device), targets.to(device)
+        n_images += len(targets)
+
+        if i + 1 == n_batches:
+            break
+
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+    return n_images / (time.time() - start)
+
+
+@click.command()
+@click.option('--config_path', default='../configs/pretrain_config.json')
+@click.option('--root', default='../data/cifar/')
+@click.option('--n_batches', default=200, help='Number of train batches per measurement.')
+@click.option('--n_repeats', default=3)
+@click.option('--device', default='cpu')
+@click.option('--seed', default=1)
+def main(config_path, root, n_batches, n_repeats, device, seed):
+    """
+    Compare the images/sec of the pretraining train loader (per-image transforms in DataLoader workers) and of the
+    batched tensor augmentation.
+    """
+    config = local_dataset_cfg if config_path is None or not len(config_path) else load_json_cfg(config_path)
+    cifar_cfg = config['cifar-10']
+    print(f"Config: {cifar_cfg}, torch threads: {torch.get_num_threads()}")
+
+    torch.manual_seed(seed)
+    train_loader = prepare_dataset(root=root, random_state=seed, **cifar_cfg)[0]
+
+    start = time.time()
+    batched_loader = prepare_batched_dataset(load_shared_cifar(root=root), random_state=seed, device=device,
+                                             **cifar_cfg)[0]
+    print(f"Decoded CIFAR-10 to tensors in {time.time() - start:.2f} s.")
+
+    for name, loader in [('DataLoader', train_loader), ('batched', batched_loader)]:
+        speeds = [measure_images_per_sec(loader, n_batches, device=device) for _ in range(n_repeats)]
+        print(f"{name}: {max(speeds):.0f} images/sec (best of {n_repeats}, "
+              f"all: {', '.join(f'{s:.0f}' for s in speeds)})")
+
+
+if __name__ == "__main__":
+    main()
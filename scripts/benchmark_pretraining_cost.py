@@ -0,0 +1,78 @@
+import multiprocessing
+
+import click
+import numpy as np
+import pandas as pd
+
+from info_nas.datasets.networks.cost_model import get_architecture_cost, measure_throughput, PretrainCostModel
+from info_nas.datasets.networks.utils import get_net_from_hash
+from nasbench import api
+
+
+def measure_in_process(ops, adjacency, **kwargs):
+    # a fresh process per network, so that the peak memory is not shared between networks
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(measure_throughput, (ops, adjacency), kwargs)
+
+
+@click.command()
+@click.argument('hash_csv')
+@click.argument('out_csv')
+@click.option('--nasbench_path', default='../data/nasbench_only108.tfrecord')
+@click.option('--n_hashes', default=50, help='Number of randomly chosen hashes to measure.')
+@click.option('--batch_size', default=128)
+@click.option('--n_batches', default=10)
+@click.option('--device', default='cpu')
+@click.option('--seed', default=1)
+@click.option('--model_path', default=None, help='Path where the fitted cost model is saved (json).')
+@click.option('--predict_csv', default=None, help='Path where the predicted pretraining times of all hashes in '
+                                                  'HASH_CSV are saved.')
+@click.option('--n_train', default=49000, help='Number of training images for the prediction.')
+@click.option('--num_epochs', default=12, help='Number of epochs for the prediction.')
+def main(hash_csv, out_csv, nasbench_path, n_hashes, batch_size, n_batches, device, seed, model_path, predict_csv,
+         n_train, num_epochs):
+    """
+    Measure the training throughput and peak memory of networks from HASH_CSV, save them along with the analytic
+    costs to OUT_CSV and fit a cost model of the pretraining time.
+    """
+    hash_list = pd.read_csv(hash_csv)['hashes'].to_list()
+    nasbench = api.NASBench(nasbench_path)
+
+    rng = np.random.RandomState(seed)
+    measured = rng.choice(hash_list, size=min(n_hashes, len(hash_list)), replace=False)
+
+    rows = []
+    for i, net_hash in enumerate(measured):
+        ops, adjacency = get_net_from_hash(net_hash, nasbench)
+
+        cost = get_architecture_cost(ops, adjacency)
+        speed = measure_in_process(ops, adjacency, batch_size=batch_size, n_batches=n_batches, device=device)
+        rows.append({'hashes': net_hash, **cost, **speed})
+
+        print(f"{i + 1}/{len(measured)} {net_hash}: {speed['images_per_sec']:.1f} images/sec, "
+              f"{speed['peak_memory_mb']:.0f} MB, {cost['macs'] / 1e6:.1f} MMACs, {cost['params'] / 1e6:.2f} M params")
+
+    df = pd.DataFrame(rows)
+    df.to_csv(out_csv, index=False)
+
+    costs = df.to_dict('records')
+    model = PretrainCostModel().fit(costs, df['images_per_sec'])
+
+    measured_time = 1.0 / df['images_per_sec'].to_numpy()
+    rel_error = np.abs(model.predict_time_per_image(costs) - measured_time) / measured_time
+    print(f"Cost model mean relative error (measured networks): {rel_error.mean():.3f}")
+
+    if model_path is not None:
+        model.save(model_path)
+
+    if predict_csv is not None:
+        all_costs = [get_architecture_cost(*get_net_from_hash(h, nasbench)) for h in hash_list]
+        pred_df = pd.DataFrame(all_costs)
+        pred_df.insert(0, 'hashes', hash_list)
+        pred_df['pretrain_time'] = model.predict_pretrain_time(all_costs, n_train, num_epochs)
+        pred_df.to_csv(predict_csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
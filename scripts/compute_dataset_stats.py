@@ -11,6 +11,7 @@ from arch2vec.utils import load_json
 
 from info_nas.datasets.arch2vec_dataset import prepare_labeled_dataset, split_off_valid
 from info_nas.datasets.io.semi_dataset import labeled_network_dataset
+from info_nas.datasets.io.stats import RunningStats
 from info_nas.datasets.io.transforms import get_transforms, get_all_scales, IncludeBias, MultByWeights, SortByWeights, \
     ToTuple
 from info_nas.models.losses import losses_dict
@@ -33,6 +34,9 @@ def main(data_name, dataset, model_cfg, nasbench_path, batch_size, split_ratio,
          use_larger_part):
     """
     Compute the baseline - difference between batches and the mean of a scaled dataset. Output and save stats.
+
+    The output stats and the MSE baseline are computed in one streaming pass (the MSE against the final mean follows
+    from the batch moments). The L1 and Huber losses cannot be derived from the moments, only they need a second pass.
     """
 
     dataset_name = dataset
@@ -51,28 +55,42 @@ def main(data_name, dataset, model_cfg, nasbench_path, batch_size, split_ratio,
     data_loader = get_eval_set(data_name, dataset, nb, transforms, batch_size, split_ratio=split_ratio,
                                use_larger_part=use_larger_part)
 
-    print("Loading output dataset...")
-    out_data = []
+    print("Computing output stats...")
+    stats = RunningStats(axis=0)
+
+    # mean((x - mu)^2) = var + (batch_mean - mu)^2 for every column
+    batch_means, batch_vars = [], []
     for i, item in enumerate(data_loader):
         if i % 10000 == 0:
             print(i)
-        out_data.append(item[3].numpy())
 
-    out_data = np.vstack(out_data)
-    print(out_data.shape)
-    print(np.min(out_data))
-    print(np.max(out_data))
-    print(np.mean(out_data))
+        data = item[3]
+        stats.update(data)
+
+        data = data.double()
+        batch_means.append(data.mean(dim=0))
+        batch_vars.append(data.var(dim=0, unbiased=False))
+
+    stats = stats.get_stats()[None]
+    print((stats['count'], len(stats['mean'])))
+    print(np.min(stats['min']))
+    print(np.max(stats['max']))
+    print(np.mean(stats['mean']))
 
     loss_stats = {k: [] for k in losses_dict.keys() if k != 'weighted'}
 
-    mean_stats = out_data.mean(axis=0)
+    mean_stats = stats['mean']
     print(mean_stats.shape)
+
+    final_mean = torch.as_tensor(mean_stats, dtype=torch.float64)
+    loss_stats['MSE'] = [(var + (mean - final_mean) ** 2).mean().item() for mean, var in zip(batch_means, batch_vars)]
+
     mean_stats = np.tile(mean_stats, (batch_size, 1))
     mean_stats = torch.Tensor(mean_stats)
 
-    losses = {k: v() for k, v in losses_dict.items() if k != 'weighted'}
+    losses = {k: v() for k, v in losses_dict.items() if k not in ['weighted', 'MSE']}
 
+    # second pass - the L1 and Huber losses of every batch against the final mean
     for batch in data_loader:
         data = batch[3]
 
@@ -0,0 +1,44 @@
+import click
+import os
+
+from info_nas.datasets.io.columnar import save_columnar_io_dataset
+from info_nas.datasets.io.create_dataset import load_io_dataset
+from info_nas.datasets.io.encoding import get_encoding, encode_io_dataset, get_encoding_error
+
+
+def _get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+@click.command()
+@click.argument('dataset')
+@click.argument('save_dir')
+@click.option('--output_dtype', default=None, type=click.Choice(['float16', 'bfloat16']),
+              help="Save the outputs in reduced precision.")
+@click.option('--image_dtype', default=None, type=click.Choice(['uint8']),
+              help="Save the reference images as pixel values, the normalization is applied on load.")
+@click.option('--compression', default=None, type=click.Choice(['gzip', 'bz2', 'lzma']),
+              help="Compress the columns (compressed columns are not memory-mapped).")
+def main(dataset, save_dir, output_dtype, image_dtype, compression):
+    """
+    Convert a saved IO dataset (.pt) to the memory-mapped columnar format, optionally with a storage encoding.
+    """
+    data = load_io_dataset(dataset)
+
+    encoding = get_encoding(output_dtype=output_dtype, image_dtype=image_dtype)
+    encoded = encode_io_dataset(data, encoding)
+    save_columnar_io_dataset(encoded, save_dir, compression=compression)
+
+    print(f"Size: {_get_size(dataset) / 2 ** 20:.1f} MB -> {_get_size(save_dir) / 2 ** 20:.1f} MB")
+
+    if encoding is not None:
+        # the precision cost of the encoding
+        for column, stats in get_encoding_error(data, encoded).items():
+            print(f"Round-trip error of '{column}': " + ', '.join(f"{k} = {v:.3g}" for k, v in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
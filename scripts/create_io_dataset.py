@@ -7,7 +7,7 @@ import pandas as pd
 import torch
 
 from info_nas.config import local_dataset_cfg, load_json_cfg
-from info_nas.datasets.io.create_dataset import dataset_from_pretrained
+from info_nas.datasets.io.create_dataset import dataset_from_pretrained, append_to_io_dataset
 from info_nas.datasets.networks.pretrained import pretrain_network_dataset
 from nasbench import api
 from nasbench_pytorch.datasets.cifar10 import prepare_dataset
@@ -24,7 +24,25 @@ from scripts.utils import mkdir_if_not_exists
 @click.option('--device', default='cuda')
 @click.option('--use_test_data/--use_validation_data', default=False, is_flag=True,
               help="If True, use cifar test data instead of validation.")
-def main(train_paths, save_path, nasbench_path, config_path, dataset, seed, device, use_test_data):
+@click.option('--shard_size', default=None, type=int,
+              help="If set, save_path is a directory where shards of shard_size networks are written.")
+@click.option('--columnar/--single_file', default=False,
+              help="If True, save_path is a directory where the dataset is saved in a memory-mapped columnar format.")
+@click.option('--append/--overwrite', default=False,
+              help="If True and save_path exists, add only networks that are not in the dataset yet.")
+@click.option('--resume/--no_resume', default=False,
+              help="If True, save the progress periodically and continue an interrupted run.")
+@click.option('--progress_every', default=50, help="Number of networks between progress saves.")
+@click.option('--group_size', default=1, help="Number of networks that are evaluated together on every batch.")
+@click.option('--n_threads', default=1, help="Number of threads that evaluate the networks of a group.")
+@click.option('--output_dtype', default=None, type=click.Choice(['float16', 'bfloat16']),
+              help="Save the outputs in reduced precision.")
+@click.option('--image_dtype', default=None, type=click.Choice(['uint8']),
+              help="Save the reference images as pixel values, the normalization is applied on load.")
+@click.option('--compression', default=None, type=click.Choice(['gzip', 'bz2', 'lzma']),
+              help="Compress the columns of the columnar format.")
+def main(train_paths, save_path, nasbench_path, config_path, dataset, seed, device, use_test_data, shard_size,
+         columnar, append, resume, progress_every, group_size, n_threads, output_dtype, image_dtype, compression):
     device = torch.device(device)
 
     # load datasets
@@ -39,11 +57,21 @@ def main(train_paths, save_path, nasbench_path, config_path, dataset, seed, devi
     else:
         config = load_json_cfg(config_path)
 
-    dataset = prepare_dataset(root=dataset, random_state=seed, no_valid_transform=False, **config['cifar-10'])
     train_paths = train_paths.split(',')
 
+    if append and os.path.exists(save_path):
+        batch_size = config['cifar-10']['batch_size']
+        append_to_io_dataset(save_path, train_paths, nb, device=device, batch_size=batch_size,
+                             shard_size=shard_size if shard_size is not None else 100, group_size=group_size,
+                             n_threads=n_threads, **config['io'])
+        return
+
+    dataset = prepare_dataset(root=dataset, random_state=seed, no_valid_transform=False, **config['cifar-10'])
+
     dataset_from_pretrained(train_paths, nb, dataset, save_path, device=device, use_test_data=use_test_data,
-                            **config['io'])
+                            shard_size=shard_size, columnar=columnar, resume=resume, progress_every=progress_every,
+                            group_size=group_size, n_threads=n_threads, output_dtype=output_dtype,
+                            image_dtype=image_dtype, compression=compression, **config['io'])
 
 
 if __name__ == "__main__":
@@ -1,7 +1,6 @@
 import pickle
 
 import click
-import numpy as np
 import torch
 import torchvision
 from nasbench import api
@@ -9,7 +8,8 @@ from nasbench import api
 from info_nas.config import local_dataset_cfg
 from info_nas.datasets.io.transforms import IncludeBias, load_scaler, SortByWeights, after_scale_path, get_scale_path, \
     MultByWeights
-from info_nas.datasets.io.semi_dataset import labeled_network_dataset
+from info_nas.datasets.io.semi_dataset import labeled_network_dataset, get_labeled_loader
+from info_nas.datasets.io.stats import RunningStats
 from info_nas.datasets.arch2vec_dataset import prepare_labeled_dataset
 
 
@@ -26,8 +26,10 @@ from info_nas.datasets.arch2vec_dataset import prepare_labeled_dataset
 @click.option('--weighted/--no_weights', default=False)
 @click.option('--multiply_by_weights/--no_mult_weights', default=True)
 @click.option('--config', default=None)
+@click.option('--batch_size', default=1024)
+@click.option('--num_workers', default=0, help='Number of DataLoader workers that transform the data.')
 def main(scale_name, scale_dir, dataset, nasbench_path, axis, axis_bef, normalize_bef, include_bias, per_label,
-         weighted, multiply_by_weights, config):
+         weighted, multiply_by_weights, config, batch_size, num_workers):
 
     if nasbench_path.endswith('.pickle'):
         with open(nasbench_path, 'rb') as f:
@@ -50,22 +52,24 @@ def main(scale_name, scale_dir, dataset, nasbench_path, axis, axis_bef, normaliz
     scaler = load_scaler(scale_path, normalize_bef, include_bias)
     transforms.append(scaler)
 
-    transforms.append(SortByWeights())
+    transforms.append(SortByWeights(include_bias=include_bias))
     transforms = torchvision.transforms.Compose(transforms)
 
     key = 'val' if scale_name == 'valid' else scale_name
     dataset, _ = prepare_labeled_dataset(dataset, nb, key=key, remove_labeled=False, config=config)
     dataset = labeled_network_dataset(dataset, transforms=transforms)
 
-    print("Loading output dataset...")
-    out_data = np.array([item['output'].numpy() for item in dataset])
-    mean = np.mean(out_data, axis=axis)
-    std = np.std(out_data, axis=axis)
+    print("Computing output stats...")
+    stats = RunningStats(axis=axis)
+    for batch in get_labeled_loader(dataset, batch_size=batch_size, num_workers=num_workers):
+        stats.update(batch['output'])
+
+    stats = stats.get_stats()[None]
 
     out_path = after_scale_path(scale_path, axis)
     data = {
-        'mean': mean,
-        'std': std
+        'mean': stats['mean'],
+        'std': stats['std']
     }
 
     with open(out_path, 'wb') as f:
@@ -1,8 +1,13 @@
 import click
+import multiprocessing
 import os
 
 import numpy as np
+import torch
 
+from info_nas.datasets.io.encoding import decode_outputs
+from info_nas.datasets.io.output_layers import get_output_key
+from info_nas.datasets.io.sharded import is_sharded
 from info_nas.datasets.io.transforms import Scaler, get_scale_path
 from info_nas.datasets.io.create_dataset import load_io_dataset
 
@@ -15,25 +20,77 @@ from info_nas.datasets.io.create_dataset import load_io_dataset
 @click.option('--weighted/--original', default=False)
 @click.option('--axis', default=None, type=int)
 @click.option('--include_bias/--no_bias', default=True)
-def main(scale_name, dataset, scale_save_dir, per_label, weighted, axis, include_bias):
-    dataset = load_io_dataset(dataset)
+@click.option('--chunk_size', default=100000, help='Number of rows fitted at once (for datasets that are not'
+                                                   ' sharded, sharded datasets are fitted per shard).')
+@click.option('--n_workers', default=1, help='Number of processes that fit the chunks.')
+def main(scale_name, dataset, scale_save_dir, per_label, weighted, axis, include_bias, chunk_size, n_workers):
+    dataset = load_io_dataset(dataset, decode=False)
 
     if not os.path.exists(scale_save_dir):
         os.mkdir(scale_save_dir)
 
     scale_save_path = get_scale_path(scale_save_dir, scale_name, include_bias, per_label, weighted, axis)
 
-    outputs = dataset['outputs'].numpy()
-    if include_bias:
+    if is_sharded(dataset):
+        parts = [s['path'] for s in dataset['shards']]
+    else:
+        n_rows = len(dataset['net_hashes'])
+        parts = [(i, min(i + chunk_size, n_rows)) for i in range(0, n_rows, chunk_size)]
+
+    scale_kwargs = {'per_label': per_label, 'axis': axis, 'weighted': weighted, 'include_bias': include_bias}
+    scale = Scaler(**scale_kwargs)
+
+    # the weighted scales use all labels, even if a chunk does not contain some of them
+    all_labels = np.unique(dataset['labels'].numpy())
+    init_args = (dataset, scale_kwargs, all_labels)
+
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=init_args) as pool:
+            for part_scale in pool.imap_unordered(_fit_part, parts):
+                scale.merge_fit(part_scale)
+    else:
+        _init_worker(*init_args)
+        for part in parts:
+            scale.merge_fit(_fit_part(part))
+
+    scale.finish_fit(save_path=scale_save_path)
+
+
+_worker_data = {}
+
+
+def _init_worker(dataset, scale_kwargs, all_labels):
+    _worker_data.update(dataset=dataset, scale_kwargs=scale_kwargs, all_labels=all_labels)
+
+
+def _fit_part(part):
+    dataset = _worker_data['dataset']
+    scale = Scaler(**_worker_data['scale_kwargs'])
+
+    outputs, net_hashes, inputs = _load_part(dataset, part)
+    outputs = decode_outputs(outputs, dataset.get('encoding')).numpy()
+
+    if scale.include_bias:
         one_vec = np.ones((len(outputs), 1))
         outputs = np.hstack([outputs, one_vec])
 
-    scale = Scaler(per_label=per_label, axis=axis, weighted=weighted, include_bias=include_bias)
-    scale.fit(outputs,
-              dataset['net_hashes'],
-              labels=dataset['labels'][dataset['inputs']].numpy(),
-              net_repo=dataset['net_repo'],
-              save_path=scale_save_path)
+    scale.partial_fit(outputs, net_hashes,
+                      labels=dataset['labels'][inputs].numpy(),
+                      net_repo=dataset['net_repo'],
+                      all_labels=_worker_data['all_labels'])
+    return scale
+
+
+def _load_part(dataset, part):
+    output_key = get_output_key(dataset)
+
+    # a shard path or a range of rows
+    if is_sharded(dataset):
+        shard = torch.load(part)
+        return shard[output_key], shard['net_hashes'], shard['inputs']
+
+    start, end = part
+    return dataset[output_key][start:end], dataset['net_hashes'][start:end], dataset['inputs'][start:end]
 
 
 if __name__ == "__main__":
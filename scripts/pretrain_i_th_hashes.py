@@ -7,7 +7,8 @@ import pandas as pd
 import torch
 
 from info_nas.config import local_dataset_cfg, load_json_cfg
-from info_nas.datasets.networks.pretrained import pretrain_network_dataset
+from info_nas.datasets.cifar import load_shared_cifar, prepare_batched_dataset
+from info_nas.datasets.networks.pretrained import pretrain_network_dataset, pretrain_network_dataset_parallel
 from nasbench import api
 from nasbench_pytorch.datasets.cifar10 import prepare_dataset
 from scripts.utils import mkdir_if_not_exists
@@ -24,7 +25,17 @@ from scripts.utils import mkdir_if_not_exists
 @click.option('--root', default='../data/cifar/')
 @click.option('--seed', default=1)
 @click.option('--device', default='cuda')
-def main(hashes_dir, chunk_no, hash_csv, prefix, nasbench_path, config_path, root, seed, device):
+@click.option('--save_every_k', default=None, type=int, help='Save the training state every k epochs, partially'
+                                                             ' trained networks are resumed on restart.')
+@click.option('--n_workers', default=1, help='Number of networks trained at once in separate processes.')
+@click.option('--cores_per_worker', default=None, type=int, help='Number of cpu cores per worker process, by default'
+                                                                 ' the cores are divided evenly.')
+@click.option('--group_size', default=1, help='Number of networks trained together on the same batches (in every'
+                                              ' worker process).')
+@click.option('--batched_augment/--per_image_augment', default=False, help='Augment whole batches with tensor'
+                                                                           ' operations on the training device.')
+def main(hashes_dir, chunk_no, hash_csv, prefix, nasbench_path, config_path, root, seed, device, save_every_k,
+         n_workers, cores_per_worker, group_size, batched_augment):
     device = torch.device(device)
 
     # load hashes
@@ -47,6 +58,9 @@ def main(hashes_dir, chunk_no, hash_csv, prefix, nasbench_path, config_path, roo
     else:
         config = load_json_cfg(config_path)
 
+    if save_every_k is not None:
+        config['pretrain']['save_every_k'] = save_every_k
+
     # save config for reference
     config_name = os.path.basename(config_path) if config_path is not None else 'config.json'
     with open(os.path.join(out_dir, config_name), 'w+') as f:
@@ -54,11 +68,26 @@ def main(hashes_dir, chunk_no, hash_csv, prefix, nasbench_path, config_path, roo
 
     nasbench = api.NASBench(nasbench_path)
 
+    if n_workers > 1:
+        # the workers share one decoded copy of the dataset, the data is loaded in the worker processes
+        shared_cifar = load_shared_cifar(root=root)
+        dataset_kwargs = {k: v for k, v in config['cifar-10'].items() if not k.startswith('num_')}
+
+        pretrain_network_dataset_parallel(hash_list, nasbench, shared_cifar, n_workers=n_workers,
+                                          cores_per_worker=cores_per_worker, dataset_kwargs=dataset_kwargs,
+                                          batched_augment=batched_augment, seed=seed, device=device,
+                                          dir_path=out_dir, group_size=group_size, **config['pretrain'])
+        return
+
     random.seed(seed)
     torch.manual_seed(seed)
-    dataset = prepare_dataset(root=root, random_state=seed, **config['cifar-10'])
+    if batched_augment:
+        dataset = prepare_batched_dataset(load_shared_cifar(root=root), random_state=seed, device=device,
+                                          **config['cifar-10'])
+    else:
+        dataset = prepare_dataset(root=root, random_state=seed, **config['cifar-10'])
 
-    pretrain_network_dataset(hash_list, nasbench, dataset, device=device, dir_path=out_dir,
+    pretrain_network_dataset(hash_list, nasbench, dataset, device=device, dir_path=out_dir, group_size=group_size,
                              **config['pretrain'])
 
 
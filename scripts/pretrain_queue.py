@@ -0,0 +1,102 @@
+import multiprocessing
+import random
+
+import click
+import json
+import os
+import pandas as pd
+import torch
+
+from info_nas.config import local_dataset_cfg, load_json_cfg
+from info_nas.datasets.networks.pretrained import pretrain_from_queue
+from info_nas.datasets.networks.work_queue import PretrainQueue
+from nasbench import api
+from nasbench_pytorch.datasets.cifar10 import prepare_dataset
+from scripts.utils import mkdir_if_not_exists
+
+
+def run_worker(queue_path, out_dir, nasbench_path, config, root, seed, device, lease_timeout, max_attempts,
+               n_threads):
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+    queue = PretrainQueue(queue_path, lease_timeout=lease_timeout, max_attempts=max_attempts)
+    nasbench = api.NASBench(nasbench_path)
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+    dataset = prepare_dataset(root=root, random_state=seed, **config['cifar-10'])
+
+    pretrain_from_queue(queue, nasbench, dataset, device=torch.device(device), dir_path=out_dir,
+                        **config['pretrain'])
+
+
+@click.command()
+@click.argument('queue_path')
+@click.argument('out_dir')
+@click.option('--hash_csv', default=None, help='Path to csv file with a column that contains nasbench hashes, the'
+                                               ' hashes are added to the queue.')
+@click.option('--nasbench_path', default='../data/nasbench_only108.tfrecord')
+@click.option('--config_path', default='../configs/pretrain_config.json')
+@click.option('--root', default='../data/cifar/')
+@click.option('--seed', default=1)
+@click.option('--device', default='cuda')
+@click.option('--save_every_k', default=None, type=int, help='Save the training state every k epochs, partially'
+                                                             ' trained networks are resumed on restart.')
+@click.option('--n_workers', default=1, help='Number of local worker processes.')
+@click.option('--lease_timeout', default=600, help='Seconds after which the network of a crashed worker is released.')
+@click.option('--max_attempts', default=3, help='Maximum number of training attempts per network.')
+@click.option('--status/--run', default=False, help='Only print the queue progress.')
+def main(queue_path, out_dir, hash_csv, nasbench_path, config_path, root, seed, device, save_every_k, n_workers,
+         lease_timeout, max_attempts, status):
+    """
+    Pretrain networks from a shared work queue (SQLite database at QUEUE_PATH), save the checkpoints to OUT_DIR.
+    Run the script on every node that shares the queue and the checkpoint directory.
+    """
+    queue = PretrainQueue(queue_path, lease_timeout=lease_timeout, max_attempts=max_attempts)
+
+    if hash_csv is not None:
+        hash_list = pd.read_csv(hash_csv)['hashes'].to_list()
+        print(f"Added {queue.add(hash_list)} hashes to the queue.")
+
+    if status:
+        print(queue.progress())
+        for net_hash, error in queue.get_failed():
+            print(f"Failed: {net_hash}\n{error}")
+        return
+
+    mkdir_if_not_exists(out_dir)
+
+    if not len(config_path) or config_path is None:
+        config = local_dataset_cfg
+    else:
+        config = load_json_cfg(config_path)
+
+    if save_every_k is not None:
+        config['pretrain']['save_every_k'] = save_every_k
+
+    # save config for reference
+    config_name = os.path.basename(config_path) if config_path is not None else 'config.json'
+    with open(os.path.join(out_dir, config_name), 'w+') as f:
+        json.dump(config, f, indent='    ')
+
+    worker_args = (queue_path, out_dir, nasbench_path, config, root, seed, device, lease_timeout, max_attempts)
+
+    if n_workers == 1:
+        run_worker(*worker_args, None)
+    else:
+        # divide the cores between the workers
+        n_threads = max(1, torch.get_num_threads() // n_workers)
+
+        ctx = multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_worker, args=(*worker_args, n_threads)) for _ in range(n_workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    print(queue.progress())
+
+
+if __name__ == "__main__":
+    main()
@@ -54,9 +54,11 @@ from scripts.utils import experiment_transforms
 @click.option('--seed', default=1, help="Seed to use.")
 @click.option('--batch_size', default=32, help="Batch size for both labeled and unlabeled batches.")
 @click.option('--epochs', default=7, help="Number of training epochs.")
+@click.option('--batched_transforms/--item_transforms', default=False,
+              help="If True, transform whole labeled batches at once instead of single items.")
 def run(train_path, valid_path, unseen_valid_path, checkpoint_path, nasbench_path, nb_dataset, cifar,
         model_cfg, use_ref, test_is_splitted, use_unseen_data, use_accuracy, deterministic, device,
-        seed, batch_size, epochs):
+        seed, batch_size, epochs, batched_transforms):
     """
     Run the training of the info-NAS model.
     """
@@ -86,8 +88,9 @@ def run(train_path, valid_path, unseen_valid_path, checkpoint_path, nasbench_pat
                                                         test_labeled_train_path=unseen_valid_path,
                                                         test_valid_split=None if test_is_splitted else 0.1)
 
-    transforms = experiment_transforms(model_cfg, use_accuracy=use_accuracy)
-    val_transforms = experiment_transforms(model_cfg, use_accuracy=use_accuracy)
+    # the labeled datasets bind the transforms to their networks (sort permutations are precomputed)
+    transforms = experiment_transforms(model_cfg, use_accuracy=use_accuracy, batched=batched_transforms)
+    val_transforms = experiment_transforms(model_cfg, use_accuracy=use_accuracy, batched=batched_transforms)
 
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     if not os.path.exists(checkpoint_path):
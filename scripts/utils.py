@@ -1,11 +1,11 @@
 import os
 
-import torch
 import torchvision
 from info_nas.datasets.arch2vec_dataset import prepare_labeled_dataset, split_off_valid
-from info_nas.datasets.io.semi_dataset import labeled_network_dataset
+from info_nas.datasets.io.semi_dataset import labeled_network_dataset, get_labeled_loader
 
-from info_nas.datasets.io.transforms import ToTuple, SortByWeights, MultByWeights, IncludeBias
+from info_nas.datasets.io.transforms import ToTuple, SortByWeights, MultByWeights, IncludeBias, BatchCompose, \
+    BatchToDevice, BatchToTuple, BatchSortByWeights, BatchMultByWeights, BatchIncludeBias
 
 
 def mkdir_if_not_exists(dir):
@@ -13,16 +13,21 @@ def mkdir_if_not_exists(dir):
         os.mkdir(dir)
 
 
-def experiment_transforms(cfg, use_accuracy=False):
+def experiment_transforms(cfg, use_accuracy=False, batched=False, device=None, net_repo=None):
     transforms = []
-    transforms.append(IncludeBias())
+    if batched and device is not None:
+        transforms.append(BatchToDevice(device))
+
+    transforms.append(BatchIncludeBias() if batched else IncludeBias())
     nr = cfg['scale'].get('normalize_row', False)
-    transforms.append(MultByWeights(include_bias=True, normalize_row=nr))
+    mult = BatchMultByWeights if batched else MultByWeights
+    transforms.append(mult(include_bias=True, normalize_row=nr))
     top_k = cfg['scale'].get('top_k', None)
-    transforms.append(SortByWeights(return_top_n=top_k, after_sort_scale=None))
+    sort = BatchSortByWeights if batched else SortByWeights
+    transforms.append(sort(return_top_n=top_k, after_sort_scale=None, net_repo=net_repo, include_bias=True))
     if not use_accuracy:
-        transforms.append(ToTuple())
-    return torchvision.transforms.Compose(transforms)
+        transforms.append(BatchToTuple() if batched else ToTuple())
+    return BatchCompose(transforms) if batched else torchvision.transforms.Compose(transforms)
 
 
 def get_eval_set(data_name, dataset, nb, transforms, batch_size, config=None, split_ratio=None, use_larger_part=False):
@@ -34,5 +39,4 @@ def get_eval_set(data_name, dataset, nb, transforms, batch_size, config=None, sp
 
     dataset = labeled_network_dataset(dataset, transforms=transforms)
 
-    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                                       num_workers=0)
+    return get_labeled_loader(dataset, batch_size=batch_size, shuffle=False, num_workers=0)
@@ -0,0 +1,30 @@
+import pytest
+
+from info_nas.datasets.io.output_layers import get_output_key, normalize_output_layers
+
+
+def test_normalize_output_layers():
+    assert normalize_output_layers(-2, 11) == 9
+    assert normalize_output_layers([-1, 3, -11], 11) == [10, 3, 0]
+
+    with pytest.raises(ValueError):
+        normalize_output_layers(11, 11)
+
+    with pytest.raises(ValueError):
+        normalize_output_layers(-12, 11)
+
+
+@pytest.mark.parametrize('stored', [[9, 8, 10], [-2, -3, -1], [9, -3, 10]])
+def test_output_key_equivalent_indices(stored):
+    io_dataset = {'output_layers': stored, 'n_output_points': 11}
+
+    for nth, column in zip([-2, -3, -1], ['outputs', 'outputs_1', 'outputs_2']):
+        assert get_output_key(io_dataset, nth) == column
+        assert get_output_key(io_dataset, nth + 11) == column
+
+
+def test_output_key_not_captured():
+    io_dataset = {'output_layers': [9], 'n_output_points': 11}
+
+    with pytest.raises(ValueError):
+        get_output_key(io_dataset, -1)
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import info_nas.datasets.networks.pretrained as pretrained
+from info_nas.datasets.cifar import prepare_batched_dataset
+
+ADJACENCY = np.array([[0, 1, 1, 0, 0],
+                      [0, 0, 0, 1, 0],
+                      [0, 0, 0, 0, 1],
+                      [0, 0, 0, 0, 1],
+                      [0, 0, 0, 0, 0]])
+OPS = ['input', 'conv3x3-bn-relu', 'maxpool3x3', 'conv1x1-bn-relu', 'output']
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _get_dataset(n_images=48):
+    gen = torch.Generator().manual_seed(0)
+    images = torch.randint(0, 256, (n_images, 3, 32, 32), dtype=torch.uint8, generator=gen)
+    labels = torch.arange(n_images) % 10
+
+    return prepare_batched_dataset({'train': (images, labels), 'test': (images[:16], labels[:16])}, 16,
+                                   validation_size=16)
+
+
+def _pretrain(dir_path, dataset, **kwargs):
+    torch.manual_seed(0)
+    pretrained._pretrain_net('net', OPS, ADJACENCY, dataset, dir_path=str(dir_path), num_epochs=3,
+                             optimizer='sgd', print_frequency=1000, **kwargs)
+
+    return torch.load(os.path.join(dir_path, 'net.tar'))
+
+
+def _assert_same(checkpoint, other):
+    assert checkpoint['info'] == other['info']
+    for key, value in checkpoint['model_state_dict'].items():
+        assert torch.equal(value, other['model_state_dict'][key]), key
+
+
+@pytest.mark.parametrize('save_every_k', [1, 2])
+def test_resumed_training_matches(tmp_path, monkeypatch, save_every_k):
+    dataset = _get_dataset()
+    uninterrupted = _pretrain(tmp_path / 'uninterrupted', dataset)
+
+    # the training is interrupted right after the first saved state
+    save_state = pretrained.save_training_state
+
+    def save_and_interrupt(*args, **kwargs):
+        save_state(*args, **kwargs)
+        raise _Interrupted()
+
+    monkeypatch.setattr(pretrained, 'save_training_state', save_and_interrupt)
+    with pytest.raises(_Interrupted):
+        _pretrain(tmp_path / 'resumed', dataset, save_every_k=save_every_k)
+
+    monkeypatch.setattr(pretrained, 'save_training_state', save_state)
+    resumed = _pretrain(tmp_path / 'resumed', dataset, save_every_k=save_every_k)
+
+    _assert_same(uninterrupted, resumed)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from info_nas.datasets.io.reducers import get_reducer, get_transformed_size
+from info_nas.datasets.io.semi_dataset import ReferenceNetworkDataset
+from scripts.utils import experiment_transforms
+
+
+def _get_reduced_dataset(reduced_size, n_nets=2, n_rows=6):
+    net_repo = {f"h{i}": {'adj': torch.zeros(7, 7), 'ops': torch.zeros(7, 5), 'weights': torch.randn(10, reduced_size),
+                          'bias': torch.randn(10)} for i in range(n_nets)}
+    io_dataset = {
+        'net_hashes': np.array([f"h{i % n_nets}" for i in range(n_rows)]),
+        'inputs': torch.arange(n_rows),
+        'outputs': torch.randn(n_rows, reduced_size),
+        'dataset': torch.randn(n_rows, 3, 2, 2),
+        'labels': torch.arange(n_rows),
+        'net_repo': net_repo,
+        'output_reducers': [[{'type': 'projection', 'out_dim': reduced_size, 'seed': 1, 'in_dim': 64}]]
+    }
+
+    return io_dataset
+
+
+@pytest.mark.parametrize('reduced_size,top_k', [(32, 10), (32, None), (5, 10)])
+def test_transformed_size(reduced_size, top_k):
+    io_dataset = _get_reduced_dataset(reduced_size)
+
+    transforms = experiment_transforms({'scale': {'include_bias': False, 'top_k': top_k}}, use_accuracy=True)
+    dataset = ReferenceNetworkDataset(io_dataset['net_hashes'], io_dataset['inputs'], io_dataset['outputs'],
+                                      net_repo=io_dataset['net_repo'], transform=transforms,
+                                      reference_dataset=(io_dataset['dataset'], io_dataset['labels']))
+
+    assert dataset[0]['output'].shape[0] == get_transformed_size(io_dataset, top_k=top_k)
+
+
+@pytest.mark.parametrize('params', [
+    {'type': 'projection', 'out_dim': 4},
+    {'type': 'pca', 'n_components': 4},
+    [{'type': 'pool'}, {'type': 'projection', 'out_dim': 6}, {'type': 'pca', 'n_components': 4}],
+    [{'type': 'pca', 'n_components': 6}, {'type': 'projection', 'out_dim': 4}]
+])
+def test_reducer_save_load(params):
+    reducer = get_reducer(params)
+    assert reducer.needs_fit
+
+    # the first batches have less rows than the PCA components
+    for batch_size in [2, 3, 5]:
+        reducer.partial_fit(torch.randn(batch_size, 8, 2, 2))
+    reducer.finish_fit()
+
+    saved = reducer.get_params()
+    assert all(p['in_dim'] is not None for p in saved if p['type'] == 'projection')
+    assert all(p['singular_values'] is not None for p in saved if p['type'] == 'pca')
+
+    loaded = get_reducer(saved)
+    assert not loaded.needs_fit
+
+    x = torch.randn(3, 8, 2, 2)
+    assert torch.allclose(reducer(x), loaded(x), atol=1e-5)
+
+
+def test_pca_not_enough_rows():
+    reducer = get_reducer({'type': 'pca', 'n_components': 4})
+    reducer.partial_fit(torch.randn(3, 8))
+
+    with pytest.raises(ValueError):
+        reducer.finish_fit()
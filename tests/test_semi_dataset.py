@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data._utils.collate import default_collate
+
+from info_nas.datasets.io.semi_dataset import ReferenceNetworkDataset
+
+
+def _get_dataset(use_reference, n_nets=3, n_rows=12):
+    net_repo = {f"h{i}": {'adj': torch.full((7, 7), i), 'ops': torch.full((7, 5), i),
+                          'weights': torch.randn(10, 4), 'bias': torch.randn(10)} for i in range(n_nets)}
+
+    net_hashes = np.array([f"h{i % n_nets}" for i in range(n_rows)])
+    outputs = torch.randn(n_rows, 4)
+
+    if use_reference:
+        images, labels = torch.randn(5, 3, 2, 2), torch.arange(5)
+        inputs = torch.arange(n_rows) % 5
+        return ReferenceNetworkDataset(net_hashes, inputs, outputs, net_repo=net_repo, return_ref_id=True,
+                                       reference_dataset=(images, labels))
+
+    inputs = torch.randn(n_rows, 3, 2, 2)
+    return ReferenceNetworkDataset(net_hashes, inputs, outputs, net_repo=net_repo, return_ref_id=True)
+
+
+@pytest.mark.parametrize('use_reference', [True, False])
+def test_batch_equals_collated_items(use_reference):
+    dataset = _get_dataset(use_reference)
+    indices = [3, 0, 7, 11]
+
+    batch = dataset.get_batch(indices)
+    items = default_collate([dataset[i] for i in indices])
+
+    assert batch.keys() == items.keys()
+    assert ('ref_id' in batch) == use_reference
+    for key in batch:
+        assert torch.equal(torch.as_tensor(batch[key]), torch.as_tensor(items[key])), key